@@ -1,12 +1,29 @@
+import time
+
+# Startup is timed from here, before the imports below.
+STARTED = time.perf_counter()
+
 import os
+import sys
 import tkinter as tk
 from tkinter import filedialog
-import pygame
 import threading
-import time
-from mutagen.mp3 import MP3
-import configparser
-import keyboard
+import bisect
+import argparse
+import json
+import signal
+
+import instrument
+from virtual_listbox import VirtualListbox
+from waveform_view import WaveformSeekBar
+from track_queue import QueueListboxView
+from dispatcher import Dispatcher, EventLoop
+from engine import PlayerEngine
+from control import ControlServer, execute, send_command
+
+
+CONTROL_SOCKET = "player.sock"
+PLAYLIST_FILETYPES = [("Playlists", "*.m3u *.m3u8 *.pls"), ("All files", "*")]
 
 
 class HoverTooltip:
@@ -59,41 +76,57 @@ class HoverTooltip:
 
 
 class TooltipMP3Player:
-    CONFIG_FILE = "player_config.ini"
+    SEARCH_DEBOUNCE_MS = 150
 
-    def __init__(self, root):
+    def __init__(self, root, control_socket=None):
         self.root = root
         self.root.title("Minimalist Audio Player")
         self.root.geometry("940x780")
         self.root.resizable(False, False)
 
-        pygame.mixer.init()
+        # The window is one client of the engine: both run on the Tk thread
+        # through the dispatcher, and hotkeys / socket clients post to it.
+        self.dispatcher = Dispatcher(root)
+        self.dispatcher.start()
+        self.engine = PlayerEngine(self.dispatcher)
+        self.engine.subscribe(self.on_engine_event)
 
-        self.files = []
         self.filtered_indices = []
-        self.current_index = None
-        self.playing = False
-        self.paused = False
-        self.song_length = 0
-        self.start_time = 0
-        self.pause_start = 0
-        self.paused_time_accum = 0
-        self.updating_slider = False
-        self.changing_track = False
         self.current_song_tooltip = "Double-click a song to play"
-        self.queue = []
-
-
-        self.config = configparser.ConfigParser()
-        self.load_config()
+        self.search_after_id = None
+        self.debug_panel = None
+        self.effects_window = None
+        if instrument.enabled:
+            instrument.wrap(self, "apply_search", prefix="gui.")
+
+        self.control = None
+        if control_socket:
+            self.control = ControlServer(control_socket, self.dispatcher.post,
+                                         lambda line: execute(self.engine, line))
+            try:
+                self.control.start()
+            except OSError as e:
+                print(f"Control socket not available: {e}")
+                self.control = None
 
         self.tooltip_label = tk.Label(root, text=self.current_song_tooltip,
                                       fg="white", bg="gray", font=("Arial", 10))
         self.tooltip_label.pack(fill="x", pady=2)
 
-        select_folder_btn = tk.Button(root, text="Select Folder", command=self.select_folder)
-        select_folder_btn.pack(pady=8)
+        folder_controls = tk.Frame(root)
+        folder_controls.pack(pady=8)
+        select_folder_btn = tk.Button(folder_controls, text="Select Folder", command=self.select_folder)
+        select_folder_btn.pack(side="left", padx=5)
         HoverTooltip(select_folder_btn, "Select a folder containing audio files")
+        load_playlist_btn = tk.Button(folder_controls, text="Load Playlist...", command=self.load_playlist)
+        load_playlist_btn.pack(side="left", padx=5)
+        HoverTooltip(load_playlist_btn, "Queue the tracks of an M3U, M3U8 or PLS playlist")
+
+        self.library_mode = tk.BooleanVar(value=self.engine.library_mode)
+        library_checkbox = tk.Checkbutton(root, text="Library mode (include subfolders)",
+                                          variable=self.library_mode, command=self.toggle_library_mode)
+        library_checkbox.pack()
+        HoverTooltip(library_checkbox, "Load every subfolder and pick up added, removed or renamed files automatically")
 
         search_frame = tk.Frame(root)
         search_frame.pack(fill="x", padx=10, pady=5)
@@ -104,7 +137,7 @@ class TooltipMP3Player:
         search_entry.pack(side="left", fill="x", expand=True, padx=5)
         HoverTooltip(search_entry, "Type to search/filter songs")
 
-        self.listbox = tk.Listbox(root)
+        self.listbox = VirtualListbox(root, self.track_label)
         self.listbox.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
         self.listbox.bind("<Double-1>", self.on_double_click)
         self.listbox.bind("<Button-3>", self.show_context_menu)
@@ -112,13 +145,22 @@ class TooltipMP3Player:
         self.menu = tk.Menu(self.root, tearoff=0)
         self.menu.add_command(label="Add to Queue", command=self.add_to_queue)
         self.menu.add_command(label="Play Next", command=self.add_to_front_of_queue)
+        self.menu.add_separator()
+        self.menu.add_command(label="Queue All Results", command=self.queue_all_results)
+        self.menu.add_command(label="Queue Folder", command=self.queue_folder)
+        self.menu.add_command(label="Remove Duplicates from Queue", command=self.dedupe_queue)
+        self.menu.add_command(label="Sort Queue by Album", command=self.sort_queue)
 
         self.time_label = tk.Label(root, 
             padx=10, pady=15,
             text="00:00 / 00:00")
         self.time_label.pack()
 
-        self.position = tk.DoubleVar()
+        self.seek_bar = WaveformSeekBar(root, on_seek=self.engine.seek)
+        self.seek_bar.pack(fill="x", padx=20)
+        HoverTooltip(self.seek_bar, "Click or drag to seek, scroll to zoom, double-click to show the whole track")
+        # Created on the first track; building peaks needs NumPy.
+        self.waveforms = None
         self.hotkeys_enabled = tk.BooleanVar(value=True)
 
         self.hotkey_stop_event = threading.Event()
@@ -127,27 +169,34 @@ class TooltipMP3Player:
         
         controls = tk.Frame(root)
         controls.pack()
-        prev_btn = tk.Button(controls, text="⏮ Previous", command=self.previous_track)
+        prev_btn = tk.Button(controls, text="⏮ Previous", command=self.engine.previous_track)
         prev_btn.grid(row=0, column=0, padx=5)
         HoverTooltip(prev_btn, "Play previous track")
         play_btn = tk.Button(controls, text="Play", command=self.play_selected)
         play_btn.grid(row=0, column=1, padx=5)
         HoverTooltip(play_btn, "Play selected song")
-        pause_btn = tk.Button(controls, text="Pause/Resume", command=self.pause_resume)
+        pause_btn = tk.Button(controls, text="Pause/Resume", command=self.engine.pause_resume)
         pause_btn.grid(row=0, column=2, padx=5)
         HoverTooltip(pause_btn, "Pause or resume")
-        stop_btn = tk.Button(controls, text="Stop", command=self.stop)
+        stop_btn = tk.Button(controls, text="Stop", command=self.engine.stop)
         stop_btn.grid(row=0, column=3, padx=5)
         HoverTooltip(stop_btn, "Stop playback")
-        next_btn = tk.Button(controls, text="Next ⏭", command=self.next_track)
+        next_btn = tk.Button(controls, text="Next ⏭", command=self.engine.next_track)
         next_btn.grid(row=0, column=4, padx=5)
         HoverTooltip(next_btn, "Play next track")
 
         queue_controls = tk.Frame(root)
         queue_controls.pack(pady=10)
         add_queue_btn = tk.Button(queue_controls, text="+ Add to Queue", command=self.add_to_queue)
-        add_queue_btn.pack()
+        add_queue_btn.pack(side="left", padx=5)
         HoverTooltip(add_queue_btn, "Add selected song to queue")
+        queue_all_btn = tk.Button(queue_controls, text="+ Queue All Results", command=self.queue_all_results)
+        queue_all_btn.pack(side="left", padx=5)
+        HoverTooltip(queue_all_btn, "Add every song matching the current search to the queue")
+        save_results_btn = tk.Button(queue_controls, text="Save Results...",
+                                     command=lambda: self.save_playlist(self.filtered_indices))
+        save_results_btn.pack(side="left", padx=5)
+        HoverTooltip(save_results_btn, "Write every song matching the current search to a playlist")
 
         hotkey_checkbox = tk.Checkbutton(
             root,
@@ -157,6 +206,37 @@ class TooltipMP3Player:
             )
         hotkey_checkbox.pack(pady=5)
 
+        self.gapless = tk.BooleanVar(value=self.engine.gapless)
+        self.crossfade = tk.DoubleVar(value=self.engine.crossfade)
+        playback_options = tk.Frame(root)
+        playback_options.pack()
+        gapless_checkbox = tk.Checkbutton(playback_options, text="Gapless playback",
+                                          variable=self.gapless, command=self.toggle_gapless)
+        gapless_checkbox.pack(side="left", padx=5)
+        HoverTooltip(gapless_checkbox, "Pre-load the next track so it starts without a gap")
+        crossfade_slider = tk.Scale(playback_options, from_=0, to=10, orient="horizontal",
+                                    resolution=0.5, label="Fade out (s)", length=160,
+                                    variable=self.crossfade, command=self.set_crossfade)
+        crossfade_slider.pack(side="left", padx=5)
+        HoverTooltip(crossfade_slider, "With gapless playback, fade the end of each track into the next one")
+        self.normalization = tk.StringVar(value=self.engine.normalization)
+        tk.Label(playback_options, text="Normalize:").pack(side="left")
+        normalization_menu = tk.OptionMenu(playback_options, self.normalization,
+                                           *self.engine.NORMALIZATION_MODES,
+                                           command=self.set_normalization)
+        normalization_menu.pack(side="left", padx=5)
+        HoverTooltip(normalization_menu, "Even out loudness per track or per album (ReplayGain)")
+        self.shuffle = tk.StringVar(value=self.engine.shuffle_mode)
+        tk.Label(playback_options, text="Shuffle:").pack(side="left")
+        shuffle_menu = tk.OptionMenu(playback_options, self.shuffle, *self.engine.SHUFFLE_MODES,
+                                     command=self.set_shuffle)
+        shuffle_menu.pack(side="left", padx=5)
+        HoverTooltip(shuffle_menu, "Shuffle the tracks shown in the list; smart favours "
+                                   "less played tracks and spaces out artists")
+        effects_btn = tk.Button(playback_options, text="Effects...", command=self.toggle_effects_window)
+        effects_btn.pack(side="left", padx=5)
+        HoverTooltip(effects_btn, "Equalizer, balance and limiter")
+
 
         self.status_label = tk.Label(
             root,
@@ -170,8 +250,7 @@ class TooltipMP3Player:
         )
         self.status_label.pack(pady=2)
 
-        default_volume = float(self.config.get("Settings", "volume", fallback="0.8"))
-        self.volume = tk.DoubleVar(value=default_volume)
+        self.volume = tk.DoubleVar(value=self.engine.volume)
         volume_slider = tk.Scale(root, from_=0, to=1, orient="horizontal",
                                  resolution=0.01, label="Volume",
                                  variable=self.volume, command=self.set_volume)
@@ -188,19 +267,48 @@ class TooltipMP3Player:
         queue_scroll.pack(side="right", fill="y")
         self.queue_listbox.config(yscrollcommand=queue_scroll.set)
         self.queue_listbox.bind("<Button-3>", self.show_context_menu)
-
-        clear_queue_btn = tk.Button(root, text="Clear Queue", command=self.clear_queue)
-        clear_queue_btn.pack(pady=5)
+        self.queue = self.engine.queue
+        self.queue_view = QueueListboxView(self.queue_listbox, self.queue,
+                                           lambda i: self.engine.tracks.name(i))
+
+        queue_buttons = tk.Frame(root)
+        queue_buttons.pack(pady=5)
+        clear_queue_btn = tk.Button(queue_buttons, text="Clear Queue", command=self.clear_queue)
+        clear_queue_btn.pack(side="left", padx=5)
         HoverTooltip(clear_queue_btn, "Remove all items from queue")
+        save_queue_btn = tk.Button(queue_buttons, text="Save Queue...",
+                                   command=lambda: self.save_playlist(list(self.queue)))
+        save_queue_btn.pack(side="left", padx=5)
+        HoverTooltip(save_queue_btn, "Write the queue to a playlist")
 
-        self.update_thread = threading.Thread(target=self.update_slider_loop, daemon=True)
-        self.update_thread.start()
-
-        pygame.mixer.music.set_volume(self.volume.get())
         self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+        # Hidden: timings from --profile, refreshed while open.
+        self.root.bind("<Control-Shift-D>", self.toggle_debug_panel)
+
+        self.dragging_item = None
+        self.drag_current_target = None
+        self.drag_window = None
+        self.drag_label = None
+        self.drag_offset_x = 10
+        self.drag_offset_y = 10
+        self.queue_listbox.bind("<ButtonPress-1>", self.on_drag_start)
+        self.queue_listbox.bind("<B1-Motion>", self.on_drag_motion)
+        self.queue_listbox.bind("<ButtonRelease-1>", self.on_drag_end)
+
+        self.engine.start()
+        self.root.after_idle(self.report_startup)
 
         threading.Thread(target=self.setup_global_hotkeys, daemon=True).start()
 
+    def report_startup(self):
+        # Runs once the window is up and the last library is listed.
+        elapsed = time.perf_counter() - STARTED
+        if instrument.enabled:
+            instrument.record("startup.time_to_interactive", STARTED)
+        budget = self.engine.config.getint("Settings", "startup_budget_ms", fallback=500)
+        if elapsed * 1000 > budget:
+            print(f"Startup took {elapsed * 1000:.0f} ms (budget {budget} ms)")
+
     def toggle_hotkeys(self):
         if self.hotkeys_enabled.get():
             if not self.hotkey_thread or not self.hotkey_thread.is_alive():
@@ -211,6 +319,7 @@ class TooltipMP3Player:
         else:
             try:
                 self.hotkey_stop_event.set()
+                import keyboard
                 keyboard.unhook_all_hotkeys()
                 print("Hotkeys disabled")
             except Exception as e:
@@ -218,106 +327,215 @@ class TooltipMP3Player:
 
 
     def setup_global_hotkeys(self):
+        # Hotkey callbacks run on the keyboard hook thread; they only post
+        # to the dispatcher, which runs the command on the Tk thread.
+        post = self.dispatcher.post
+        engine = self.engine
         try:
-            keyboard.add_hotkey("ctrl+alt+left", self.previous_track)
-            keyboard.add_hotkey("ctrl+alt+right", self.next_track)
-            keyboard.add_hotkey("ctrl+alt+up", self.pause_resume)
+            # Imported here, off the Tk thread, to keep it out of startup.
+            import keyboard
+            keyboard.add_hotkey("ctrl+alt+left", instrument.dispatched(post, "hotkey.previous", engine.previous_track))
+            keyboard.add_hotkey("ctrl+alt+right", instrument.dispatched(post, "hotkey.next", engine.next_track))
+            keyboard.add_hotkey("ctrl+alt+up", instrument.dispatched(post, "hotkey.pause", engine.pause_resume))
         except Exception as e:
             print(f"Global hotkeys not available: {e}")
 
-        if self.Last_folder and os.path.exists(self.Last_folder):
-            self.load_folder(self.Last_folder)
-
-        self.dragging_item = None
-        self.drag_current_target = None
-        self.drag_window = None
-        self.drag_label = None
-        self.drag_offset_x = 10
-        self.drag_offset_y = 10
-        self.queue_listbox.bind("<ButtonPress-1>", self.on_drag_start)
-        self.queue_listbox.bind("<B1-Motion>", self.on_drag_motion)
-        self.queue_listbox.bind("<ButtonRelease-1>", self.on_drag_end)
-
-
-    def load_config(self):
-        if os.path.exists(self.CONFIG_FILE):
-            self.config.read(self.CONFIG_FILE)
-        else:
-            self.config["Settings"] = {"volume": "0.8"}
-        self.Last_folder = self.config.get("Settings", "Last_folder", fallback="")
-
-    def save_config(self):
-        if "Settings" not in self.config:
-            self.config["Settings"] = {}
-        self.config["Settings"]["volume"] = str(self.volume.get())
-        if hasattr(self, "Last_folder") and self.Last_folder:
-            self.config["Settings"]["Last_folder"] = self.Last_folder
-        with open(self.CONFIG_FILE, "w") as f:
-            self.config.write(f)
 
     def on_close(self):
-        self.save_config()
+        self.engine.close()
+        if self.waveforms:
+            self.waveforms.close()
+        if self.control:
+            self.control.stop()
+        self.dispatcher.stop()
         self.root.destroy()
-
-    def load_folder(self, folder):
-        self.listbox.delete(0, tk.END)
-        self.files = []
-
-        for f in sorted(os.listdir(folder)):
-            if f.lower().endswith((".mp3", ".wav", ".ogg", ".flac")):
-                file_path = os.path.join(folder, f)
-                try:
-                    if f.lower().endswith(".mp3"):
-                        audio = MP3(file_path)
-                        length = audio.info.length
-                    else:
-                        sound = pygame.mixer.Sound(file_path)
-                        length = sound.get_length()
-                        del sound
-                except Exception as e:
-                    self.show_tooltip(f"Error loading {f}: {str(e)}", 5)
-                    continue
-
-                self.files.append((file_path, length))
-                self.listbox.insert(tk.END, os.path.splitext(f)[0].replace("_", " "))
-
-        self.filtered_indices = list(range(len(self.files)))
-        if self.files:
-            self.show_tooltip(f"Loaded {len(self.files)} track(s)", 3)
+        if instrument.enabled:
+            instrument.dump()
+
+    def toggle_debug_panel(self, event=None):
+        if self.debug_panel:
+            self.debug_panel.destroy()
+            self.debug_panel = None
+            self.dispatcher.cancel("debug_panel")
+            return
+        self.debug_panel = tk.Toplevel(self.root)
+        self.debug_panel.title("Timings")
+        self.debug_panel.protocol("WM_DELETE_WINDOW", self.toggle_debug_panel)
+        self.debug_text = tk.Text(self.debug_panel, width=100, height=30, font=("Courier", 9))
+        self.debug_text.pack(fill="both", expand=True)
+        self.refresh_debug_panel()
+
+    def refresh_debug_panel(self):
+        if not self.debug_panel:
+            return
+        if instrument.enabled:
+            text = instrument.summary()
+        else:
+            text = "Instrumentation is off. Start the player with --profile to collect timings."
+        buffers = self.engine.buffers.stats()
+        text += (f"\n\nTrack buffers: {buffers['entries']} track(s), "
+                 f"{buffers['bytes'] / 1048576:.1f} / {buffers['max_bytes'] / 1048576:.0f} MB, "
+                 f"{buffers['hits']} hit(s), {buffers['misses']} miss(es), "
+                 f"{buffers['evictions']} eviction(s)")
+        if self.engine.effects:
+            effects = self.engine.effects.stats()
+            text += (f"\nEffects: {effects['blocks']} block(s), mean {effects['mean_ms']} ms, "
+                     f"worst {effects['worst_ms']} ms of {effects['budget_ms']} ms, "
+                     f"{effects['late']} late, {effects['underruns']} underrun(s), "
+                     f"latency {effects['latency_ms']} ms")
+        self.debug_text.delete("1.0", tk.END)
+        self.debug_text.insert("1.0", text)
+        self.dispatcher.call_later("debug_panel", 1.0, self.refresh_debug_panel)
+
+    def toggle_effects_window(self):
+        if self.effects_window:
+            self.effects_window.destroy()
+            self.effects_window = None
+            return
+        import dsp
+        self.effects_window = window = tk.Toplevel(self.root)
+        window.title("Effects")
+        window.protocol("WM_DELETE_WINDOW", self.toggle_effects_window)
+        self.effects_enabled = tk.BooleanVar(value=self.engine.effects_enabled)
+        tk.Checkbutton(window, text="Enable effects", variable=self.effects_enabled,
+                       command=lambda: self.engine.set_effects(self.effects_enabled.get())).pack(pady=5)
+        bands = tk.Frame(window)
+        bands.pack(padx=10)
+        gains = list(self.engine.eq) + [0.0] * (len(dsp.EQ_BANDS) - len(self.engine.eq))
+        self.eq_vars = []
+        for freq, gain in zip(dsp.EQ_BANDS, gains):
+            var = tk.DoubleVar(value=gain)
+            self.eq_vars.append(var)
+            label = f"{freq // 1000}k" if freq >= 1000 else str(freq)
+            tk.Scale(bands, from_=dsp.EQ_RANGE, to=-dsp.EQ_RANGE, resolution=0.5, length=150,
+                     label=label, variable=var, command=self.set_eq).pack(side="left")
+        self.balance = tk.DoubleVar(value=self.engine.balance)
+        tk.Scale(window, from_=-1, to=1, orient="horizontal", resolution=0.05, label="Balance",
+                 variable=self.balance,
+                 command=lambda _: self.engine.set_balance(self.balance.get())).pack(fill="x", padx=10)
+        self.limiter = tk.BooleanVar(value=self.engine.limiter)
+        tk.Checkbutton(window, text="Limiter", variable=self.limiter,
+                       command=lambda: self.engine.set_limiter(self.limiter.get())).pack(pady=5)
+
+    def set_eq(self, _=None):
+        self.engine.set_eq([var.get() for var in self.eq_vars])
+
+    def on_engine_event(self, event, *args):
+        if event == "library_cleared":
+            self.filtered_indices = []
+            self.listbox.set_count(0, reset=True)
+            self.update_shuffle_scope()
+        elif event == "tracks_added":
+            start, stop = args
+            query = self.search_var.get()
+            if not query:
+                self.filtered_indices.extend(range(start, stop))
+            else:
+                matches = self.engine.search_index.matches
+                self.filtered_indices.extend(i for i in range(start, stop) if matches(i, query))
+            self.listbox.set_count(len(self.filtered_indices))
+        elif event == "library_changed":
+            self.filtered_indices = self.engine.search_index.search(self.search_var.get())
+            self.listbox.selection_clear()
+            self.listbox.set_count(len(self.filtered_indices))
+            self.listbox.refresh()
+            self.update_shuffle_scope()
+        elif event == "track":
+            self.track_started(args[0])
+        elif event == "paused":
+            self.update_top_message("Paused", permanent=True)
+        elif event == "resumed":
+            self.update_top_message(self.current_song_tooltip, permanent=True)
+        elif event == "stopped":
+            self.seek_bar.set_track(0)
+            if self.waveforms:
+                self.waveforms.cancel()
+            self.time_label.config(text="00:00 / 00:00")
+            self.update_top_message("Double-click a song to play", permanent=False)
+            self.show_tooltip("Select a song to play")
+        elif event == "position":
+            current = args[0]
+            self.seek_bar.set_position(current)
+            self.update_time_label(current)
+        elif event == "message":
+            text, duration, permanent = args
+            self.show_tooltip(text, duration, permanent)
+
+    def toggle_library_mode(self):
+        self.engine.set_library_mode(self.library_mode.get())
+
+    def track_label(self, pos):
+        return self.engine.tracks.name(self.filtered_indices[pos])
+
+    def filtered_position(self, index):
+        # filtered_indices is always kept in ascending order.
+        pos = bisect.bisect_left(self.filtered_indices, index)
+        if pos < len(self.filtered_indices) and self.filtered_indices[pos] == index:
+            return pos
+        return None
 
     def select_folder(self):
         folder = filedialog.askdirectory()
         if not folder:
             return
-        self.Last_folder = folder
-        self.load_folder(folder)
+        self.engine.load_folder(folder)
 
-    def play_file(self, index):
-        if not self.files or index >= len(self.files):
+    def load_playlist(self):
+        path = filedialog.askopenfilename(filetypes=PLAYLIST_FILETYPES)
+        if not path:
             return
+        self.engine.load_playlist(path)
 
-        file_path, length = self.files[index]
+    def save_playlist(self, indexes):
+        if not indexes:
+            self.engine.message("Nothing to save", 2)
+            return
+        path = filedialog.asksaveasfilename(defaultextension=".m3u8", filetypes=PLAYLIST_FILETYPES)
+        if not path:
+            return
         try:
-            pygame.mixer.music.load(file_path)
-            pygame.mixer.music.play()
-
-            self.current_index = index
-            self.song_length = length
-            self.playing = True
-            self.paused = False
-            self.paused_time_accum = 0
-            self.start_time = time.time()
-
-            self.listbox.select_clear(0, tk.END)
-            if index in self.filtered_indices:
-                filtered_idx = self.filtered_indices.index(index)
-                self.listbox.select_set(filtered_idx)
-
-            self.current_song_tooltip = f"Now playing: {os.path.splitext(os.path.basename(file_path))[0].replace("_", " ")}"
-            self.update_top_message(self.current_song_tooltip, permanent=True)
+            count = self.engine.export_playlist(path, indexes)
+        except OSError as e:
+            self.engine.message(f"Could not save playlist: {e}", 5)
+            return
+        self.engine.message(f"Saved {count} track(s) to {os.path.basename(path)}", 3)
 
-        except Exception as e:
-            self.show_tooltip(f"Playback error: {e}", permanent=True)
+    def track_started(self, index):
+        self.listbox.select_clear(0, tk.END)
+        filtered_idx = self.filtered_position(index)
+        if filtered_idx is not None:
+            self.listbox.select_set(filtered_idx)
+
+        self.current_song_tooltip = f"Now playing: {self.engine.tracks.name(index)}"
+        self.update_top_message(self.current_song_tooltip, permanent=True)
+        self.show_waveform(index)
+
+    def show_waveform(self, index):
+        self.seek_bar.set_track(self.engine.tracks.length(index))
+        if self.waveforms is None:
+            from waveform import WaveformCache
+            config = self.engine.config
+            self.waveforms = WaveformCache(
+                self.dispatcher.post,
+                config.get("Settings", "waveform_cache", fallback="player_waveforms"),
+                max_bytes=config.getint("Settings", "waveform_cache_mb", fallback=200) * 1024 * 1024)
+        self.waveforms.request(self.engine.tracks.path(index), self.seek_bar.set_peaks)
+
+    def toggle_gapless(self):
+        self.engine.set_gapless(self.gapless.get())
+
+    def set_crossfade(self, _=None):
+        self.engine.set_crossfade(self.crossfade.get())
+
+    def set_normalization(self, mode):
+        self.engine.set_normalization(mode)
+
+    def set_shuffle(self, mode):
+        self.engine.set_shuffle(mode)
+
+    def update_shuffle_scope(self):
+        # Shuffle follows the search filter; no query means the whole library.
+        self.engine.set_shuffle_scope(self.filtered_indices if self.search_var.get() else None)
 
     def play_selected(self):
         sel = self.listbox.curselection()
@@ -326,45 +544,40 @@ class TooltipMP3Player:
             return
         filtered_idx = sel[0]
         actual_idx = self.filtered_indices[filtered_idx]
-        self.play_file(actual_idx)
-
-    def pause_resume(self):
-        if not self.playing:
-            return
-        if not self.paused:
-            pygame.mixer.music.pause()
-            self.paused = True
-            self.pause_start = time.time()
-            self.update_top_message("Paused", permanent=True)
-        else:
-            pygame.mixer.music.unpause()
-            self.paused = False
-            self.paused_time_accum += time.time() - self.pause_start
-            self.update_top_message(f"Now playing: {os.path.splitext(os.path.basename(self.files[self.current_index][0]))[0].replace("_", " ")}", permanent=True)
-
-    def stop(self):
-        pygame.mixer.music.stop()
-        self.playing = False
-        self.paused = False
-        self.position.set(0)
-        self.time_label.config(text="00:00 / 00:00")
-        self.update_top_message("Double-click a song to play", permanent=False)
-        self.show_tooltip("Select a song to play")
-
-    def refresh_queue_display(self):
-        self.queue_listbox.delete(0, tk.END)
-        for i in self.queue:
-            try:
-                name = os.path.basename(self.files[i][0])
-                self.queue_listbox.insert(tk.END, name)
-            except:
-                self.queue_listbox.insert(tk.END, "<Invalid>")
+        self.engine.play_file(actual_idx)
 
     def clear_queue(self):
         self.queue.clear()
-        self.refresh_queue_display()
         self.show_tooltip("Queue cleared", 2)
 
+    def queue_all_results(self):
+        if not self.filtered_indices:
+            self.show_tooltip("Nothing to queue", 2)
+            return
+        self.queue.extend(self.filtered_indices)
+        self.show_tooltip(f"Queued {len(self.filtered_indices)} track(s)", 2)
+
+    def queue_folder(self):
+        sel = self.listbox.curselection()
+        if not sel:
+            self.show_tooltip("No song selected", 2)
+            return
+        folder = self.engine.tracks.folder(self.filtered_indices[sel[0]])
+        tracks = self.engine.tracks.in_folder(folder)
+        self.queue.extend(tracks)
+        self.show_tooltip(f"Queued {len(tracks)} track(s) from {os.path.basename(folder) or folder}", 2)
+
+    def sort_queue(self):
+        if not self.queue:
+            self.show_tooltip("Queue is empty", 2)
+            return
+        self.engine.sort_queue()
+        self.show_tooltip("Queue sorted by artist, album and track", 2)
+
+    def dedupe_queue(self):
+        removed = self.queue.dedupe()
+        self.show_tooltip(f"Removed {removed} duplicate(s)" if removed else "No duplicates in queue", 2)
+
     def show_context_menu(self, event):
         widget = event.widget
         try:
@@ -386,8 +599,7 @@ class TooltipMP3Player:
         sel = self.listbox.curselection()
         if sel:
             actual_idx = self.filtered_indices[sel[0]]
-            self.queue.append(actual_idx)
-            self.refresh_queue_display()
+            self.engine.enqueue(actual_idx)
             self.show_tooltip("Added to queue", 2)
         else:
             self.show_tooltip("No song selected", 2)
@@ -396,8 +608,7 @@ class TooltipMP3Player:
         sel = self.listbox.curselection()
         if sel:
             actual_idx = self.filtered_indices[sel[0]]
-            self.queue.insert(0, actual_idx)
-            self.refresh_queue_display()
+            self.engine.enqueue(actual_idx, front=True)
             self.show_tooltip("Added to front of queue (next)", 2)
         else:
             self.show_tooltip("No song selected", 2)
@@ -475,9 +686,7 @@ class TooltipMP3Player:
         orig = self.dragging_item
         dest = target
         if orig != dest and 0 <= orig < len(self.queue) and 0 <= dest < len(self.queue):
-            item = self.queue.pop(orig)
-            self.queue.insert(dest, item)
-            self.refresh_queue_display()
+            self.queue.move(orig, dest)
             self.queue_listbox.selection_clear(0, tk.END)
             self.queue_listbox.selection_set(dest)
             self.show_tooltip("Item moved", 1)
@@ -488,66 +697,18 @@ class TooltipMP3Player:
         self.dragging_item = None
         self.drag_current_target = None
 
-    def next_track(self):
-        if self.queue:
-            next_index = self.queue.pop(0)
-            self.refresh_queue_display()
-        elif self.current_index is not None:
-            next_index = (self.current_index + 1) % len(self.files)
-        else:
-            return
-        self.play_file(next_index)
-
-    def previous_track(self):
-        if self.current_index is None:
-            return
-        prev_index = (self.current_index - 1) % len(self.files)
-        self.play_file(prev_index)
-
     def set_volume(self, _=None):
-        pygame.mixer.music.set_volume(self.volume.get())
-        self.save_config()
-
-    def seek(self, val):
-        if not self.playing or self.song_length <= 0:
-            return
-        pos = (float(val) / 100) * self.song_length
-        self.play_file_at_position(pos)
-
-    def play_file_at_position(self, pos):
-        file_path, _ = self.files[self.current_index]
-        pygame.mixer.music.stop()
-        pygame.mixer.music.load(file_path)
-        pygame.mixer.music.play()
-        try:
-            pygame.mixer.music.set_pos(pos)
-        except Exception:
-            pass
-        self.start_time = time.time() - pos
-        self.paused_time_accum = 0
-        self.paused = False
-        self.playing = True
-
-    def update_slider_loop(self):
-        while True:
-            if self.playing and not self.paused:
-                current = time.time() - self.start_time - self.paused_time_accum
-                if current >= self.song_length:
-                    self.next_track()
-                if self.song_length > 0:
-                    self.position.set((current / self.song_length) * 100)
-                    self.update_time_label(current)
-            time.sleep(0.2)
+        self.engine.set_volume(self.volume.get())
 
     def on_double_click(self, event):
         sel = self.listbox.curselection()
         if sel:
             filtered_idx = sel[0]
             actual_idx = self.filtered_indices[filtered_idx]
-            self.play_file(actual_idx)
+            self.engine.play_file(actual_idx)
 
     def update_time_label(self, current):
-        total = self.song_length
+        total = self.engine.song_length
         self.time_label.config(
             text=f"{self.format_time(current)} / {self.format_time(total)}"
         )
@@ -561,50 +722,92 @@ class TooltipMP3Player:
 
     def show_tooltip(self, text, duration=2, permanent=False):
         self.status_label.config(text=text)
+        # A new message always replaces the pending reset of the last one.
+        self.dispatcher.cancel("status")
         if permanent:
             return
         if duration:
-            def clear():
-                time.sleep(duration)
-                try:
-                    self.status_label.after(0, lambda: self.status_label.config(
-                        text="Ctrl + Alt + Left/Right/Up (arrow) for hotkeys"))
-                except:
-                    pass
-            threading.Thread(target=clear, daemon=True).start()
+            self.dispatcher.call_later("status", duration, lambda: self.status_label.config(
+                text="Ctrl + Alt + Left/Right/Up (arrow) for hotkeys"))
 
     def update_top_message(self, text, permanent=False, duration=2):
         self.tooltip_label.config(text=text)
+        self.dispatcher.cancel("top_message")
         if permanent:
             return
         if duration:
-            def clear():
-                time.sleep(duration)
-                try:
-                    self.tooltip_label.after(0, lambda: self.tooltip_label.config(
-                        text="Double-click a song to play"))
-                except:
-                    pass
-            threading.Thread(target=clear, daemon=True).start()
+            self.dispatcher.call_later("top_message", duration, lambda: self.tooltip_label.config(
+                text="Double-click a song to play"))
 
     def update_search(self, *args):
-        query = self.search_var.get().lower()
-        self.listbox.delete(0, tk.END)
-        self.filtered_indices = []
-        for idx, (file_path, length) in enumerate(self.files):
-            filename = os.path.splitext(os.path.basename(file_path))[0].replace("_", " ")
-            if query in filename.lower():
-                self.listbox.insert(tk.END, filename)
-                self.filtered_indices.append(idx)
-
+        if self.search_after_id:
+            self.root.after_cancel(self.search_after_id)
+        self.search_after_id = self.root.after(self.SEARCH_DEBOUNCE_MS, self.apply_search)
+
+    def apply_search(self):
+        self.search_after_id = None
+        self.filtered_indices = self.engine.search_index.search(self.search_var.get())
+        self.listbox.set_count(len(self.filtered_indices), reset=True)
+        self.update_shuffle_scope()
+
+
+def run_headless(control_socket):
+    # No window: the engine runs on a plain event loop and is driven
+    # entirely through the control socket.
+    os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+    loop = EventLoop()
+    engine = PlayerEngine(loop)
+    engine.subscribe(lambda event, *args: event == "message" and print(args[0]))
+    server = ControlServer(control_socket, loop.post, lambda line: execute(engine, line))
+    server.start()
+    signal.signal(signal.SIGTERM, lambda signum, frame: loop.stop())
+    print(f"Listening on {control_socket}")
+    loop.post(engine.start)
+    try:
+        loop.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.stop()
+        engine.close()
+        if instrument.enabled:
+            instrument.dump()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Minimalist audio player")
+    parser.add_argument("--headless", action="store_true",
+                        help="run without a window, controlled through the socket")
+    parser.add_argument("--socket", default=None,
+                        help=f"control socket path (headless default: {CONTROL_SOCKET})")
+    parser.add_argument("--send", metavar="COMMAND",
+                        help="send a command to a running player and print the reply")
+    parser.add_argument("--profile", action="store_true",
+                        help="time playback, scanning, search and hotkeys; print a summary on exit")
+    parser.add_argument("--trace", metavar="FILE",
+                        help="with --profile, also write a Chrome trace (chrome://tracing) to FILE")
+    args = parser.parse_args()
+    if args.profile or args.trace:
+        instrument.enable(os.path.abspath(args.trace) if args.trace else None)
+
+    if args.send:
+        try:
+            print(json.dumps(send_command(args.socket or CONTROL_SOCKET, args.send)))
+        except OSError as e:
+            sys.exit(f"No player listening on {args.socket or CONTROL_SOCKET}: {e}")
+        return
+    if args.headless:
+        run_headless(args.socket or CONTROL_SOCKET)
+        return
 
-if __name__ == "__main__":
     root = tk.Tk()
     try:
         root.iconbitmap("resources/music.ico")
     except Exception:
         pass
-    app = TooltipMP3Player(root)
+    app = TooltipMP3Player(root, control_socket=args.socket)
     root.mainloop()
 
 
+if __name__ == "__main__":
+    main()
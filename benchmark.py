@@ -0,0 +1,575 @@
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import struct
+import sys
+import tempfile
+import time
+
+# Benchmarks never touch the sound card or open a window.
+os.environ["SDL_AUDIODRIVER"] = "dummy"
+os.environ["SDL_VIDEODRIVER"] = "dummy"
+
+import pygame
+
+from dispatcher import EventLoop
+from engine import PlayerEngine
+from track_queue import TrackQueue, QueueListboxView
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+WORDS = ("midnight", "river", "echo", "neon", "summer", "ghost", "velvet", "static",
+         "golden", "paper", "ocean", "signal", "hollow", "crystal", "fever", "orbit",
+         "silver", "thunder", "garden", "motion", "shadow", "highway", "lantern", "winter")
+
+
+# --- Synthetic library ------------------------------------------------------
+#
+# Every file is real, decodable silence, just cheap to produce and small on
+# disk, so the probes, the seek indexes and the mixer all do their normal
+# work on it.
+
+def _crc_table(poly, width):
+    top = 1 << (width - 1)
+    mask = (1 << width) - 1
+    table = []
+    for i in range(256):
+        crc = i << (width - 8)
+        for _ in range(8):
+            crc = ((crc << 1) ^ poly) & mask if crc & top else (crc << 1) & mask
+        table.append(crc)
+    return table
+
+
+CRC8 = _crc_table(0x07, 8)
+CRC16 = _crc_table(0x8005, 16)
+OGG_CRC = _crc_table(0x04C11DB7, 32)
+
+
+def _crc(table, width, data):
+    crc = 0
+    shift = width - 8
+    mask = (1 << width) - 1
+    for b in data:
+        crc = ((crc << 8) & mask) ^ table[((crc >> shift) & 0xFF) ^ b]
+    return crc
+
+
+def _syncsafe(n):
+    return bytes(((n >> 21) & 0x7F, (n >> 14) & 0x7F, (n >> 7) & 0x7F, n & 0x7F))
+
+
+def _id3(tags):
+    frames = b""
+    for frame_id, key in (("TIT2", "title"), ("TPE1", "artist"), ("TALB", "album"), ("TRCK", "tracknumber")):
+        data = b"\x03" + tags[key].encode()
+        frames += frame_id.encode() + _syncsafe(len(data)) + b"\x00\x00" + data
+    return b"ID3\x04\x00\x00" + _syncsafe(len(frames)) + frames
+
+
+def _vorbis_comments(tags):
+    vendor = b"benchmark"
+    fields = [f"{key.upper()}={value}".encode() for key, value in tags.items()]
+    out = struct.pack("<I", len(vendor)) + vendor + struct.pack("<I", len(fields))
+    for field in fields:
+        out += struct.pack("<I", len(field)) + field
+    return out
+
+
+def write_wav(path, seconds, tags, rate=22050):
+    # 16-bit mono; the sample data is a sparse hole, which reads as zeros.
+    size = int(seconds * rate) * 2
+    header = struct.pack("<4sI4s4sIHHIIHH4sI", b"RIFF", 36 + size, b"WAVE", b"fmt ", 16,
+                         1, 1, rate, rate * 2, 2, 16, b"data", size)
+    with open(path, "wb") as f:
+        f.write(header)
+        f.truncate(len(header) + size)
+
+
+def write_mp3(path, seconds, tags):
+    # MPEG-2 layer III, 8 kbps, 16 kHz mono: 36-byte frames of 576 samples
+    # with all-zero side info, i.e. silence.
+    frame = b"\xff\xf3\x18\xc4" + bytes(32)
+    with open(path, "wb") as f:
+        f.write(_id3(tags))
+        f.write(frame * int(seconds * 16000 / 576))
+
+
+def _utf8_number(n):
+    if n < 0x80:
+        return bytes((n,))
+    if n < 0x800:
+        return bytes((0xC0 | n >> 6, 0x80 | n & 0x3F))
+    if n < 0x10000:
+        return bytes((0xE0 | n >> 12, 0x80 | (n >> 6) & 0x3F, 0x80 | n & 0x3F))
+    return bytes((0xF0 | n >> 18, 0x80 | (n >> 12) & 0x3F, 0x80 | (n >> 6) & 0x3F, 0x80 | n & 0x3F))
+
+
+def write_flac(path, seconds, tags, rate=44100, block=4096):
+    # 16-bit mono frames, each holding a single CONSTANT 0 subframe.
+    total = int(seconds * rate)
+    streaminfo = struct.pack(">HH", block, block) + bytes(6)
+    streaminfo += ((rate << 44) | (15 << 36) | total).to_bytes(8, "big") + bytes(16)
+    comments = _vorbis_comments(tags)
+    out = bytearray(b"fLaC")
+    out += b"\x00" + len(streaminfo).to_bytes(3, "big") + streaminfo
+    out += b"\x84" + len(comments).to_bytes(3, "big") + comments
+    number = 0
+    done = 0
+    while done < total:
+        size = min(block, total - done)
+        header = b"\xff\xf8\x79\x08" + _utf8_number(number) + (size - 1).to_bytes(2, "big")
+        frame = header + bytes((_crc(CRC8, 8, header),)) + b"\x00\x00\x00"
+        out += frame + _crc(CRC16, 16, frame).to_bytes(2, "big")
+        number += 1
+        done += size
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def _ogg_page(serial, sequence, granule, packets, flags=0):
+    lacing = bytearray()
+    for packet in packets:
+        n = len(packet)
+        while n >= 255:
+            lacing.append(255)
+            n -= 255
+        lacing.append(n)
+    page = bytearray(struct.pack("<4sBBqIIIB", b"OggS", 0, flags, granule, serial, sequence, 0, len(lacing)))
+    page += lacing + b"".join(packets)
+    struct.pack_into("<I", page, 22, _crc(OGG_CRC, 32, page))
+    return bytes(page)
+
+
+class _BitWriter:
+    # Vorbis packs fields least significant bit first.
+
+    def __init__(self):
+        self.value = 0
+        self.bits = 0
+
+    def write(self, value, bits):
+        self.value |= value << self.bits
+        self.bits += bits
+
+    def getvalue(self):
+        return self.value.to_bytes((self.bits + 7) // 8, "little")
+
+
+def _vorbis_setup():
+    # The smallest setup that libvorbis accepts: one two-entry codebook,
+    # one floor 1 without posts, one empty residue, one mapping and one
+    # short-block mode. Audio packets then only say "floor unused", which
+    # decodes to silence.
+    b = _BitWriter()
+    b.write(0, 8)
+    b.write(0x564342, 24), b.write(1, 16), b.write(2, 24)
+    b.write(0, 1), b.write(0, 1), b.write(0, 5), b.write(0, 5), b.write(0, 4)
+    b.write(0, 6), b.write(0, 16)
+    b.write(0, 6), b.write(1, 16), b.write(0, 5), b.write(0, 2), b.write(1, 4)
+    b.write(0, 6), b.write(0, 16), b.write(0, 24), b.write(0, 24), b.write(0, 24)
+    b.write(0, 6), b.write(0, 8), b.write(0, 3), b.write(0, 1)
+    b.write(0, 6), b.write(0, 16), b.write(0, 4), b.write(0, 24)
+    b.write(0, 6), b.write(0, 1), b.write(0, 16), b.write(0, 16), b.write(0, 8)
+    b.write(1, 1)
+    return b"\x05vorbis" + b.getvalue()
+
+
+def write_ogg(path, seconds, tags, rate=22050):
+    serial = 1
+    ident = b"\x01vorbis" + struct.pack("<IBIiiiBB", 0, 1, rate, 0, 32000, 0, 0xB8, 1)
+    comment = b"\x03vorbis" + _vorbis_comments(tags) + b"\x01"
+    out = bytearray(_ogg_page(serial, 0, 0, [ident], flags=2))
+    out += _ogg_page(serial, 1, 0, [comment, _vorbis_setup()])
+    # Each 256-sample short block adds 128 samples after the first.
+    packets = int(seconds * rate) // 128 + 1
+    sequence = 2
+    sent = 0
+    while sent < packets:
+        n = min(255, packets - sent)
+        sent += n
+        out += _ogg_page(serial, sequence, (sent - 1) * 128, [b"\x00"] * n,
+                         flags=4 if sent == packets else 0)
+        sequence += 1
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+WRITERS = {
+    "wav": write_wav,
+    "mp3": write_mp3,
+    "flac": write_flac,
+    "ogg": write_ogg,
+}
+
+
+def generate_library(folder, count, formats, min_seconds, max_seconds, seed):
+    # formats may repeat a name to weight the mix, e.g. mp3,mp3,flac.
+    rng = random.Random(seed)
+    os.makedirs(folder, exist_ok=True)
+    paths = []
+    for n in range(count):
+        fmt = rng.choice(formats)
+        artist = " ".join(rng.sample(WORDS, 2)).title()
+        title = " ".join(rng.sample(WORDS, rng.randint(1, 3))).title()
+        tags = {
+            "title": title,
+            "artist": artist,
+            "album": f"{rng.choice(WORDS).title()} Sessions",
+            "tracknumber": str(n % 20 + 1),
+        }
+        path = os.path.join(folder, f"{artist} - {title} {n:06d}.{fmt}")
+        WRITERS[fmt](path, rng.uniform(min_seconds, max_seconds), tags)
+        paths.append(path)
+    return paths
+
+
+# --- Measurements -----------------------------------------------------------
+
+def summarize(samples):
+    # samples in seconds; reported in milliseconds.
+    if not samples:
+        return {"n": 0}
+    ordered = sorted(samples)
+    n = len(ordered)
+    return {
+        "n": n,
+        "mean_ms": sum(ordered) / n * 1000,
+        "p50_ms": ordered[n // 2] * 1000,
+        "p95_ms": ordered[min(n - 1, int(n * 0.95))] * 1000,
+        "max_ms": ordered[-1] * 1000,
+    }
+
+
+def peak_memory():
+    if resource is None:
+        return {}
+    # ru_maxrss is in KiB on Linux and in bytes on macOS.
+    scale = 1024 if sys.platform == "darwin" else 1
+    return {
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // scale,
+        "children_peak_rss_kb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss // scale,
+    }
+
+
+def run_until(loop, engine, event, timeout=600):
+    def listener(name, *args):
+        if name == event:
+            loop.stop()
+
+    engine.subscribe(listener)
+    loop.call_later("benchmark_timeout", timeout, loop.stop)
+    loop.run()
+    loop.cancel("benchmark_timeout")
+    engine.listeners.remove(listener)
+
+
+def bench_scan(loop, engine, folder):
+    results = {}
+    for phase in ("cold", "warm"):
+        start = time.perf_counter()
+        engine.load_folder(folder)
+        run_until(loop, engine, "scan_done")
+        elapsed = time.perf_counter() - start
+        results[phase] = {
+            "tracks": len(engine.tracks),
+            "seconds": elapsed,
+            "tracks_per_s": len(engine.tracks) / elapsed if elapsed else 0.0,
+        }
+    return results
+
+
+def bench_startup(engine):
+    # A second start over the scanned library: the list is shown from the
+    # snapshot, then indexed for search and rescanned in the background.
+    engine.close()
+    start = time.perf_counter()
+    loop = EventLoop()
+    engine = PlayerEngine(loop)
+    restored = engine.restore_snapshot()
+    interactive = time.perf_counter() - start
+    results = {"restored": restored, "tracks": len(engine.tracks), "interactive_ms": interactive * 1000}
+    if restored:
+        run_until(loop, engine, "library_changed")
+        results["indexed_ms"] = (time.perf_counter() - start) * 1000
+        run_until(loop, engine, "scan_done")
+        results["revalidated_ms"] = (time.perf_counter() - start) * 1000
+    budget = engine.config.getint("Settings", "startup_budget_ms", fallback=500)
+    results["within_budget"] = interactive * 1000 <= budget
+    return loop, engine, results
+
+
+def bench_loudness(loop, engine):
+    # Loudness analysis of the whole library on the process pool, then
+    # again with every gain cached.
+    results = {}
+    engine.normalization = "track"
+    for phase in ("cold", "cached"):
+        start = time.perf_counter()
+        engine.analyze_loudness()
+        run_until(loop, engine, "loudness_done")
+        elapsed = time.perf_counter() - start
+        results[phase] = {
+            "seconds": elapsed,
+            "tracks_per_s": len(engine.tracks) / elapsed if elapsed else 0.0,
+        }
+    engine.normalization = "off"
+    return results
+
+
+def bench_effects(engine, blocks=(256, 1024, 2048, 4096)):
+    # Offline renders of the first track through the effects chain with
+    # every stage working, per block size: time per block against the
+    # block's own duration, which is what playback has to keep up with.
+    import dsp
+    results = {}
+    if not engine.tracks:
+        return results
+    eq = [6, 4, 2, 0, -2, -2, 0, 2, 4, 6]
+    for block in blocks:
+        timer = dsp.render(engine.tracks.path(0), "effects.wav", eq=eq, balance=0.2, block=block)
+        results[str(block)] = timer.stats()
+    return results
+
+
+def bench_search(engine, queries, rng):
+    # Types each query one character at a time, as update_search sees it
+    # (minus the debounce), and times every keystroke.
+    index = engine.search_index
+    keystrokes = []
+    first = []
+    hits = []
+    for _ in range(queries):
+        words = engine.tracks.name(rng.randrange(len(engine.tracks))).split()
+        start = rng.randrange(len(words))
+        query = " ".join(words[start:start + 2]).lower()
+        index.search("")
+        for n in range(1, len(query) + 1):
+            t = time.perf_counter()
+            results = index.search(query[:n])
+            elapsed = time.perf_counter() - t
+            keystrokes.append(elapsed)
+            if n == 1:
+                first.append(elapsed)
+        hits.append(len(results))
+    index.search("")
+    return {
+        "queries": queries,
+        "keystroke": summarize(keystrokes),
+        "first_keystroke": summarize(first),
+        "mean_hits": sum(hits) / len(hits) if hits else 0,
+    }
+
+
+class MemoryListbox:
+    # Just enough of tk.Listbox for QueueListboxView.
+
+    def __init__(self):
+        self.items = []
+
+    def _index(self, pos):
+        return len(self.items) if pos == "end" else pos
+
+    def insert(self, pos, *items):
+        pos = self._index(pos)
+        self.items[pos:pos] = items
+
+    def delete(self, first, last=None):
+        first = self._index(first)
+        last = first if last is None else self._index(last)
+        del self.items[first:last + 1]
+
+    def get(self, pos):
+        return self.items[pos]
+
+
+def bench_queue(engine, ops, rng):
+    # Queue edits as the GUI makes them, including the view update.
+    queue = TrackQueue()
+    view = QueueListboxView(MemoryListbox(), queue, engine.tracks.name)
+    count = len(engine.tracks)
+    results = {}
+
+    def timed(name, func, repeat=1):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            func()
+        elapsed = time.perf_counter() - start
+        results[name] = {"ops": repeat, "total_ms": elapsed * 1000, "per_op_us": elapsed / repeat * 1e6}
+
+    timed("extend_library", lambda: queue.extend(range(count)))
+    timed("append", lambda: queue.append(rng.randrange(count)), ops)
+    timed("insert_front", lambda: queue.insert(0, rng.randrange(count)), ops)
+    timed("move", lambda: queue.move(rng.randrange(len(queue)), rng.randrange(len(queue))), ops)
+    timed("remove_at", lambda: queue.remove_at(rng.randrange(len(queue))), ops)
+    timed("popleft", queue.popleft, ops)
+    timed("dedupe", queue.dedupe)
+    timed("sort_album", lambda: queue.replace(engine.tracks.sorted(queue, ("artist", "album", "tracknumber", "name"))))
+    timed("clear", queue.clear)
+    assert len(view.listbox.items) == len(queue)
+    return results
+
+
+def play_and_wait(loop, engine, index, timeout=30):
+    # play_file() returns before a track that is still being read starts.
+    started = []
+
+    def listener(name, *args):
+        if name == "track" or (name == "message" and "error" in args[0].lower()):
+            started.append(name)
+            loop.stop()
+
+    engine.subscribe(listener)
+    engine.play_file(index)
+    if not started:
+        loop.call_later("benchmark_timeout", timeout, loop.stop)
+        loop.run()
+        loop.cancel("benchmark_timeout")
+    engine.listeners.remove(listener)
+
+
+def bench_playback(loop, engine, per_format, seeks, rng, throttle=0.0):
+    # Track switches (until the track has started) and seeks, per format.
+    # throttle: seconds of simulated latency per read-ahead chunk, as on a
+    # slow network share.
+    errors = []
+    engine.buffers.read_delay = throttle
+
+    def listener(name, *args):
+        if name == "message" and "error" in args[0].lower():
+            errors.append(args[0])
+
+    engine.subscribe(listener)
+    by_format = {}
+    tracks = engine.tracks
+    for index, ext_id in enumerate(tracks.ext_of):
+        by_format.setdefault(tracks.exts[ext_id].lower().lstrip("."), []).append(index)
+    results = {}
+    for fmt, indices in sorted(by_format.items()):
+        switches = []
+        seek_times = []
+        for index in rng.sample(indices, min(per_format, len(indices))):
+            start = time.perf_counter()
+            play_and_wait(loop, engine, index)
+            switches.append(time.perf_counter() - start)
+            for _ in range(seeks):
+                position = rng.uniform(0, engine.song_length)
+                start = time.perf_counter()
+                engine.seek(position)
+                seek_times.append(time.perf_counter() - start)
+        results[fmt] = {"switch": summarize(switches), "seek": summarize(seek_times)}
+    engine.stop()
+    engine.listeners.remove(listener)
+    engine.buffers.read_delay = 0.0
+    results["buffers"] = engine.buffers.stats()
+    results["errors"] = errors[:20]
+    return results
+
+
+def compare(baseline, results, prefix=""):
+    # Prints every numeric result next to the baseline value.
+    for key, value in results.items():
+        name = f"{prefix}{key}"
+        old = baseline.get(key) if isinstance(baseline, dict) else None
+        if isinstance(value, dict):
+            compare(old or {}, value, name + ".")
+        elif isinstance(value, (int, float)) and isinstance(old, (int, float)) and not isinstance(value, bool):
+            change = f"{(value - old) / old * 100:+.1f}%" if old else "n/a"
+            print(f"{name:55} {old:14.3f} {value:14.3f} {change:>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the player engine on a synthetic library")
+    parser.add_argument("--tracks", type=int, default=1000, help="number of tracks to generate")
+    parser.add_argument("--formats", default="wav,ogg,flac,mp3",
+                        help="comma-separated mix; repeat a format to weight it")
+    parser.add_argument("--min-seconds", type=float, default=30.0)
+    parser.add_argument("--max-seconds", type=float, default=300.0)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--library", help="benchmark an existing folder instead of generating one")
+    parser.add_argument("--keep", action="store_true", help="keep the generated library and work dir")
+    parser.add_argument("--queries", type=int, default=50, help="search queries to type")
+    parser.add_argument("--queue-ops", type=int, default=2000, help="operations per queue edit kind")
+    parser.add_argument("--switches", type=int, default=10, help="track switches per format")
+    parser.add_argument("--seeks", type=int, default=3, help="seeks per switched track")
+    parser.add_argument("--throttle", type=float, default=0.0, metavar="MS",
+                        help="simulated latency per 256 KB read during playback, as on a slow share")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--compare", metavar="BASELINE", help="print changes against an earlier results file")
+    args = parser.parse_args()
+
+    output = os.path.abspath(args.output)
+    baseline = os.path.abspath(args.compare) if args.compare else None
+    work = tempfile.mkdtemp(prefix="player-bench-")
+    formats = [f.strip().lower() for f in args.formats.split(",") if f.strip()]
+    unknown = set(formats) - set(WRITERS)
+    if unknown:
+        parser.error(f"unknown format(s): {', '.join(sorted(unknown))}")
+
+    results = {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "pygame": pygame.version.ver,
+            "sdl_mixer": ".".join(map(str, pygame.mixer.get_sdl_mixer_version())),
+            "args": vars(args),
+        },
+    }
+    folder = os.path.abspath(args.library) if args.library else os.path.join(work, "library")
+    os.chdir(work)
+    try:
+        if not args.library:
+            start = time.perf_counter()
+            generate_library(folder, args.tracks, formats, args.min_seconds, args.max_seconds, args.seed)
+            results["meta"]["generate_seconds"] = time.perf_counter() - start
+            print(f"Generated {args.tracks} tracks in {results['meta']['generate_seconds']:.1f}s")
+
+        rng = random.Random(args.seed)
+        loop = EventLoop()
+        engine = PlayerEngine(loop)
+        # Loudness analysis would otherwise start after every scan and
+        # compete with the phases below; it is measured on its own.
+        engine.normalization = "off"
+        memory = {}
+        results["scan"] = bench_scan(loop, engine, folder)
+        memory["after_scan"] = peak_memory()
+        loop, engine, results["startup"] = bench_startup(engine)
+        if engine.tracks:
+            results["search"] = bench_search(engine, args.queries, rng)
+            results["queue"] = bench_queue(engine, args.queue_ops, rng)
+            memory["after_queue"] = peak_memory()
+            results["playback"] = bench_playback(loop, engine, args.switches, args.seeks, rng,
+                                                 throttle=args.throttle / 1000)
+            results["loudness"] = bench_loudness(loop, engine)
+            results["effects"] = bench_effects(engine)
+        memory["final"] = peak_memory()
+        results["memory"] = memory
+        engine.close()
+        pygame.mixer.quit()
+    finally:
+        if not args.keep:
+            os.chdir(os.path.dirname(work))
+            shutil.rmtree(work, ignore_errors=True)
+
+    with open(output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"Results written to {output}")
+    if baseline:
+        with open(baseline) as f:
+            old = json.load(f)
+        for section, values in results.items():
+            if section != "meta" and isinstance(values, dict):
+                compare(old.get(section, {}), values, section + ".")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,319 @@
+import json
+import os
+import queue
+import socket
+import stat
+import threading
+
+import instrument
+
+# Control protocol: one command per line, answered by one JSON object per
+# line ({"ok": true, ...} or {"ok": false, "error": "..."}). Tracks are
+# given as a library index or a full path; the player does not share the
+# client's working directory, so every path must be absolute
+# (send_command() makes them so).
+#
+#   play [track]      play a track, or resume / start from the top
+#   pause | resume | toggle | stop | next | prev
+#   enqueue <track>   append to the queue ("enqueue next <track>" = play next)
+#   seek <seconds>    absolute, or relative with a leading + / -
+#   volume [0..1]     set or report the volume
+#   normalize [mode]  set or report loudness normalization (off/track/album)
+#   shuffle [mode]    set or report shuffle (off/shuffle/smart)
+#   effects [on|off]  route playback through the effects below, or report
+#   eq [gains]        10 band gains in dB, comma-separated, or "flat"
+#   balance [-1..1]   set or report the channel balance
+#   limiter [on|off]  set or report the brickwall limiter
+#   load <folder>     load a folder into the library
+#   playlist load|save <file>
+#                     queue an M3U/M3U8/PLS playlist, or write the queue to one
+#   clear             clear the queue
+#   status            state, current track, position, volume, queue length
+#   stats             decoded-buffer cache hits and misses, effects block
+#                     timings, plus timers and counters when started with
+#                     --profile
+
+
+def absolute_path(arg):
+    if not os.path.isabs(arg):
+        raise ValueError(f"path must be absolute: {arg}")
+    return os.path.normpath(arg)
+
+
+def resolve_track(engine, arg):
+    if not arg:
+        raise ValueError("missing track")
+    if arg.isdigit():
+        index = int(arg)
+        if index >= len(engine.tracks):
+            raise ValueError(f"no track {index}")
+        return index
+    index = engine.tracks.find(absolute_path(arg))
+    if index is None:
+        raise ValueError(f"not in library: {arg}")
+    return index
+
+
+def cmd_play(engine, arg):
+    if arg:
+        engine.play_file(resolve_track(engine, arg))
+    elif engine.paused:
+        engine.resume()
+    elif not engine.playing:
+        if not engine.tracks:
+            raise ValueError("library is empty")
+        engine.play_file(engine.current_index or 0)
+
+
+def cmd_enqueue(engine, arg):
+    front = False
+    if arg.startswith("next "):
+        front = True
+        arg = arg[5:].strip()
+    engine.enqueue(resolve_track(engine, arg), front=front)
+    return {"queue": len(engine.queue)}
+
+
+def cmd_seek(engine, arg):
+    if not engine.playing:
+        raise ValueError("nothing is playing")
+    offset = float(arg)
+    if arg[:1] in "+-":
+        offset += engine.position()
+    engine.seek(offset)
+
+
+def cmd_volume(engine, arg):
+    if arg:
+        engine.set_volume(float(arg))
+    return {"volume": engine.volume}
+
+
+def cmd_normalize(engine, arg):
+    if arg:
+        engine.set_normalization(arg.lower())
+    return {"normalization": engine.normalization}
+
+
+def cmd_shuffle(engine, arg):
+    if arg:
+        engine.set_shuffle(arg.lower())
+    return {"shuffle": engine.shuffle_mode}
+
+
+def parse_switch(arg):
+    value = arg.lower()
+    if value not in ("on", "off"):
+        raise ValueError(f"expected on or off, not {arg}")
+    return value == "on"
+
+
+def cmd_effects(engine, arg):
+    if arg:
+        engine.set_effects(parse_switch(arg))
+    return {"effects": engine.effects_enabled}
+
+
+def cmd_eq(engine, arg):
+    if arg:
+        import dsp
+        engine.set_eq(dsp.parse_eq(arg))
+    return {"eq": engine.eq}
+
+
+def cmd_balance(engine, arg):
+    if arg:
+        engine.set_balance(float(arg))
+    return {"balance": engine.balance}
+
+
+def cmd_limiter(engine, arg):
+    if arg:
+        engine.set_limiter(parse_switch(arg))
+    return {"limiter": engine.limiter}
+
+
+def cmd_load(engine, arg):
+    folder = absolute_path(arg)
+    if not os.path.isdir(folder):
+        raise ValueError(f"not a folder: {arg}")
+    engine.load_folder(folder)
+
+
+def cmd_playlist(engine, arg):
+    action, _, path = arg.partition(" ")
+    if not path.strip():
+        raise ValueError("missing playlist file")
+    path = absolute_path(path.strip())
+    if action == "load":
+        if not os.path.isfile(path):
+            raise ValueError(f"not a file: {path}")
+        engine.load_playlist(path)
+    elif action == "save":
+        try:
+            count = engine.export_playlist(path, list(engine.queue))
+        except OSError as e:
+            raise ValueError(f"could not write {path}: {e}")
+        return {"written": count}
+    else:
+        raise ValueError(f"expected load or save, not {action}")
+
+
+COMMANDS = {
+    "play": cmd_play,
+    "pause": lambda engine, arg: engine.pause(),
+    "resume": lambda engine, arg: engine.resume(),
+    "toggle": lambda engine, arg: engine.pause_resume(),
+    "stop": lambda engine, arg: engine.stop(),
+    "next": lambda engine, arg: engine.next_track(),
+    "prev": lambda engine, arg: engine.previous_track(),
+    "enqueue": cmd_enqueue,
+    "seek": cmd_seek,
+    "volume": cmd_volume,
+    "normalize": cmd_normalize,
+    "shuffle": cmd_shuffle,
+    "effects": cmd_effects,
+    "eq": cmd_eq,
+    "balance": cmd_balance,
+    "limiter": cmd_limiter,
+    "load": cmd_load,
+    "playlist": cmd_playlist,
+    "clear": lambda engine, arg: engine.queue.clear(),
+    "status": lambda engine, arg: engine.status(),
+    "stats": lambda engine, arg: {"enabled": instrument.enabled, "buffers": engine.buffers.stats(),
+                                  "effects": engine.effects.stats() if engine.effects else None,
+                                  **instrument.snapshot()},
+}
+
+
+def execute(engine, line):
+    # Runs on the engine's loop thread.
+    name, _, arg = line.strip().partition(" ")
+    command = COMMANDS.get(name.lower())
+    if command is None:
+        return {"ok": False, "error": f"unknown command: {name}"}
+    try:
+        result = command(engine, arg.strip())
+    except ValueError as e:
+        return {"ok": False, "error": str(e)}
+    reply = {"ok": True}
+    if result:
+        reply.update(result)
+    return reply
+
+
+class ControlServer:
+    # Serves the control protocol on a UNIX socket. Each connection is read
+    # on its own thread, but commands are handed to the engine's loop with
+    # post() and the reply is waited for, so clients never run engine code
+    # themselves.
+
+    def __init__(self, path, post, handler, reply_timeout=5.0):
+        self.path = path
+        self.post = post
+        self.handler = handler
+        self.reply_timeout = reply_timeout
+        self.sock = None
+
+    def start(self):
+        self._remove_stale()
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(self.path)
+        os.chmod(self.path, 0o600)
+        sock.listen(8)
+        self.sock = sock
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _remove_stale(self):
+        # A socket file left by a player that is no longer running.
+        try:
+            mode = os.stat(self.path).st_mode
+        except FileNotFoundError:
+            return
+        if not stat.S_ISSOCK(mode):
+            raise OSError(f"{self.path} exists and is not a socket")
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            probe.connect(self.path)
+        except OSError:
+            os.unlink(self.path)
+            return
+        finally:
+            probe.close()
+        raise OSError(f"another player is listening on {self.path}")
+
+    def stop(self):
+        if self.sock is None:
+            return
+        self.sock.close()
+        self.sock = None
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def _accept(self):
+        sock = self.sock
+        while True:
+            try:
+                conn, _ = sock.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._serve, args=(conn,), daemon=True).start()
+
+    def _serve(self, conn):
+        with conn, conn.makefile("rb") as lines:
+            for line in lines:
+                line = line.decode("utf-8", "replace").strip()
+                if not line:
+                    continue
+                # A fresh queue per command, so a reply that arrives after
+                # the timeout is never taken for the next one.
+                replies = queue.SimpleQueue()
+                start = instrument.now() if instrument.enabled else None
+                self.post(self._execute, line, replies)
+                try:
+                    reply = replies.get(timeout=self.reply_timeout)
+                except queue.Empty:
+                    reply = {"ok": False, "error": "player did not respond"}
+                if start is not None:
+                    name = line.split(" ", 1)[0].lower()
+                    instrument.record("control." + (name if name in COMMANDS else "unknown"), start)
+                try:
+                    conn.sendall(json.dumps(reply).encode() + b"\n")
+                except OSError:
+                    return
+
+    def _execute(self, line, replies):
+        try:
+            reply = self.handler(line)
+        except Exception as e:
+            reply = {"ok": False, "error": str(e)}
+        replies.put(reply)
+
+
+def absolutize(line):
+    # Path arguments are relative to the client's working directory.
+    name, _, arg = line.strip().partition(" ")
+    arg = arg.strip()
+    prefix = ""
+    if name.lower() == "enqueue" and arg.startswith("next "):
+        prefix, arg = "next ", arg[5:].strip()
+    elif name.lower() == "playlist":
+        action, _, rest = arg.partition(" ")
+        prefix, arg = action + " ", rest.strip()
+    elif name.lower() not in ("play", "enqueue", "load"):
+        return line
+    if not arg or arg.isdigit():
+        return line
+    return f"{name} {prefix}{os.path.abspath(os.path.expanduser(arg))}"
+
+
+def send_command(path, line, timeout=5.0):
+    line = absolutize(line)
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(line.strip().encode() + b"\n")
+        with sock.makefile("rb") as replies:
+            return json.loads(replies.readline())
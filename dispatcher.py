@@ -0,0 +1,220 @@
+import heapq
+import itertools
+import os
+import queue
+import threading
+import time
+import tkinter
+import traceback
+
+
+class TaskQueue:
+    # Work posted from any thread plus keyed timers, both run on a single
+    # owner thread. call_later() with a key that is already scheduled
+    # replaces it, so a burst of status messages leaves one pending reset
+    # instead of one sleeping thread each.
+
+    def __init__(self):
+        self.inbox = queue.SimpleQueue()
+        self.timers = []
+        self.timer_keys = {}
+        self.sequence = itertools.count()
+        self.running = False
+
+    def post(self, func, *args):
+        # Safe to call from any thread.
+        self.inbox.put((func, args))
+
+    def call_later(self, key, delay, func, *args):
+        # Owner thread only. delay in seconds.
+        seq = next(self.sequence)
+        self.timer_keys[key] = seq
+        heapq.heappush(self.timers, (time.monotonic() + delay, seq, key, func, args))
+
+    def cancel(self, key):
+        self.timer_keys.pop(key, None)
+
+    def _run(self, func, args):
+        try:
+            func(*args)
+        except Exception:
+            traceback.print_exc()
+
+    def _run_timers(self):
+        now = time.monotonic()
+        while self.timers and self.timers[0][0] <= now:
+            _, seq, key, func, args = heapq.heappop(self.timers)
+            # Cancelled or replaced timers are dropped lazily here.
+            if self.timer_keys.get(key) == seq:
+                del self.timer_keys[key]
+                self._run(func, args)
+
+    def _next_timeout(self):
+        # Seconds until the next live timer, or None.
+        while self.timers and self.timer_keys.get(self.timers[0][2]) != self.timers[0][1]:
+            heapq.heappop(self.timers)
+        if not self.timers:
+            return None
+        return max(0.0, self.timers[0][0] - time.monotonic())
+
+
+class Dispatcher(TaskQueue):
+    # The only way work gets onto the Tk thread. Background threads
+    # (hotkeys, scanners, pre-buffering, the control socket) post()
+    # callables, and the pump runs them on the Tk thread together with the
+    # due timers.
+    #
+    # Nothing polls: post() wakes the pump through a pipe registered with
+    # createfilehandler, and an after() is only armed while a keyed timer
+    # is pending. An idle player never wakes up.
+    #
+    # Windows Tk has no file handlers, and Tk must not be called from other
+    # threads, so there the pump polls the inbox from the Tk thread instead:
+    # every busy_interval while work keeps arriving, every idle_interval
+    # otherwise.
+
+    def __init__(self, root, max_batch=256, busy_interval=0.01, idle_interval=0.1):
+        super().__init__()
+        self.root = root
+        self.max_batch = max_batch
+        self.busy_interval = busy_interval
+        self.idle_interval = idle_interval
+        self.after_id = None
+        self.after_due = None
+        self.lock = threading.Lock()
+        self.woken = False
+        self.pipe = None
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        try:
+            read_fd, write_fd = os.pipe()
+            os.set_blocking(write_fd, False)
+            self.root.createfilehandler(read_fd, tkinter.READABLE, self._on_pipe)
+            self.pipe = read_fd, write_fd
+        except (AttributeError, OSError, tkinter.TclError):
+            # Windows: no file handlers in Tk; poll instead.
+            self.pipe = None
+        if self.pipe is not None:
+            self._wake()
+        else:
+            self._arm(0)
+
+    def stop(self):
+        self.running = False
+        self._disarm()
+        if self.pipe is not None:
+            read_fd, write_fd = self.pipe
+            self.pipe = None
+            try:
+                self.root.deletefilehandler(read_fd)
+            except Exception:
+                pass
+            os.close(read_fd)
+            os.close(write_fd)
+
+    def post(self, func, *args):
+        # Safe to call from any thread.
+        self.inbox.put((func, args))
+        self._wake()
+
+    def call_later(self, key, delay, func, *args):
+        super().call_later(key, delay, func, *args)
+        if self.running and (self.after_due is None or time.monotonic() + delay < self.after_due):
+            self._arm(delay)
+
+    def _wake(self):
+        # One wake-up at a time; the pump clears woken before it drains
+        # the inbox, so nothing posted after that is missed.
+        # Without a pipe the poll picks the work up.
+        with self.lock:
+            if self.woken or not self.running or self.pipe is None:
+                return
+            self.woken = True
+        try:
+            os.write(self.pipe[1], b"\0")
+        except (OSError, TypeError):
+            # Shutting down. Let the next post() try again.
+            with self.lock:
+                self.woken = False
+
+    def _on_pipe(self, fd, mask):
+        try:
+            os.read(fd, 512)
+        except OSError:
+            pass
+        self._pump()
+
+    def _arm(self, delay):
+        self._disarm()
+        self.after_due = time.monotonic() + delay
+        self.after_id = self.root.after(max(1, int(delay * 1000)), self._on_timer)
+
+    def _disarm(self):
+        if self.after_id is not None:
+            try:
+                self.root.after_cancel(self.after_id)
+            except Exception:
+                pass
+        self.after_id = None
+        self.after_due = None
+
+    def _on_timer(self):
+        self.after_id = None
+        self.after_due = None
+        self._pump()
+
+    def _pump(self):
+        if not self.running:
+            return
+        with self.lock:
+            self.woken = False
+        handled = 0
+        while handled < self.max_batch:
+            try:
+                func, args = self.inbox.get_nowait()
+            except queue.Empty:
+                break
+            self._run(func, args)
+            handled += 1
+
+        self._run_timers()
+
+        if not self.running:
+            return
+        if handled == self.max_batch:
+            # More is waiting; let Tk redraw and handle input first.
+            self._arm(0)
+            return
+        timeout = self._next_timeout()
+        if self.pipe is None:
+            poll = self.busy_interval if handled or not self.inbox.empty() else self.idle_interval
+            timeout = poll if timeout is None else min(timeout, poll)
+        if timeout is None:
+            self._disarm()
+        elif self.after_due is None or abs(time.monotonic() + timeout - self.after_due) > 0.001:
+            self._arm(timeout)
+
+
+class EventLoop(TaskQueue):
+    # Stand-in for the Dispatcher when there is no Tk (headless mode).
+    # run() blocks on the inbox until the next timer is due, so posted
+    # work starts as soon as it arrives instead of at the next poll.
+
+    def run(self):
+        self.running = True
+        while self.running:
+            try:
+                func, args = self.inbox.get(timeout=self._next_timeout())
+            except queue.Empty:
+                pass
+            else:
+                self._run(func, args)
+            self._run_timers()
+
+    def stop(self):
+        # Safe to call from any thread or a signal handler.
+        self.running = False
+        self.post(lambda: None)
@@ -0,0 +1,595 @@
+import argparse
+import math
+import os
+import sys
+import threading
+import time
+import wave
+
+import numpy as np
+
+
+# Effects applied to decoded audio in blocks of frames, (frames, channels)
+# float arrays at full scale 1.0: a 10-band equalizer, channel balance, the
+# volume and a brickwall limiter. EffectsPlayer runs the chain in real
+# time into a pygame Channel; render() runs it offline into a WAV file.
+
+EQ_BANDS = (31, 62, 125, 250, 500, 1000, 2000, 4000, 8000, 16000)
+# One octave per band.
+EQ_Q = 1.41
+EQ_RANGE = 12.0
+# Length of the equalizer's impulse response; the band filters ring for
+# a few thousand samples at most at the bottom of the range.
+EQ_TAPS = 8192
+DEFAULT_BLOCK = 2048
+
+
+def peaking_biquad(rate, freq, gain_db, q=EQ_Q):
+    # RBJ cookbook peaking filter, normalized so a[0] == 1.
+    amp = 10 ** (gain_db / 40)
+    w0 = 2 * math.pi * freq / rate
+    alpha = math.sin(w0) / (2 * q)
+    cos = math.cos(w0)
+    a0 = 1 + alpha / amp
+    b = ((1 + alpha * amp) / a0, -2 * cos / a0, (1 - alpha * amp) / a0)
+    a = (1.0, -2 * cos / a0, (1 - alpha / amp) / a0)
+    return b, a
+
+
+def eq_response(rate, gains, size):
+    # Complex response of the band biquads in cascade at the rfft bins of
+    # a size-sample transform.
+    z = np.exp(-2j * np.pi * np.fft.rfftfreq(size))
+    response = np.ones(len(z), complex)
+    for freq, gain in zip(EQ_BANDS, gains):
+        if not gain or freq >= rate / 2:
+            continue
+        b, a = peaking_biquad(rate, freq, gain)
+        response *= (b[0] + b[1] * z + b[2] * z * z) / (a[0] + a[1] * z + a[2] * z * z)
+    return response
+
+
+def eq_filter(rate, gains, taps=EQ_TAPS):
+    # The cascade's impulse response, taken from a transform four times
+    # as long so that wrap-around is negligible, cut to taps with a short
+    # fade. It is causal and minimum phase like the biquads themselves,
+    # so the equalizer adds no delay.
+    size = taps * 4
+    impulse = np.fft.irfft(eq_response(rate, gains, size), size)[:taps]
+    fade = taps // 8
+    impulse[-fade:] *= np.hanning(2 * fade)[fade:]
+    return impulse
+
+
+def channel_gains(balance, channels):
+    # balance -1 (left only) .. 1 (right only); the louder side stays at
+    # unity.
+    if channels != 2:
+        return np.ones(channels)
+    return np.array([min(1.0, 1.0 - balance), min(1.0, 1.0 + balance)])
+
+
+class Equalizer:
+    # FFT convolution with eq_filter(), overlap-add from block to block.
+    # A flat setting skips the transforms.
+
+    def __init__(self, rate, channels, block, gains=None):
+        self.rate = rate
+        self.size = 1 << (block + EQ_TAPS - 2).bit_length()
+        self.overlap = np.zeros((self.size, channels))
+        self.set_gains(gains or [0.0] * len(EQ_BANDS))
+
+    def set_gains(self, gains):
+        # May be called from another thread than process(); the spectrum
+        # is swapped in one assignment.
+        gains = tuple(max(-EQ_RANGE, min(EQ_RANGE, float(g))) for g in gains)
+        self.gains = gains
+        self.spectrum = (np.fft.rfft(eq_filter(self.rate, gains), self.size)[:, None]
+                         if any(gains) else None)
+
+    def reset(self):
+        self.overlap[:] = 0
+
+    def process(self, samples):
+        spectrum = self.spectrum
+        n = len(samples)
+        overlap = self.overlap
+        if spectrum is None:
+            overlap[:n] += samples
+        else:
+            overlap += np.fft.irfft(np.fft.rfft(samples, self.size, axis=0) * spectrum, self.size, axis=0)
+        out = overlap[:n].copy()
+        overlap[:-n] = overlap[n:]
+        overlap[-n:] = 0
+        return out
+
+
+class Limiter:
+    # Lookahead brickwall limiter, vectorized per block. The gain (in dB)
+    # each sample needs to stay under the ceiling is held at its minimum
+    # over the lookahead window, released at release_db per second
+    # (a running minimum of the held gain against a linear ramp), then
+    # averaged over the window. Every gain in the average around a peak
+    # is at or below what the peak needs, so the output never goes over;
+    # the audio is delayed by the lookahead to line up with its gain.
+
+    def __init__(self, rate, channels, ceiling_db=-1.0, lookahead_ms=1.5, release_db=60.0):
+        self.window = max(2, int(rate * lookahead_ms / 1000))
+        self.latency = self.window - 1
+        self.release = release_db / rate
+        self.channels = channels
+        self.enabled = True
+        self.set_ceiling(ceiling_db)
+        self.reset()
+
+    def set_ceiling(self, ceiling_db):
+        self.ceiling_db = min(0.0, float(ceiling_db))
+        self.ceiling = 10 ** (self.ceiling_db / 20)
+
+    def reset(self):
+        keep = self.latency
+        self.delayed = np.zeros((keep, self.channels))
+        self.needed = np.zeros(keep)
+        self.held = np.zeros(keep)
+        self.last = 0.0
+        # Lowest gain applied since the last stats() call.
+        self.reduction_db = 0.0
+
+    def process(self, samples):
+        n = len(samples)
+        keep = self.latency
+        delayed = np.concatenate((self.delayed, samples))
+        self.delayed = delayed[n:]
+        if not self.enabled:
+            self.needed[:] = 0
+            self.held[:] = 0
+            self.last = 0.0
+            return delayed[:n]
+        peak = np.abs(samples).max(axis=1) if samples.shape[1] else np.zeros(n)
+        needed = np.minimum(0.0, self.ceiling_db - 20 * np.log10(np.maximum(peak, 1e-9)))
+        needed = np.concatenate((self.needed, needed))
+        self.needed = needed[n:]
+        held = np.lib.stride_tricks.sliding_window_view(needed, self.window).min(axis=1)
+        ramp = np.arange(1, n + 1) * self.release
+        held = np.minimum(np.minimum.accumulate(held - ramp), self.last) + ramp
+        held = np.minimum(held, 0.0)
+        self.last = held[-1]
+        held = np.concatenate((self.held, held))
+        self.held = held[n:]
+        sums = np.cumsum(np.concatenate(([0.0], held)))
+        gain_db = (sums[self.window:] - sums[:-self.window]) / self.window
+        self.reduction_db = min(self.reduction_db, float(gain_db.min()))
+        out = delayed[:n] * (10 ** (gain_db / 20))[:, None]
+        # Only rounding can still be over.
+        return np.clip(out, -self.ceiling, self.ceiling)
+
+
+class EffectsChain:
+    # Equalizer -> balance -> limiter -> volume. The volume comes last so
+    # it never changes how hard the limiter works. latency is in frames.
+
+    def __init__(self, rate, channels, block=DEFAULT_BLOCK, eq=None, balance=0.0,
+                 limiter=True, ceiling_db=-1.0):
+        self.rate = rate
+        self.channels = channels
+        self.block = block
+        self.equalizer = Equalizer(rate, channels, block, eq)
+        self.limiter = Limiter(rate, channels, ceiling_db)
+        self.limiter.enabled = limiter
+        self.latency = self.limiter.latency
+        self.volume = 1.0
+        self.set_balance(balance)
+
+    def set_balance(self, balance):
+        self.balance = max(-1.0, min(1.0, float(balance)))
+        self.gains = channel_gains(self.balance, self.channels)
+
+    def reset(self):
+        self.equalizer.reset()
+        self.limiter.reset()
+
+    def process(self, samples):
+        # samples: (frames, channels) float, frames <= block.
+        out = self.equalizer.process(samples)
+        if self.balance:
+            out *= self.gains
+        out = self.limiter.process(out)
+        if self.volume != 1.0:
+            out *= self.volume
+        return out
+
+
+def to_float(samples):
+    return samples.astype(np.float32) / 32768.0
+
+
+def to_int16(samples):
+    return np.clip(np.rint(samples * 32768.0), -32768, 32767).astype(np.int16)
+
+
+def decode(source):
+    # source: a path or a binary file object. Decodes the whole file at
+    # the mixer's format; returns (int16 frames x channels, Sound), and the
+    # array is only valid while the Sound is kept.
+    import pygame
+    if not pygame.mixer.get_init():
+        pygame.mixer.init()
+    sound = pygame.mixer.Sound(file=source)
+    samples = pygame.sndarray.samples(sound)
+    if samples.ndim == 1:
+        samples = samples[:, None]
+    return samples, sound
+
+
+class BlockTimer:
+    # Time spent on each block against the block's duration, the deadline
+    # for having the following one ready.
+
+    def __init__(self, rate, block):
+        self.budget = block / rate
+        self.reset()
+
+    def reset(self):
+        self.blocks = 0
+        self.total = 0.0
+        self.worst = 0.0
+        self.late = 0
+        self.underruns = 0
+
+    def add(self, elapsed):
+        self.blocks += 1
+        self.total += elapsed
+        self.worst = max(self.worst, elapsed)
+        if elapsed > self.budget:
+            self.late += 1
+
+    def stats(self):
+        return {
+            "blocks": self.blocks,
+            "budget_ms": round(self.budget * 1000, 2),
+            "mean_ms": round(self.total / self.blocks * 1000, 3) if self.blocks else 0.0,
+            "worst_ms": round(self.worst * 1000, 3),
+            "late": self.late,
+            "underruns": self.underruns,
+        }
+
+
+class Track:
+    # A decoded track and the next frame to send.
+
+    def __init__(self, samples, sound, rate, position=0.0):
+        self.samples = samples
+        self.sound = sound
+        self.rate = rate
+        self.pos = 0
+        self.seek(position)
+
+    def seek(self, seconds):
+        self.pos = max(0, min(len(self.samples), int(seconds * self.rate)))
+        return self.pos / self.rate
+
+
+class EffectsPlayer:
+    # Plays decoded tracks through an EffectsChain into a reserved pygame
+    # Channel. A worker thread keeps one processed block playing and the
+    # next queued behind it (Channel.queue), so a change to the chain is
+    # heard within two blocks. A block that is not ready by the time the
+    # channel runs dry is an underrun; it and blocks that took longer than
+    # their own duration are counted and passed to on_underrun(timer)
+    # from the worker thread.
+    #
+    # Tracks are decoded whole on a thread of their own before they start,
+    # like loudness analysis does. queue() decodes the following track so
+    # it continues straight from the last block of the current one.
+    # ended() reports (once) that the current track ran out, and busy()
+    # whether the queued one took over.
+
+    def __init__(self, chain, on_underrun=None):
+        import pygame
+        self.chain = chain
+        self.on_underrun = on_underrun
+        self.timer = BlockTimer(chain.rate, chain.block)
+        pygame.mixer.set_reserved(1)
+        self.channel = pygame.mixer.Channel(0)
+        self.cond = threading.Condition()
+        self.generation = 0
+        self.track = None
+        self.next = None
+        # Where the track being decoded is to start.
+        self.start_position = 0.0
+        self.fade = None
+        self.paused = False
+        self.paused_at = None
+        self.primed = False
+        # Monotonic time the last queued block will have played out, and
+        # the time the current track ran out (once it has been queued).
+        self.playing_until = 0.0
+        self.boundary = None
+        self.finished_at = None
+        self.closed = False
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def play(self, source, position=0.0, on_ready=None, on_error=None):
+        # Stops what is playing and starts source once decoded;
+        # on_ready(position) and on_error(message) run on the decoding
+        # thread.
+        with self.cond:
+            self.generation += 1
+            generation = self.generation
+            self.start_position = position
+            self.track = None
+            self.next = None
+            self.fade = None
+            self.paused = False
+            self.finished_at = None
+            self.channel.stop()
+        threading.Thread(target=self._decode, args=(generation, source, on_ready, on_error),
+                         daemon=True).start()
+
+    def _decode(self, generation, source, on_ready, on_error):
+        try:
+            samples, sound = decode(source)
+        except Exception as e:
+            if on_error and generation == self.generation:
+                on_error(str(e))
+            return
+        with self.cond:
+            if generation != self.generation:
+                return
+            self.track = Track(samples, sound, self.chain.rate, self.start_position)
+            position = self.track.pos / self.chain.rate
+            self.chain.reset()
+            self.primed = False
+            self.cond.notify_all()
+        if on_ready:
+            on_ready(position)
+
+    def queue(self, source):
+        generation = self.generation
+
+        def run():
+            try:
+                samples, sound = decode(source)
+            except Exception as e:
+                print(f"Could not queue for effects: {e}")
+                return
+            with self.cond:
+                if generation == self.generation:
+                    self.next = Track(samples, sound, self.chain.rate)
+        threading.Thread(target=run, daemon=True).start()
+
+    def stop(self):
+        with self.cond:
+            self.generation += 1
+            self.track = None
+            self.next = None
+            self.fade = None
+            self.finished_at = None
+            self.channel.stop()
+
+    def pause(self):
+        with self.cond:
+            if not self.paused:
+                self.paused = True
+                self.paused_at = time.monotonic()
+                self.channel.pause()
+
+    def resume(self):
+        with self.cond:
+            if self.paused:
+                self.paused = False
+                delay = time.monotonic() - self.paused_at
+                self.playing_until += delay
+                if self.finished_at is not None:
+                    self.finished_at += delay
+                self.channel.unpause()
+                self.cond.notify_all()
+
+    def seek(self, seconds):
+        # Returns the position actually seeked to.
+        with self.cond:
+            if self.track is None:
+                # Still decoding.
+                self.start_position = seconds
+                return seconds
+            actual = self.track.seek(seconds)
+            self.fade = None
+            self.chain.reset()
+            self.channel.stop()
+            self.primed = False
+            self.playing_until = 0.0
+            self.cond.notify_all()
+        return actual
+
+    def fadeout(self, seconds):
+        # Fades the current track out over seconds and ends it there.
+        with self.cond:
+            if self.track is not None:
+                start = self.track.pos
+                self.fade = (start, start + max(1, int(seconds * self.chain.rate)))
+
+    def set_volume(self, volume):
+        self.chain.volume = volume
+
+    def ended(self):
+        with self.cond:
+            if self.finished_at is None or time.monotonic() < self.finished_at:
+                return False
+            if self.track is None and self.channel.get_busy():
+                # The last blocks are still playing.
+                return False
+            self.finished_at = None
+        return True
+
+    def busy(self):
+        return self.track is not None
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.generation += 1
+            self.track = None
+            self.next = None
+            self.channel.stop()
+            self.cond.notify_all()
+
+    def stats(self):
+        stats = self.timer.stats()
+        stats["latency_ms"] = round((2 * self.chain.block + self.chain.latency) / self.chain.rate * 1000, 1)
+        stats["limiter_db"] = round(self.chain.limiter.reduction_db, 1)
+        self.chain.limiter.reduction_db = 0.0
+        return stats
+
+    def _take(self):
+        # The next block of frames as float, moving on to the queued track
+        # when the current one runs out (boundary is then the frame in the
+        # block where it did). None once there is nothing left.
+        block = self.chain.block
+        track = self.track
+        parts = []
+        count = 0
+        while count < block and track is not None:
+            stop = min(len(track.samples), track.pos + block - count)
+            gain = None
+            if self.fade is not None:
+                start, end = self.fade
+                stop = min(stop, end)
+                gain = np.clip((end - np.arange(track.pos, stop)) / (end - start), 0.0, 1.0)
+            if stop > track.pos:
+                part = to_float(track.samples[track.pos:stop])
+                if gain is not None:
+                    part *= gain[:, None]
+                parts.append(part)
+                count += stop - track.pos
+                track.pos = stop
+            if stop >= len(track.samples) or (self.fade is not None and stop >= self.fade[1]):
+                if self.boundary is None:
+                    self.boundary = count
+                self.fade = None
+                track = self.track = self.next
+                self.next = None
+        if not parts:
+            return None
+        return np.concatenate(parts) if len(parts) > 1 else parts[0]
+
+    def _run(self):
+        import pygame
+        channel = self.channel
+        poll = self.timer.budget / 4
+        while True:
+            with self.cond:
+                while not self.closed and (self.track is None or self.paused):
+                    self.cond.wait()
+                if self.closed:
+                    return
+                if channel.get_queue() is not None:
+                    waiting = True
+                else:
+                    waiting = False
+                    started = time.perf_counter()
+                    samples = self._take()
+                    if samples is not None:
+                        out = self.chain.process(samples)
+                        # The channel running dry while the block was being
+                        # made is an underrun, once the output has started
+                        # (not after a start or a seek).
+                        underrun = self.primed and not channel.get_busy()
+                        channel.queue(pygame.sndarray.make_sound(to_int16(out)))
+                        start = max(time.monotonic(), self.playing_until)
+                        self.playing_until = start + len(out) / self.chain.rate
+                        self.primed = True
+                        elapsed = time.perf_counter() - started
+                        self.timer.add(elapsed)
+                        if underrun:
+                            self.timer.underruns += 1
+                        report = underrun or elapsed > self.timer.budget
+                    else:
+                        start = time.monotonic()
+                    if self.boundary is not None:
+                        # When that frame will be heard, not when it is queued.
+                        self.finished_at = start + (self.boundary + self.chain.latency) / self.chain.rate
+                        self.boundary = None
+            if waiting:
+                time.sleep(poll)
+            elif samples is not None and report and self.on_underrun:
+                self.on_underrun(self.timer)
+
+
+def render(source, output, eq=None, balance=0.0, limiter=True, ceiling_db=-1.0,
+           volume=1.0, block=DEFAULT_BLOCK):
+    # Offline version of EffectsPlayer: the same chain, block by block,
+    # into a 16-bit WAV file. The limiter's lookahead delay is trimmed.
+    # Returns the BlockTimer, to compare processing time with real time.
+    import pygame
+    samples, sound = decode(source)
+    rate = pygame.mixer.get_init()[0]
+    channels = samples.shape[1]
+    chain = EffectsChain(rate, channels, block, eq, balance, limiter, ceiling_db)
+    chain.volume = volume
+    timer = BlockTimer(rate, block)
+    skip = chain.latency
+    total = len(samples) + chain.latency
+    with wave.open(output, "wb") as out:
+        out.setnchannels(channels)
+        out.setsampwidth(2)
+        out.setframerate(rate)
+        for start in range(0, total, block):
+            part = to_float(samples[start:start + block])
+            wanted = min(block, total - start)
+            if len(part) < wanted:
+                # Zeros past the end push the last of the track out of the
+                # limiter's delay line.
+                part = np.concatenate((part, np.zeros((wanted - len(part), channels), np.float32)))
+            started = time.perf_counter()
+            processed = chain.process(part)
+            timer.add(time.perf_counter() - started)
+            if skip:
+                dropped = min(skip, len(processed))
+                processed = processed[dropped:]
+                skip -= dropped
+            out.writeframes(to_int16(processed).tobytes())
+    del samples, sound
+    return timer
+
+
+def parse_eq(text):
+    # "flat", or up to ten comma-separated band gains in dB.
+    text = text.strip().lower()
+    if text in ("", "flat", "off"):
+        return [0.0] * len(EQ_BANDS)
+    gains = [float(g) for g in text.replace(" ", "").split(",")]
+    if len(gains) > len(EQ_BANDS):
+        raise ValueError(f"at most {len(EQ_BANDS)} equalizer bands")
+    return gains + [0.0] * (len(EQ_BANDS) - len(gains))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Render a track through the player's effects into a WAV file")
+    parser.add_argument("input")
+    parser.add_argument("output")
+    parser.add_argument("--eq", default="flat",
+                        help="gains in dB for " + "/".join(map(str, EQ_BANDS)) + " Hz, comma-separated")
+    parser.add_argument("--balance", type=float, default=0.0, help="-1 (left) .. 1 (right)")
+    parser.add_argument("--no-limiter", action="store_true")
+    parser.add_argument("--ceiling", type=float, default=-1.0, help="limiter ceiling in dBFS")
+    parser.add_argument("--volume", type=float, default=1.0)
+    parser.add_argument("--block", type=int, default=DEFAULT_BLOCK, help="frames per block")
+    args = parser.parse_args()
+    try:
+        eq = parse_eq(args.eq)
+    except ValueError as e:
+        sys.exit(f"--eq: {e}")
+    # No audio device is needed to decode.
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+    started = time.perf_counter()
+    timer = render(args.input, args.output, eq, args.balance, not args.no_limiter, args.ceiling,
+                   args.volume, args.block)
+    elapsed = time.perf_counter() - started
+    stats = timer.stats()
+    print(f"Rendered {args.output} in {elapsed:.2f} s: {stats['blocks']} blocks, "
+          f"mean {stats['mean_ms']} ms, worst {stats['worst_ms']} ms of a {stats['budget_ms']} ms budget, "
+          f"{stats['late']} late")
+
+
+if __name__ == "__main__":
+    main()
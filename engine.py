@@ -0,0 +1,1219 @@
+import bisect
+import configparser
+import io
+import itertools
+import locale
+import os
+import time
+
+import instrument
+from metadata_cache import MetadataCache
+from scanner import FolderScanner
+from library import LibraryWatcher
+from search import SearchIndex
+from playback_clock import PlaybackClock, install_end_event, music_ended, discard_end_events
+from gapless import NextTrackPreloader
+from seekindex import SeekIndexCache, seek_music
+from track_queue import TrackQueue
+from snapshot import load_snapshot, save_snapshot
+from session import BackgroundWriter, encode_session, load_session
+from track_table import TrackTable
+from track_buffers import TrackBufferCache
+from shuffle import Shuffle
+from playlist import PlaylistLoader, write_playlist
+
+
+# Imported by ensure_audio() on the first playback.
+pygame = None
+
+
+class PlayerEngine:
+    # Everything about playback that does not need a window: the library,
+    # the queue, the mixer and the config. It runs on one loop thread (the
+    # Tk dispatcher, or an EventLoop when headless) and is only driven
+    # through that loop, so the GUI, the hotkeys and control-socket clients
+    # never touch its state concurrently.
+    #
+    # Clients subscribe() to events, called as listener(event, *args):
+    #   "library_cleared"                 a new folder is being loaded
+    #   "tracks_added", start, stop       tracks start..stop-1 were appended
+    #                                     (after a snapshot restore they are
+    #                                     not searchable until the following
+    #                                     "library_changed")
+    #   "scan_done", count, error         a folder scan finished
+    #   "loudness_done", analyzed         gains are known for the folder
+    #   "library_changed"                 tracks were renamed/removed/retagged
+    #   "track", index                    a track started playing
+    #   "paused" / "resumed" / "stopped"
+    #   "position", seconds               periodic while playing, and on seek
+    #   "message", text, duration, permanent
+
+    CONFIG_FILE = "player_config.ini"
+    METADATA_CACHE_FILE = "player_metadata.db"
+    SNAPSHOT_FILE = "player_library.snapshot"
+    SESSION_FILE = "player_session.json"
+    TICK_INTERVAL = 0.25
+    # Once the clock says the track is over but the output has not ended
+    # yet, the next check comes this soon, backing off to TICK_INTERVAL.
+    END_RETRY = 0.01
+    NORMALIZATION_MODES = ("off", "track", "album")
+    SHUFFLE_MODES = ("off", "shuffle", "smart")
+    INDEX_CHUNK = 1000
+    # Seconds play_file() waits for a read-ahead before going async.
+    READ_AHEAD_WAIT = 0.02
+    # At most one effects underrun message per this many seconds.
+    UNDERRUN_REPORT_INTERVAL = 10.0
+    # While playing, the position is saved this often (in seconds); other
+    # session changes are saved within session_write_interval.
+    POSITION_SAVE_INTERVAL = 5.0
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.listeners = []
+        self.scan_started = None
+        self.audio_ready = False
+        self.restoring = False
+        self.revalidating = None
+        if instrument.enabled:
+            instrument.wrap(self, "load_folder", "play_file", "seek", "next_track", "previous_track",
+                            "pause_resume", "on_scan_batch", "on_library_change", prefix="engine.")
+
+        self.tracks = TrackTable()
+        self.search_index = SearchIndex()
+        self.queue = TrackQueue()
+        self.current_index = None
+        self.playing = False
+        self.paused = False
+        self.song_length = 0
+        self.fading = False
+        self.clock = PlaybackClock()
+        self.end_retry = self.END_RETRY
+        self.seek_indexes = SeekIndexCache()
+        self.queue.subscribe(self.on_queue_changed)
+
+        self.config = configparser.ConfigParser()
+        # Config and session files are written on this thread, at most once
+        # per session_write_interval however fast settings change.
+        self.writer = BackgroundWriter()
+        self.config_pending = False
+        self.session_pending = False
+        self.session_saved = 0.0
+        # The queue as paths, kept until the queue changes.
+        self.session_queue = None
+        self.resuming = None
+        self.load_config()
+        self.write_interval = self.config.getfloat("Settings", "session_write_interval", fallback=1.0)
+        self.resume_playback = self.config.getboolean("Settings", "resume_playback", fallback=False)
+        mb = 1024 * 1024
+        self.buffers = TrackBufferCache(
+            max_bytes=int(self.config.getfloat("Settings", "buffer_cache_mb", fallback=256) * mb),
+            max_file_bytes=int(self.config.getfloat("Settings", "buffer_max_file_mb", fallback=64) * mb),
+            spool_dir=self.config.get("Settings", "spool_dir", fallback="") or None,
+            spool_bytes=int(self.config.getfloat("Settings", "spool_mb", fallback=2048) * mb))
+        self.readahead_tracks = self.config.getint("Settings", "readahead_tracks", fallback=2)
+        self.preloader = NextTrackPreloader(loop.post, self.buffers, self.queue_next_stream)
+        self.previous_index = None
+        self.play_generation = 0
+        # The track play_file() is waiting on, while its read-ahead starts.
+        self.fetching = None
+        self.library_mode = self.config.getboolean("Settings", "library_mode", fallback=False)
+        self.gapless = self.config.getboolean("Settings", "gapless", fallback=False)
+        self.crossfade = self.config.getfloat("Settings", "crossfade", fallback=0.0)
+        # Off unless asked for: turning it on analyzes the whole folder.
+        self.normalization = self.config.get("Settings", "normalization", fallback="off")
+        if self.normalization not in self.NORMALIZATION_MODES:
+            self.normalization = "off"
+        self.shuffle_mode = self.config.get("Settings", "shuffle", fallback="off")
+        if self.shuffle_mode not in self.SHUFFLE_MODES:
+            self.shuffle_mode = "off"
+        # Created by get_shuffle(); shuffle_scope is the filtered list of
+        # track ids to shuffle, or None for the whole library.
+        self.shuffle = None
+        self.shuffle_scope = None
+        # Effects (dsp.py): equalizer gains in dB, balance -1..1, limiter.
+        # The player is created by get_effects() on the first track played
+        # with effects on; output_effects says whether the current track
+        # went through it rather than pygame.mixer.music.
+        self.effects_enabled = self.config.getboolean("Settings", "effects", fallback=False)
+        try:
+            self.eq = [float(g) for g in self.config.get("Settings", "eq", fallback="").split(",") if g.strip()]
+        except ValueError:
+            self.eq = []
+        self.balance = self.config.getfloat("Settings", "balance", fallback=0.0)
+        self.limiter = self.config.getboolean("Settings", "limiter", fallback=True)
+        self.effects = None
+        self.output_effects = False
+        self.underrun_reported = None
+
+        cache_size = self.config.getint("Settings", "cache_max_entries", fallback=200000)
+        self.metadata_cache = MetadataCache(self.METADATA_CACHE_FILE, max_entries=cache_size)
+        scan_workers = self.config.getint("Settings", "scan_workers", fallback=0)
+        self.scanner = FolderScanner(loop.post, self.metadata_cache,
+                                     on_batch=self.on_scan_batch,
+                                     on_done=self.on_scan_done,
+                                     on_error=self.on_scan_error,
+                                     workers=scan_workers or None)
+        self.playlists = PlaylistLoader(loop.post, self.metadata_cache,
+                                        on_batch=self.on_playlist_batch,
+                                        on_done=self.on_playlist_done,
+                                        on_checked=self.on_playlist_checked)
+        # Paths from the playlist being loaded that turned out not to exist;
+        # removed together once the check is done.
+        self.playlist_missing = []
+        self.library = LibraryWatcher(loop.post, self.metadata_cache,
+                                      on_ready=self.on_library_ready,
+                                      on_change=self.on_library_change,
+                                      poll_interval=self.config.getfloat("Settings", "library_poll_interval", fallback=5.0))
+        # Created by analyze_loudness(); it pulls in NumPy.
+        self.loudness = None
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def emit(self, event, *args):
+        for listener in self.listeners:
+            listener(event, *args)
+
+    def message(self, text, duration=2, permanent=False):
+        self.emit("message", text, duration, permanent)
+
+    def load_config(self):
+        if os.path.exists(self.CONFIG_FILE):
+            self.config.read(self.CONFIG_FILE)
+        else:
+            self.config["Settings"] = {}
+        # The volume and last folder are part of the session; older configs
+        # still have them, and are only read when there is no session yet.
+        session = load_session(self.SESSION_FILE) or {}
+        self.last_folder = session.get("folder", self.config.get("Settings", "Last_folder", fallback=""))
+        self.volume = session.get("volume", self.config.getfloat("Settings", "volume", fallback=0.8))
+        # Queue, current track and position, applied by resume_session()
+        # once the library is loaded.
+        self.resume_state = session if session.get("queue") or session.get("current") else None
+
+    def save_config(self):
+        # Coalesced: a burst of changes (an EQ slider being dragged) is
+        # written once, write_interval later.
+        if not self.config_pending:
+            self.config_pending = True
+            self.loop.call_later("save_config", self.write_interval, self.write_config)
+
+    def write_config(self):
+        self.config_pending = False
+        if "Settings" not in self.config:
+            self.config["Settings"] = {}
+        self.config["Settings"].pop("volume", None)
+        self.config["Settings"].pop("Last_folder", None)
+        self.config["Settings"]["library_mode"] = str(self.library_mode)
+        self.config["Settings"]["gapless"] = str(self.gapless)
+        self.config["Settings"]["crossfade"] = str(self.crossfade)
+        self.config["Settings"]["normalization"] = self.normalization
+        self.config["Settings"]["shuffle"] = self.shuffle_mode
+        self.config["Settings"]["effects"] = str(self.effects_enabled)
+        self.config["Settings"]["eq"] = ",".join(f"{g:g}" for g in self.eq)
+        self.config["Settings"]["balance"] = str(self.balance)
+        self.config["Settings"]["limiter"] = str(self.limiter)
+        text = io.StringIO()
+        self.config.write(text)
+        self.writer.write(self.CONFIG_FILE, text.getvalue().encode(locale.getpreferredencoding(False)))
+
+    def save_session(self):
+        # Coalesced like save_config().
+        if not self.session_pending:
+            self.session_pending = True
+            self.loop.call_later("save_session", self.write_interval, self.write_session)
+
+    def write_session(self):
+        self.session_pending = False
+        self.session_saved = time.monotonic()
+        session = self.session_state()
+        # Encoded on the writer thread; a long queue takes a while.
+        self.writer.write(self.SESSION_FILE, lambda: encode_session(session))
+
+    def session_state(self):
+        if self.resume_state is not None:
+            # Not applied yet (the library is still loading): keep it for
+            # the next start.
+            return dict(self.resume_state, volume=self.volume)
+        tracks = self.tracks
+        if self.session_queue is None:
+            self.session_queue = [tracks.path(i) for i in self.queue if i < len(tracks)]
+        session = {"folder": self.last_folder, "volume": self.volume, "queue": self.session_queue}
+        index = self.current_index
+        if index is not None and index < len(tracks):
+            session["current"] = tracks.path(index)
+            if self.playing:
+                session["position"] = round(self.position(), 3)
+                session["state"] = "paused" if self.paused else "playing"
+        return session
+
+    def resume_session(self):
+        # Puts back the queue and current track from the last run, or from
+        # before a reload of the same folder. A track that was playing or
+        # paused is loaded at its position and paused, or keeps playing
+        # with resume_playback.
+        session, self.resume_state = self.resume_state, None
+        if session is None:
+            return
+        # Held back while the library was loading.
+        self.save_session()
+        tracks = self.tracks
+        if not self.queue:
+            self.queue.replace(i for i in map(tracks.find, session.get("queue", ())) if i is not None)
+        index = tracks.find(session["current"]) if "current" in session else None
+        if index is None:
+            return
+        if self.playing:
+            if self.current_index is None:
+                self.playing_found(index)
+            return
+        self.current_index = index
+        state = session.get("state", "stopped")
+        if state == "stopped":
+            return
+        self.resuming = "playing" if state == "playing" and self.resume_playback else "paused"
+        self.play_file(index, min(session.get("position", 0.0), tracks.length(index)))
+
+    def close(self):
+        self.loop.cancel("save_config")
+        self.loop.cancel("save_session")
+        self.write_config()
+        self.write_session()
+        self.save_snapshot()
+        self.loop.cancel("tick")
+        self.loop.cancel("prepare_next")
+        self.loop.cancel("index_restored")
+        self.scanner.cancel()
+        self.playlists.cancel()
+        self.library.stop()
+        if self.loudness:
+            self.loudness.cancel()
+        self.buffers.close()
+        if self.effects:
+            self.effects.close()
+        self.metadata_cache.close()
+        self.writer.close()
+
+    def ensure_audio(self):
+        # pygame and the mixer come up on the first playback rather than
+        # at startup; importing pygame alone takes a few hundred ms.
+        global pygame
+        if self.audio_ready:
+            return
+        import pygame
+        pygame.mixer.init()
+        install_end_event()
+        self.audio_ready = True
+        self.apply_volume()
+
+    def start(self):
+        # Shows the last library from the snapshot if there is one that
+        # matches the config, otherwise scans it.
+        if not self.restore_snapshot():
+            self.resume_last_folder()
+
+    def resume_last_folder(self):
+        if self.last_folder and os.path.exists(self.last_folder):
+            self.load_folder(self.last_folder)
+
+    def save_snapshot(self):
+        # While a restore is still being indexed, the snapshot on disk is
+        # still the complete one.
+        if not self.last_folder or self.restoring:
+            return
+        try:
+            save_snapshot(self.SNAPSHOT_FILE, self.last_folder, self.library_mode, self.tracks)
+        except (OSError, ValueError) as e:
+            print(f"Could not save library snapshot: {e}")
+
+    def restore_snapshot(self):
+        if not self.last_folder:
+            return False
+        snapshot = load_snapshot(self.SNAPSHOT_FILE)
+        if snapshot is None:
+            return False
+        folder, library_mode, tracks = snapshot
+        if folder != self.last_folder or library_mode != self.library_mode:
+            return False
+        self.reset_library()
+        self.tracks = tracks
+        self.restoring = True
+        self.emit("library_cleared")
+        self.emit("tracks_added", 0, len(tracks))
+        # Lookups and search are rebuilt in slices on the loop, so the
+        # list is usable right away; the rescan follows once they are done.
+        self.loop.call_later("index_restored", 0, self.index_restored, 0)
+        return True
+
+    def index_restored(self, start):
+        tracks = self.tracks
+        stop = min(start + self.INDEX_CHUNK, len(tracks))
+        tracks.index(start, stop)
+        for index in range(start, stop):
+            self.search_index.add(index, tracks.name(index), tracks.tags(index))
+        if stop < len(tracks):
+            self.loop.call_later("index_restored", 0, self.index_restored, stop)
+            return
+        self.restoring = False
+        self.emit("library_changed")
+        self.resume_session()
+        self.revalidate()
+
+    def revalidate(self):
+        # Rescans the restored folder; on_scan_batch/on_scan_done fold the
+        # result into the library instead of rebuilding it.
+        self.revalidating = set()
+        folder = self.last_folder
+        if self.library_mode:
+            self.scanner.cancel()
+            self.library.watch(folder)
+        else:
+            self.library.stop()
+            self.scanner.scan(folder)
+
+    def playing_found(self, index):
+        # What kept playing through a reload is in the new table again.
+        self.current_index = index
+        self.buffer_neighbours()
+        self.emit("track", index)
+        self.emit("position", self.position())
+        self.schedule_prepare_next()
+
+    def reset_library(self, reload=False):
+        self.loop.cancel("index_restored")
+        self.restoring = False
+        self.revalidating = None
+        if self.loudness:
+            self.loudness.cancel()
+        self.playlists.cancel()
+        self.playlist_missing = []
+        # Track ids from the old table mean nothing in the new one. On a
+        # reload of the same folder the output carries on without an id
+        # until playing_found(); only the gapless pick, made by id, is
+        # dropped. Buffers are keyed by path and stay.
+        if self.playing and not reload:
+            self.stop()
+        elif self.playing:
+            self.loop.cancel("prepare_next")
+            self.preloader.cancel()
+        self.current_index = None
+        self.previous_index = None
+        self.queue.clear()
+        self.tracks = TrackTable()
+        self.search_index.clear()
+        if not reload:
+            self.buffers.clear()
+        self.shuffle = None
+
+    def load_folder(self, folder):
+        if instrument.enabled:
+            self.scan_started = instrument.now()
+        if folder == self.last_folder:
+            # The same folder again (library mode toggled): what is playing
+            # keeps playing, and the current track and queue are found
+            # again by path, as after a restart. Until then the session
+            # still holds them.
+            if self.resume_state is None:
+                session = self.session_state()
+                if session.get("queue") or session.get("current"):
+                    self.resume_state = session
+            self.reset_library(reload=True)
+            self.emit("library_cleared")
+        else:
+            self.last_folder = folder
+            if self.resume_state is not None and self.resume_state.get("folder") != folder:
+                self.resume_state = None
+            self.reset_library()
+            self.emit("library_cleared")
+            self.save_session()
+        if self.library_mode:
+            self.scanner.cancel()
+            self.library.watch(folder)
+            self.message(f"Indexing {os.path.basename(folder) or folder}...", permanent=True)
+        else:
+            self.library.stop()
+            self.scanner.scan(folder)
+            self.message(f"Scanning {os.path.basename(folder) or folder}...", permanent=True)
+
+    def set_library_mode(self, enabled):
+        self.library_mode = enabled
+        self.save_config()
+        self.resume_last_folder()
+
+    def append_track(self, file_path, length, tags):
+        index = self.tracks.append(file_path, length, tags)
+        self.search_index.add(index, self.tracks.name(index), tags or None)
+
+    def on_scan_batch(self, token, batch):
+        start = len(self.tracks)
+        seen = self.revalidating
+        changed = False
+        for file_path, length, tags in batch:
+            index = self.tracks.find(file_path)
+            if index is None:
+                self.append_track(file_path, length, tags)
+            elif seen is not None:
+                changed |= self.update_track(index, length, tags)
+            if seen is not None:
+                seen.add(file_path)
+        self.emit("tracks_added", start, len(self.tracks))
+        if changed:
+            self.emit("library_changed")
+        if self.playing and self.current_index is None and self.resume_state is not None:
+            index = self.tracks.find(self.resume_state.get("current", ""))
+            if index is not None:
+                self.playing_found(index)
+
+    def update_track(self, index, length, tags):
+        tracks = self.tracks
+        old_tags = tracks.tags(index)
+        if length == tracks.length(index) and (tags or None) == old_tags:
+            return False
+        tracks.set_length(index, length)
+        if (tags or None) != old_tags:
+            tracks.set_tags(index, tags)
+            self.search_index.update(index, tracks.name(index), tracks.tags(index))
+        if index == self.current_index:
+            self.song_length = length
+        return True
+
+    def load_playlist(self, playlist_path):
+        # Queues the playlist's tracks in order, adding the ones the library
+        # does not have yet. Those are checked in the background: missing
+        # files are dropped, lengths and tags filled in.
+        self.playlist_missing = []
+        self.playlists.load(playlist_path)
+        self.message(f"Loading {os.path.basename(playlist_path)}...", permanent=True)
+
+    def on_playlist_batch(self, token, batch):
+        tracks = self.tracks
+        start = len(tracks)
+        indexes = []
+        fresh = []
+        for file_path, length, title in batch:
+            index = tracks.find(file_path)
+            if index is None:
+                index = len(tracks)
+                # The playlist's own length until the file has been probed.
+                self.append_track(file_path, length or 0.0, None)
+                fresh.append(file_path)
+            indexes.append(index)
+        if len(tracks) > start:
+            self.emit("tracks_added", start, len(tracks))
+        self.queue.extend(indexes)
+        if fresh:
+            self.playlists.check(token, fresh)
+
+    def on_playlist_done(self, token, count, skipped, error):
+        self.playlists.check(token, None)
+        if error:
+            self.message(f"Could not read playlist: {error}", 5)
+            return
+        text = f"Queued {count} track(s)"
+        if skipped:
+            text += f", skipped {skipped} stream(s) or unsupported file(s)"
+        self.message(text, 3)
+
+    def on_playlist_checked(self, token, found, missing, final):
+        tracks = self.tracks
+        changed = False
+        for file_path, length, tags in found:
+            index = tracks.find(file_path)
+            if index is not None:
+                changed |= self.update_track(index, length, tags)
+        self.playlist_missing.extend(missing)
+        if final:
+            missing, self.playlist_missing = self.playlist_missing, []
+            if missing:
+                self.remove_tracks(missing)
+                changed = True
+                self.message(f"{len(missing)} playlist track(s) not found", 5)
+            self.save_snapshot()
+        if changed:
+            self.emit("library_changed")
+
+    def export_playlist(self, playlist_path, indexes):
+        # indexes: the queue or the filtered list, written as they are
+        # iterated. Returns the number of tracks written.
+        tracks = self.tracks
+        return write_playlist(playlist_path, ((tracks.path(i), tracks.length(i), self.display_title(i))
+                                              for i in indexes if i < len(tracks)))
+
+    def display_title(self, index):
+        artist = self.tracks.tag(index, "artist")
+        title = self.tracks.tag(index, "title")
+        if artist and title:
+            return f"{artist} - {title}"
+        return title or self.tracks.name(index)
+
+    def in_library_folder(self, file_path):
+        # Whether a scan of the library folder lists file_path; tracks from
+        # playlists can be anywhere else.
+        prefix = os.path.join(self.last_folder, "")
+        if self.library_mode:
+            return file_path.startswith(prefix)
+        return os.path.dirname(file_path) == os.path.dirname(prefix)
+
+    def on_library_ready(self, folder, entries):
+        self.scanner.scan(folder, listing=entries)
+
+    def on_library_change(self, added, removed, renamed):
+        tracks = self.tracks
+        for old, new in renamed:
+            self.buffers.discard(old)
+            index = tracks.find(old)
+            if index is None:
+                continue
+            tracks.rename(index, new)
+            self.session_queue = None
+            self.search_index.update(index, tracks.name(index), tracks.tags(index))
+        for file_path, length, tags in added:
+            self.buffers.discard(file_path)
+            index = tracks.find(file_path)
+            if index is None:
+                self.append_track(file_path, length, tags)
+                continue
+            tracks.set_length(index, length)
+            if tags:
+                tracks.set_tags(index, tags)
+                self.search_index.update(index, tracks.name(index), tracks.tags(index))
+            if index == self.current_index:
+                self.song_length = length
+        if removed:
+            for file_path in removed:
+                self.buffers.discard(file_path)
+            self.remove_tracks(removed)
+        self.emit("library_changed")
+        changes = len(added) + len(removed) + len(renamed)
+        self.message(f"Library updated ({changes} change(s))", 3)
+        if added:
+            self.analyze_loudness()
+
+    def analyze_loudness(self):
+        # Gains for the whole folder; cached ones come back right away, so
+        # only new or changed files cost an analysis.
+        if self.normalization == "off" or not self.last_folder:
+            return
+        if self.loudness is None:
+            from loudness import LoudnessAnalyzer
+            workers = self.config.getint("Settings", "scan_workers", fallback=0)
+            self.loudness = LoudnessAnalyzer(self.loop.post, self.metadata_cache,
+                                             on_batch=self.on_gains, on_done=self.on_gains_done,
+                                             workers=workers or None)
+        self.loudness.analyze(self.last_folder, self.library_mode)
+
+    def on_gains(self, batch):
+        tracks = self.tracks
+        current = False
+        for file_path, track_gain, track_peak, album_gain, album_peak in batch:
+            index = tracks.find(file_path)
+            if index is None:
+                continue
+            tracks.set_gain(index, track_gain, track_peak, album_gain, album_peak)
+            current |= index == self.current_index
+        if current:
+            self.apply_volume()
+
+    def on_gains_done(self, analyzed):
+        self.emit("loudness_done", analyzed)
+        if analyzed:
+            self.message(f"Measured loudness of {analyzed} track(s)", 3)
+
+    def remove_tracks(self, paths):
+        tracks = self.tracks
+        doomed = sorted(i for i in map(tracks.find, paths) if i is not None)
+        if not doomed:
+            return
+        doomed_set = set(doomed)
+
+        def remap(i):
+            return i - bisect.bisect_left(doomed, i)
+
+        tracks.remove(doomed_set)
+        self.search_index.rebuild((tracks.name(i), tracks.tags(i)) for i in range(len(tracks)))
+        self.queue.replace(remap(i) for i in self.queue if i not in doomed_set)
+        if self.current_index is not None:
+            if self.current_index in doomed_set:
+                # Keep playing what is already loaded; "next" continues
+                # with the track that followed it.
+                self.current_index = remap(self.current_index) - 1
+                if self.current_index < 0:
+                    self.current_index = None if not tracks else len(tracks) - 1
+            else:
+                self.current_index = remap(self.current_index)
+        if self.previous_index is not None:
+            doomed_previous = self.previous_index in doomed_set
+            self.previous_index = None if doomed_previous else remap(self.previous_index)
+        if self.shuffle is not None:
+            self.shuffle.remap(remap, doomed_set)
+
+    def on_scan_error(self, token, file_path, error):
+        self.message(f"Error loading {os.path.basename(file_path)}: {error}", 5)
+
+    def on_scan_done(self, token, count, error):
+        if instrument.enabled and self.scan_started is not None:
+            elapsed = instrument.now() - self.scan_started
+            instrument.record("engine.scan", self.scan_started, files=count)
+            instrument.gauge("scan.files_per_s", count / elapsed if elapsed else 0.0)
+            self.scan_started = None
+        seen = self.revalidating
+        self.revalidating = None
+        if seen is not None and not error:
+            # Whatever the snapshot had that the rescan did not find.
+            gone = [p for p in self.tracks.by_path if p not in seen and self.in_library_folder(p)]
+            if gone:
+                self.remove_tracks(gone)
+                self.emit("library_changed")
+        if not error:
+            self.resume_session()
+        self.emit("scan_done", count, error)
+        if not error:
+            self.save_snapshot()
+            self.analyze_loudness()
+        if error:
+            self.message(f"Could not read folder: {error}", 5)
+        elif count:
+            self.message(f"Loaded {count} track(s)", 3)
+        else:
+            self.message("No audio files found", 3)
+
+    def play_file(self, index, position=0.0):
+        if index >= len(self.tracks):
+            return
+
+        # Tracks that are not in memory yet start once their read-ahead
+        # has the first chunk. That is waited for here only briefly, which
+        # covers local disks; a slow share finishes in the background.
+        file_path = self.tracks.path(index)
+        started = instrument.now() if instrument.enabled else None
+        self.play_generation += 1
+        self.fetching = None
+        buffer = self.buffers.get(file_path)
+        if buffer is not None:
+            self.start_stream(index, buffer, started, position)
+            return
+        generation = self.play_generation
+        reader = self.buffers.fetch(file_path)
+        if reader.wait_ready(self.READ_AHEAD_WAIT):
+            self.on_fetched(generation, index, file_path, reader, started, position)
+        else:
+            self.fetching = file_path
+            reader.add_ready_callback(lambda reader: self.loop.post(self.on_fetched, generation, index,
+                                                                    file_path, reader, started, position))
+
+    def on_fetched(self, generation, index, file_path, reader, started, position=0.0):
+        if generation != self.play_generation:
+            return
+        self.fetching = None
+        if index >= len(self.tracks) or self.tracks.path(index) != file_path:
+            return
+        if reader.error is not None:
+            self.message(f"Playback error: {reader.error}", permanent=True)
+            return
+        self.start_stream(index, reader, started, position)
+
+    def start_stream(self, index, source, started=None, position=0.0):
+        # source: a track buffer or read-ahead reader for the track.
+        file_path = self.tracks.path(index)
+        try:
+            self.ensure_audio()
+            self.preloader.cancel()
+            if self.effects_enabled:
+                self.start_effects(index, source, position)
+                self.track_started(index, position)
+                return
+            if self.output_effects:
+                self.effects.stop()
+                self.output_effects = False
+            pygame.mixer.music.load(source.open(), os.path.splitext(file_path)[1].lstrip("."))
+            pygame.mixer.music.set_volume(self.effective_volume(index))
+            pygame.mixer.music.play()
+            discard_end_events()
+            if started is not None:
+                # get_pos() only moves once the audio callback has pulled
+                # the first buffer of the new track.
+                instrument.poll_until(self.loop, "engine.play_file.audible", started,
+                                      lambda: pygame.mixer.music.get_pos() > 0)
+            self.track_started(index)
+            if position:
+                self.seek(position)
+        except Exception as e:
+            self.message(f"Playback error: {e}", permanent=True)
+
+    def start_effects(self, index, source, position):
+        # The track is decoded before it starts; the clock is restarted
+        # once it has been (effects_ready).
+        pygame.mixer.music.stop()
+        discard_end_events()
+        generation = self.play_generation
+        effects = self.get_effects()
+        effects.set_volume(self.effective_volume(index))
+        effects.play(source.open(), position,
+                     on_ready=lambda actual: self.loop.post(self.effects_ready, generation, actual),
+                     on_error=lambda error: self.loop.post(self.effects_failed, generation, error))
+        self.output_effects = True
+
+    def effects_ready(self, generation, position):
+        if generation != self.play_generation or not self.playing:
+            return
+        self.clock.start(position)
+        if self.paused:
+            self.clock.pause()
+        self.schedule_tick()
+
+    def effects_failed(self, generation, error):
+        if generation == self.play_generation:
+            self.message(f"Playback error: {error}", permanent=True)
+
+    def get_effects(self):
+        if self.effects is None:
+            import dsp
+            rate, _, channels = pygame.mixer.get_init()
+            block = self.config.getint("Settings", "effects_block", fallback=dsp.DEFAULT_BLOCK)
+            ceiling = self.config.getfloat("Settings", "limiter_ceiling_db", fallback=-1.0)
+            chain = dsp.EffectsChain(rate, channels, block, self.eq, self.balance, self.limiter, ceiling)
+            self.effects = dsp.EffectsPlayer(
+                chain, on_underrun=lambda timer: self.loop.post(self.report_underrun, timer.stats()))
+        return self.effects
+
+    def report_underrun(self, stats):
+        now = time.monotonic()
+        if self.underrun_reported is not None and now - self.underrun_reported < self.UNDERRUN_REPORT_INTERVAL:
+            return
+        self.underrun_reported = now
+        text = (f"Effects falling behind: {stats['underruns']} underrun(s), worst block "
+                f"{stats['worst_ms']} ms of {stats['budget_ms']} ms")
+        print(text)
+        self.message(text, 3)
+
+    def queue_next_stream(self, stream, namehint):
+        # Gapless: hands the preloaded track to whichever output is playing.
+        if self.output_effects:
+            self.effects.queue(stream)
+        else:
+            pygame.mixer.music.queue(stream, namehint=namehint)
+
+    def track_ended(self):
+        return self.effects.ended() if self.output_effects else music_ended()
+
+    def output_busy(self):
+        return self.effects.busy() if self.output_effects else pygame.mixer.music.get_busy()
+
+    def track_started(self, index, position=0.0):
+        resuming, self.resuming = self.resuming, None
+        if index != self.current_index:
+            self.previous_index = self.current_index
+        self.current_index = index
+        self.song_length = self.tracks.length(index)
+        self.playing = True
+        self.paused = False
+        self.fading = False
+        self.clock.start(position)
+        self.end_retry = self.END_RETRY
+        self.apply_volume()
+        self.schedule_tick()
+        if self.shuffle is not None:
+            self.shuffle.visit(index)
+            if not resuming:
+                self.shuffle.played(index)
+        if not resuming:
+            # Picking up where the last run stopped is not another play.
+            self.record_play(index)
+        self.buffer_neighbours(track_changed=True)
+        self.buffers.prepare_seek(self.tracks.path(index), self.seek_indexes.get)
+        self.emit("track", index)
+        if resuming == "paused":
+            self.pause()
+            self.emit("position", position)
+        self.schedule_prepare_next()
+        self.save_session()
+
+    def buffer_neighbours(self, track_changed=False):
+        # Keeps the current track, the one before it and the next few in
+        # memory (readahead_tracks), and out of reach of eviction while
+        # they are neighbours.
+        tracks = self.tracks
+        count = len(tracks)
+        if self.current_index is None or self.current_index >= count:
+            return
+        ahead = [self.current_index] + self.upcoming_indexes(self.readahead_tracks)
+        behind = [self.previous_index, (self.current_index - 1) % count]
+        paths = [tracks.path(i) for i in ahead + behind if i is not None and i < count]
+        self.buffers.protect(paths)
+        if track_changed:
+            # Only the current and next tracks keep reading, plus any that
+            # play_file() or the gapless preloader still waits for.
+            wanted = [tracks.path(i) for i in ahead if i is not None and i < count]
+            if self.preloader.pending:
+                wanted.append(self.preloader.pending[1])
+            self.buffers.cancel_except(wanted + [self.fetching])
+        for index in ahead:
+            if index is not None and index < count:
+                self.buffers.prefetch(tracks.path(index))
+
+    def upcoming_index(self):
+        # What next_track would play, without consuming the queue.
+        indexes = self.upcoming_indexes(1)
+        return indexes[0] if indexes else None
+
+    def upcoming_indexes(self, count):
+        # The next count tracks: the queue first, then the shuffle or the
+        # library order.
+        indexes = list(itertools.islice(self.queue, count))
+        shuffle = self.get_shuffle()
+        if shuffle is not None:
+            if len(indexes) < count:
+                indexes.extend(shuffle.peek(count - len(indexes)))
+            return indexes
+        after = indexes[-1] if indexes else self.current_index
+        while after is not None and len(indexes) < min(count, len(self.tracks)):
+            after = (after + 1) % len(self.tracks)
+            indexes.append(after)
+        return indexes
+
+    def schedule_prepare_next(self):
+        if not self.gapless or not self.playing:
+            return
+        self.loop.call_later("prepare_next", 0.05, self.prepare_next)
+
+    def prepare_next(self):
+        if not self.gapless or not self.playing:
+            return
+        index = self.upcoming_index()
+        if index is not None and index < len(self.tracks):
+            self.preloader.request(index, self.tracks.path(index))
+
+    def advance_to_preloaded(self):
+        # The queued stream is already playing; just catch up our state.
+        index = self.preloader.index
+        overshoot = 0.0 if self.fading else max(0.0, self.clock.position() - self.song_length)
+        self.preloader.cancel()
+        if self.queue and self.queue[0] == index:
+            self.queue.popleft()
+        elif self.shuffle is not None and self.shuffle.peek(1) == [index]:
+            self.shuffle.next()
+        self.track_started(index, overshoot)
+
+    def set_gapless(self, enabled):
+        self.gapless = enabled
+        self.save_config()
+        self.schedule_prepare_next()
+
+    def set_crossfade(self, seconds):
+        self.crossfade = seconds
+        self.save_config()
+        if self.playing and not self.paused:
+            self.schedule_tick()
+
+    def track_gain(self, index):
+        # (gain in dB, peak) for a track, or None.
+        if self.normalization == "off" or index is None or index >= len(self.tracks):
+            return None
+        return self.tracks.gain(index, album=self.normalization == "album")
+
+    def effective_volume(self, index):
+        gain = self.track_gain(index)
+        if gain is None:
+            return self.volume
+        gain_db, peak = gain
+        factor = 10 ** (gain_db / 20)
+        if peak > 0:
+            # Never push the peak past full scale.
+            factor = min(factor, 1 / peak)
+        # The mixer can only attenuate, so boosts stop at full volume.
+        return min(1.0, self.volume * factor)
+
+    def apply_volume(self):
+        if not self.audio_ready:
+            return
+        volume = self.effective_volume(self.current_index)
+        if self.output_effects:
+            self.effects.set_volume(volume)
+        else:
+            pygame.mixer.music.set_volume(volume)
+
+    def set_volume(self, volume):
+        self.volume = max(0.0, min(1.0, volume))
+        self.apply_volume()
+        self.save_session()
+
+    def set_normalization(self, mode):
+        if mode not in self.NORMALIZATION_MODES:
+            raise ValueError(f"normalization must be one of {', '.join(self.NORMALIZATION_MODES)}")
+        self.normalization = mode
+        self.save_config()
+        self.apply_volume()
+        self.analyze_loudness()
+
+    def set_shuffle(self, mode):
+        if mode not in self.SHUFFLE_MODES:
+            raise ValueError(f"shuffle must be one of {', '.join(self.SHUFFLE_MODES)}")
+        self.shuffle_mode = mode
+        self.shuffle = None
+        self.save_config()
+        self.on_queue_changed(None)
+
+    def set_shuffle_scope(self, indices):
+        # indices: the ids the library list shows (ascending), or None for
+        # all. Only the gapless pick is redone right away, and that after
+        # the usual short delay, so typing in the search box stays cheap.
+        if indices is None and self.shuffle_scope is None:
+            # Still the whole library; a grown library is picked up by the
+            # shuffle itself.
+            return
+        self.shuffle_scope = indices
+        if self.shuffle is not None:
+            self.shuffle.set_scope(indices)
+            self.schedule_prepare_next()
+
+    def set_effects(self, enabled):
+        self.effects_enabled = enabled
+        self.save_config()
+        if self.playing and self.current_index is not None and self.output_effects != enabled:
+            # Carries on from the same spot through the other output.
+            self.play_file(self.current_index, self.position())
+
+    def set_eq(self, gains):
+        self.eq = [float(g) for g in gains]
+        self.save_config()
+        if self.effects:
+            self.effects.chain.equalizer.set_gains(self.eq)
+
+    def set_balance(self, balance):
+        self.balance = max(-1.0, min(1.0, balance))
+        self.save_config()
+        if self.effects:
+            self.effects.chain.set_balance(self.balance)
+
+    def set_limiter(self, enabled):
+        self.limiter = enabled
+        self.save_config()
+        if self.effects:
+            self.effects.chain.limiter.enabled = enabled
+
+    def get_shuffle(self):
+        if self.shuffle_mode == "off":
+            return None
+        if self.shuffle is None or self.shuffle.tracks is not self.tracks:
+            counts = self.play_counts() if self.shuffle_mode == "smart" else None
+            self.shuffle = Shuffle(self.tracks, self.shuffle_mode, self.shuffle_scope, counts,
+                                   current=self.current_index)
+        return self.shuffle
+
+    def play_counts(self):
+        # {track id: times played} for the loaded folder.
+        counts = {}
+        if not self.last_folder:
+            return counts
+        try:
+            plays = self.metadata_cache.lookup_plays(self.last_folder)
+        except Exception as e:
+            print(f"Could not read play counts: {e}")
+            return counts
+        for file_path, count in plays.items():
+            index = self.tracks.find(file_path)
+            if index is not None:
+                counts[index] = count
+        return counts
+
+    def record_play(self, index):
+        try:
+            self.metadata_cache.record_play(self.tracks.path(index))
+        except Exception as e:
+            print(f"Could not record play: {e}")
+
+    def pause(self):
+        if self.playing and not self.paused:
+            if self.output_effects:
+                self.effects.pause()
+            else:
+                pygame.mixer.music.pause()
+            self.paused = True
+            self.clock.pause()
+            self.loop.cancel("tick")
+            self.emit("paused")
+            self.save_session()
+
+    def resume(self):
+        if self.playing and self.paused:
+            if self.output_effects:
+                self.effects.resume()
+            else:
+                pygame.mixer.music.unpause()
+            self.paused = False
+            self.clock.resume()
+            self.schedule_tick()
+            self.emit("resumed")
+            self.save_session()
+
+    def pause_resume(self):
+        if self.paused:
+            self.resume()
+        else:
+            self.pause()
+
+    def stop(self):
+        self.play_generation += 1
+        self.preloader.cancel()
+        if self.audio_ready:
+            pygame.mixer.music.stop()
+            discard_end_events()
+        if self.effects:
+            self.effects.stop()
+        self.playing = False
+        self.paused = False
+        self.clock.reset()
+        self.loop.cancel("tick")
+        self.emit("stopped")
+        self.save_session()
+
+    def on_queue_changed(self, change):
+        # Only the pre-buffers may need to follow a new queue head.
+        if self.playing:
+            self.buffer_neighbours()
+        self.schedule_prepare_next()
+        self.session_queue = None
+        self.save_session()
+
+    def enqueue(self, index, front=False):
+        if front:
+            self.queue.insert(0, index)
+        else:
+            self.queue.append(index)
+
+    def sort_queue(self, keys=("artist", "album", "tracknumber", "name")):
+        self.queue.replace(self.tracks.sorted(self.queue, keys))
+
+    def next_track(self):
+        shuffle = self.get_shuffle()
+        if self.queue:
+            next_index = self.queue.popleft()
+        elif shuffle is not None:
+            next_index = shuffle.next()
+        elif self.current_index is not None and self.tracks:
+            next_index = (self.current_index + 1) % len(self.tracks)
+        else:
+            next_index = None
+        if next_index is None:
+            return
+        self.play_file(next_index)
+
+    def previous_track(self):
+        if self.current_index is None or not self.tracks:
+            return
+        shuffle = self.get_shuffle()
+        if shuffle is not None:
+            # Back through what was actually played.
+            prev_index = shuffle.previous()
+            if prev_index is None:
+                return
+        else:
+            prev_index = (self.current_index - 1) % len(self.tracks)
+        self.play_file(prev_index)
+
+    def position(self):
+        return min(self.clock.position(), self.song_length)
+
+    def seek(self, pos):
+        if not self.playing or self.current_index is None or self.song_length <= 0:
+            return
+        file_path = self.tracks.path(self.current_index)
+        pos = max(0.0, min(pos, self.song_length))
+        if self.output_effects:
+            # Decoded already; the next block simply starts at pos.
+            actual, reopened = self.effects.seek(pos), False
+        else:
+            buffer = self.buffers.get(file_path)
+            if buffer is None:
+                reader = self.buffers.reader(file_path)
+                if reader is not None and not reader.direct:
+                    buffer = reader
+                file_path = self.buffers.local_path(file_path)
+            try:
+                actual, reopened = seek_music(file_path, pos, self.seek_indexes, buffer)
+            except Exception as e:
+                self.message(f"Seek failed: {e}", 3)
+                return
+        if reopened:
+            # load() drops whatever was queued for gapless playback.
+            self.preloader.cancel()
+            discard_end_events()
+            if self.paused:
+                pygame.mixer.music.pause()
+        self.clock.start(actual)
+        self.end_retry = self.END_RETRY
+        if self.paused:
+            self.clock.pause()
+        self.fading = False
+        self.emit("position", actual)
+        if not self.paused:
+            self.schedule_tick()
+        self.schedule_prepare_next()
+        self.save_session()
+
+    def schedule_tick(self):
+        # Only runs while something is actually playing; pause and stop
+        # cancel it, so an idle player never wakes up.
+        delay = self.TICK_INTERVAL
+        remaining = self.song_length - self.clock.position()
+        if self.preloader.index is not None and not self.fading:
+            remaining -= self.crossfade
+        if 0 < remaining < delay:
+            delay = remaining + 0.005
+        elif remaining <= 0:
+            # The clock runs a little ahead of what the device has played.
+            delay = self.end_retry
+            self.end_retry = min(self.end_retry * 2, self.TICK_INTERVAL)
+        self.loop.call_later("tick", delay, self.playback_tick)
+
+    def playback_tick(self):
+        if not self.playing or self.paused:
+            return
+        if self.track_ended():
+            if self.preloader.index is not None and self.output_busy():
+                self.advance_to_preloaded()
+            else:
+                self.next_track()
+            return
+        current = self.position()
+        if (self.crossfade > 0 and not self.fading and self.preloader.index is not None
+                and self.song_length - current <= self.crossfade):
+            # pygame has a single music stream, so the "crossfade" fades the
+            # outgoing track out; the queued one starts when the fade ends.
+            self.fading = True
+            if self.output_effects:
+                self.effects.fadeout(self.song_length - current)
+            else:
+                pygame.mixer.music.fadeout(max(1, int((self.song_length - current) * 1000)))
+        if self.song_length > 0:
+            self.emit("position", current)
+        if time.monotonic() - self.session_saved >= self.POSITION_SAVE_INTERVAL:
+            self.save_session()
+        self.schedule_tick()
+
+    def status(self):
+        if not self.playing:
+            state = "stopped"
+        elif self.paused:
+            state = "paused"
+        else:
+            state = "playing"
+        status = {
+            "state": state,
+            "volume": self.volume,
+            "tracks": len(self.tracks),
+            "queue": len(self.queue),
+            "folder": self.last_folder,
+            "normalization": self.normalization,
+            "shuffle": self.shuffle_mode,
+            "effects": self.effects_enabled,
+        }
+        index = self.current_index
+        if index is not None and index < len(self.tracks):
+            status.update(index=index, path=self.tracks.path(index),
+                          title=self.tracks.name(index), length=self.tracks.length(index),
+                          position=round(self.position(), 3) if self.playing else 0.0)
+            gain = self.track_gain(index)
+            if gain is not None:
+                status["gain_db"] = round(gain[0], 2)
+        return status
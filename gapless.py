@@ -0,0 +1,81 @@
+import io
+import os
+import threading
+
+
+class NextTrackPreloader:
+    # Reads the upcoming track into memory on a worker thread and hands it
+    # back through post() so pygame.mixer.music.queue() runs on the Tk
+    # thread. SDL_mixer opens the queued stream right away and starts it
+    # from its own end-of-music callback, so the switch happens inside the
+    # audio thread with no reload in between. With a track_buffers cache,
+    # the track is read through it instead: one it already holds is not
+    # read again, and others are queued as soon as their read-ahead can
+    # start playing. queue_stream(stream, namehint), when given, replaces
+    # pygame.mixer.music.queue() as the output the stream is handed to.
+
+    def __init__(self, post, buffers=None, queue_stream=None):
+        self.post = post
+        self.buffers = buffers
+        self.queue_stream = queue_stream
+        self.generation = 0
+        self.index = None
+        self.path = None
+        self.pending = None
+
+    def request(self, index, path, on_queued=None):
+        if index == self.index and path == self.path:
+            return
+        self.cancel()
+        self.pending = (index, path)
+        generation = self.generation
+        if self.buffers is not None:
+            buffer = self.buffers.get(path)
+            if buffer is not None:
+                self.post(self._queue, generation, index, path, buffer, on_queued)
+            else:
+                self.buffers.fetch(path, lambda reader: self.post(self._queue, generation, index, path,
+                                                                  reader, on_queued))
+            return
+        threading.Thread(target=self._read, args=(generation, index, path, on_queued),
+                         daemon=True).start()
+
+    def cancel(self):
+        # pygame cannot un-queue; a stale queued stream is simply replaced
+        # by the next queue() or dropped by the next load()/stop().
+        self.generation += 1
+        self.index = None
+        self.path = None
+        self.pending = None
+
+    def _read(self, generation, index, path, on_queued):
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+        except OSError as e:
+            print(f"Could not pre-buffer {path}: {e}")
+            return
+        self.post(self._queue, generation, index, path, data, on_queued)
+
+    def _queue(self, generation, index, path, source, on_queued):
+        # source: the file's bytes, a track buffer or a read-ahead reader.
+        if generation != self.generation:
+            return
+        import pygame
+        self.pending = None
+        try:
+            if getattr(source, "error", None) is not None:
+                raise OSError(source.error)
+            stream = io.BytesIO(source) if isinstance(source, bytes) else source.open()
+            namehint = os.path.splitext(path)[1].lstrip(".")
+            if self.queue_stream is not None:
+                self.queue_stream(stream, namehint)
+            else:
+                pygame.mixer.music.queue(stream, namehint=namehint)
+        except Exception as e:
+            print(f"Could not queue {path}: {e}")
+            return
+        self.index = index
+        self.path = path
+        if on_queued:
+            on_queued(index)
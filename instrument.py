@@ -0,0 +1,186 @@
+import json
+import math
+import os
+import threading
+import time
+
+
+# Timers, counters and an optional Chrome trace for the hot paths. Off by
+# default: callers check `instrument.enabled` (or only wrap methods when it
+# is set), so a normal run pays nothing beyond that flag.
+
+enabled = False
+trace_path = None
+histograms = {}
+counters = {}
+gauges = {}
+trace_events = []
+lock = threading.Lock()
+MAX_TRACE_EVENTS = 500000
+ORIGIN = time.perf_counter()
+
+now = time.perf_counter
+
+
+class Histogram:
+    # Log-scale buckets, four per octave of microseconds: O(1) add, a few
+    # dozen ints of memory, and percentiles within about 20%.
+
+    PER_OCTAVE = 4
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = 0.0
+
+    def add(self, seconds):
+        us = seconds * 1e6
+        bucket = int(math.log2(us) * self.PER_OCTAVE) if us > 1 else 0
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if self.min is None or seconds < self.min:
+            self.min = seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        if not self.count:
+            return 0.0
+        target = self.count * p / 100
+        running = 0
+        for bucket in sorted(self.buckets):
+            running += self.buckets[bucket]
+            if running >= target:
+                upper = 2 ** ((bucket + 1) / self.PER_OCTAVE) / 1e6
+                return max(self.min, min(self.max, upper))
+        return self.max
+
+
+def enable(trace=None):
+    global enabled, trace_path
+    enabled = True
+    trace_path = trace
+
+
+def add(name, seconds):
+    with lock:
+        histogram = histograms.get(name)
+        if histogram is None:
+            histogram = histograms[name] = Histogram()
+        histogram.add(seconds)
+
+
+def record(name, start, end=None, **args):
+    # A timed span: goes into the histogram and, with tracing on, into the
+    # trace as a complete ("X") event.
+    if end is None:
+        end = now()
+    add(name, end - start)
+    if trace_path and len(trace_events) < MAX_TRACE_EVENTS:
+        event = {"name": name, "ph": "X", "pid": os.getpid(), "tid": threading.get_ident(),
+                 "ts": (start - ORIGIN) * 1e6, "dur": (end - start) * 1e6}
+        if args:
+            event["args"] = args
+        trace_events.append(event)
+
+
+def count(name, n=1):
+    with lock:
+        counters[name] = counters.get(name, 0) + n
+
+
+def gauge(name, value):
+    gauges[name] = value
+
+
+def wrap(obj, *names, prefix=""):
+    # Replaces obj.<name> with a timed wrapper on the instance. Call it
+    # before the methods are handed out as callbacks.
+    for name in names:
+        method = getattr(obj, name)
+
+        def timed(*args, _method=method, _name=prefix + name, **kwargs):
+            start = now()
+            try:
+                return _method(*args, **kwargs)
+            finally:
+                record(_name, start)
+
+        setattr(obj, name, timed)
+
+
+def dispatched(post, name, func):
+    # A callable for another thread that posts func to the loop; when
+    # enabled it also records the time from the post until func returns.
+    if not enabled:
+        return lambda: post(func)
+
+    def run(posted):
+        try:
+            func()
+        finally:
+            record(name, posted)
+
+    return lambda: post(run, now())
+
+
+def poll_until(loop, name, start, ready, interval=0.002, timeout=2.0):
+    # Records the time from start until ready() first returns true,
+    # checking every interval seconds on the loop.
+    def check():
+        if ready():
+            record(name, start)
+        elif now() - start < timeout:
+            loop.call_later(name, interval, check)
+        else:
+            count(name + ".timeout")
+
+    loop.call_later(name, interval, check)
+
+
+def snapshot():
+    with lock:
+        timers = {
+            name: {
+                "count": h.count,
+                "mean_ms": h.total / h.count * 1000 if h.count else 0.0,
+                "p50_ms": h.percentile(50) * 1000,
+                "p95_ms": h.percentile(95) * 1000,
+                "p99_ms": h.percentile(99) * 1000,
+                "max_ms": h.max * 1000,
+            }
+            for name, h in histograms.items()
+        }
+        return {"timers": timers, "counters": dict(counters), "gauges": dict(gauges)}
+
+
+def summary():
+    data = snapshot()
+    lines = [f"{'timer':34} {'count':>7} {'mean':>9} {'p50':>9} {'p95':>9} {'p99':>9} {'max':>9}  (ms)"]
+    for name, t in sorted(data["timers"].items()):
+        lines.append(f"{name:34} {t['count']:7d} {t['mean_ms']:9.2f} {t['p50_ms']:9.2f} "
+                     f"{t['p95_ms']:9.2f} {t['p99_ms']:9.2f} {t['max_ms']:9.2f}")
+    for name, value in sorted(data["counters"].items()):
+        lines.append(f"{name:34} {value:7d}")
+    for name, value in sorted(data["gauges"].items()):
+        lines.append(f"{name:34} {value:.1f}")
+    return "\n".join(lines)
+
+
+def write_trace(path):
+    with open(path, "w") as f:
+        json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+
+
+def dump():
+    # Called on exit when enabled.
+    print(summary())
+    if trace_path:
+        try:
+            write_trace(trace_path)
+            print(f"Trace written to {trace_path} ({len(trace_events)} events)")
+        except OSError as e:
+            print(f"Could not write trace: {e}")
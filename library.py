@@ -0,0 +1,334 @@
+import os
+import select
+import struct
+import sys
+import threading
+import time
+
+from probe import probe_file
+from scanner import AUDIO_EXTENSIONS
+
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_NONBLOCK = os.O_NONBLOCK
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+              | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class DirState:
+    __slots__ = ("mtime", "files", "subdirs")
+
+    def __init__(self, mtime, files, subdirs):
+        self.mtime = mtime
+        self.files = files
+        self.subdirs = subdirs
+
+
+def list_dir(path):
+    # One os.scandir pass: audio files with their stat, and subdirectories.
+    files = {}
+    subdirs = set()
+    with os.scandir(path) as it:
+        for entry in it:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    subdirs.add(entry.name)
+                elif entry.name.lower().endswith(AUDIO_EXTENSIONS) and entry.is_file():
+                    st = entry.stat()
+                    files[entry.name] = (st.st_size, st.st_mtime_ns)
+            except OSError:
+                continue
+    return DirState(os.stat(path).st_mtime_ns, files, subdirs)
+
+
+class LibrarySnapshot:
+    def __init__(self, root):
+        self.root = root
+        self.dirs = {}
+
+    def scan(self, path=None):
+        # Walks path (default: the whole tree) and records it. Returns the
+        # directories that were added.
+        added = []
+        stack = [path or self.root]
+        while stack:
+            current = stack.pop()
+            try:
+                state = list_dir(current)
+            except OSError:
+                continue
+            self.dirs[current] = state
+            added.append(current)
+            stack.extend(os.path.join(current, name) for name in state.subdirs)
+        return added
+
+    def entries(self):
+        # (path, size, mtime) for every file, sorted by path.
+        result = []
+        for dir_path in sorted(self.dirs):
+            for name, (size, mtime) in sorted(self.dirs[dir_path].files.items()):
+                result.append((os.path.join(dir_path, name), size, mtime))
+        return result
+
+    def drop(self, dir_path):
+        # Forgets dir_path and everything below it; returns the file
+        # entries that went with it.
+        removed = []
+        prefix = os.path.join(dir_path, "")
+        for path in [d for d in self.dirs if d == dir_path or d.startswith(prefix)]:
+            state = self.dirs.pop(path)
+            removed.extend((os.path.join(path, n), *stat) for n, stat in state.files.items())
+        return removed
+
+    def changed_dirs(self):
+        # mtime-diff fallback: one stat per known directory.
+        changed = []
+        for dir_path, state in list(self.dirs.items()):
+            try:
+                if os.stat(dir_path).st_mtime_ns != state.mtime:
+                    changed.append(dir_path)
+            except OSError:
+                changed.append(dir_path)
+        return changed
+
+    def refresh(self, dir_paths):
+        # Re-lists only dir_paths. Returns (added, removed, new_dirs) where
+        # added/removed are (path, size, mtime) entries.
+        added = []
+        removed = []
+        new_dirs = []
+        for dir_path in dir_paths:
+            old = self.dirs.get(dir_path)
+            if old is None:
+                continue
+            try:
+                state = list_dir(dir_path)
+            except OSError:
+                removed.extend(self.drop(dir_path))
+                continue
+            self.dirs[dir_path] = state
+            for name, stat in state.files.items():
+                if old.files.get(name) != stat:
+                    added.append((os.path.join(dir_path, name), *stat))
+            for name, stat in old.files.items():
+                if state.files.get(name) != stat:
+                    removed.append((os.path.join(dir_path, name), *stat))
+            for name in state.subdirs - old.subdirs:
+                sub = os.path.join(dir_path, name)
+                if sub in self.dirs:
+                    continue
+                for d in self.scan(sub):
+                    new_dirs.append(d)
+                    added.extend((os.path.join(d, n), *stat)
+                                 for n, stat in self.dirs[d].files.items())
+            for name in old.subdirs - state.subdirs:
+                removed.extend(self.drop(os.path.join(dir_path, name)))
+        return added, removed, new_dirs
+
+
+class InotifyWatch:
+    # Minimal ctypes binding to Linux inotify. Raises OSError when it is
+    # not available so callers can fall back to mtime polling.
+
+    def __init__(self):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on Linux")
+        import ctypes
+        import ctypes.util
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        self.ctypes = ctypes
+        self.fd = self.libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.watches = {}
+
+    def add(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path), WATCH_MASK)
+        if wd < 0:
+            errno = self.ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno), path)
+        self.watches[wd] = path
+
+    def read(self, timeout):
+        # Returns (changed directories, overflowed).
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if not ready:
+            return set(), False
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return set(), False
+        changed = set()
+        overflow = False
+        offset = 0
+        while offset + EVENT_HEADER.size <= len(data):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            path = self.watches.get(wd)
+            if path is None:
+                continue
+            if mask & IN_IGNORED:
+                del self.watches[wd]
+                continue
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                changed.add(os.path.dirname(path))
+            else:
+                changed.add(path)
+        return changed, overflow
+
+    def close(self):
+        try:
+            os.close(self.fd)
+        except OSError:
+            pass
+
+
+def match_renames(added, removed):
+    # A rename keeps size and mtime, so pair removed/added entries on that.
+    # Returns (added, removed paths, renamed (old, new, size, mtime)).
+    by_stat = {}
+    for path, size, mtime in removed:
+        by_stat.setdefault((size, mtime), []).append(path)
+    renamed = []
+    still_added = []
+    for path, size, mtime in added:
+        candidates = by_stat.get((size, mtime))
+        if candidates:
+            renamed.append((candidates.pop(), path, size, mtime))
+        else:
+            still_added.append((path, size, mtime))
+    renamed_from = {r[0] for r in renamed}
+    still_removed = [path for path, _, _ in removed if path not in renamed_from]
+    return still_added, still_removed, renamed
+
+
+class LibraryWatcher:
+    # Keeps a snapshot of a folder tree and reports changes to it. Uses
+    # inotify where available and otherwise diffs directory mtimes every
+    # poll_interval seconds. Only the directories that changed are
+    # re-listed, and only new or modified files are probed.
+
+    def __init__(self, post, metadata_cache, on_ready, on_change,
+                 poll_interval=5.0, settle_delay=1.0):
+        self.post = post
+        self.metadata_cache = metadata_cache
+        self.on_ready = on_ready
+        self.on_change = on_change
+        self.poll_interval = poll_interval
+        self.settle_delay = settle_delay
+        self.snapshot = None
+        self.stop_event = None
+        self.thread = None
+
+    def watch(self, folder):
+        self.stop()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(folder, self.stop_event), daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.stop_event:
+            self.stop_event.set()
+        self.stop_event = None
+        self.thread = None
+
+    def _post(self, stop_event, func, *args):
+        if not stop_event.is_set():
+            self.post(lambda: stop_event.is_set() or func(*args))
+
+    def _run(self, folder, stop_event):
+        snapshot = LibrarySnapshot(folder)
+        snapshot.scan()
+        self.snapshot = snapshot
+        self._post(stop_event, self.on_ready, folder, snapshot.entries())
+
+        inotify = None
+        try:
+            inotify = InotifyWatch()
+            for dir_path in snapshot.dirs:
+                inotify.add(dir_path)
+        except OSError as e:
+            print(f"inotify unavailable, polling for changes: {e}")
+            if inotify:
+                inotify.close()
+            inotify = None
+
+        try:
+            while not stop_event.is_set():
+                if inotify:
+                    dirty, overflow = inotify.read(self.poll_interval)
+                    if not dirty and not overflow:
+                        continue
+                    # Let a copy in progress settle before re-listing.
+                    deadline = time.monotonic() + self.settle_delay
+                    while time.monotonic() < deadline and not stop_event.is_set():
+                        more, more_overflow = inotify.read(self.settle_delay)
+                        dirty |= more
+                        overflow = overflow or more_overflow
+                    if overflow:
+                        dirty |= set(snapshot.changed_dirs())
+                else:
+                    if stop_event.wait(self.poll_interval):
+                        break
+                    dirty = set(snapshot.changed_dirs())
+                if not dirty or stop_event.is_set():
+                    continue
+                added, removed, new_dirs = snapshot.refresh(sorted(dirty))
+                if inotify:
+                    for dir_path in new_dirs:
+                        try:
+                            inotify.add(dir_path)
+                        except OSError:
+                            pass
+                if added or removed:
+                    self._apply(stop_event, added, removed)
+        finally:
+            if inotify:
+                inotify.close()
+
+    def _apply(self, stop_event, added, removed):
+        added, removed, renamed = match_renames(added, removed)
+        # A file rewritten in place shows up as removed + added; report it
+        # only as added so the player updates the existing row.
+        added_paths = {path for path, _, _ in added}
+        removed = [path for path in removed if path not in added_paths]
+        probed = []
+        fresh = []
+        for old, new, size, mtime in renamed:
+            cached = self.metadata_cache.lookup(old, size, mtime)
+            if cached:
+                fresh.append((new, size, mtime, *cached))
+        for path, size, mtime in added:
+            if stop_event.is_set():
+                return
+            cached = self.metadata_cache.lookup(path, size, mtime)
+            if cached:
+                length, tags = cached
+            else:
+                try:
+                    length, tags = probe_file(path)
+                except Exception as e:
+                    print(f"Error loading {path}: {e}")
+                    continue
+                fresh.append((path, size, mtime, length, tags))
+            probed.append((path, length, tags))
+        try:
+            self.metadata_cache.store_many(fresh)
+        except Exception as e:
+            print(f"Metadata cache update failed: {e}")
+        self._post(stop_event, self.on_change, probed, removed,
+                   [(old, new) for old, new, _, _ in renamed])
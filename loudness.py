@@ -0,0 +1,358 @@
+import math
+import os
+import threading
+import wave
+
+import numpy as np
+
+from scanner import ScanToken
+
+
+# ReplayGain 2.0 style loudness normalization. A track's loudness is
+# measured as in EBU R128 / ITU-R BS.1770: K-weighted mean square over
+# 400 ms blocks with 75% overlap, gated at -70 LUFS and then 10 LU below
+# the ungated level. Gains bring tracks to REFERENCE_LUFS. ReplayGain
+# tags already in the file are used as they are and skip the decode.
+
+REFERENCE_LUFS = -18.0
+ANALYSIS_RATE = 44100
+SEGMENT_SECONDS = 0.1
+SEGMENTS_PER_BLOCK = 4
+SEGMENTS_PER_CHUNK = 600
+# SDL_mixer decodes compressed files whole; longer ones are left at the
+# slider volume.
+MAX_ANALYSIS_SECONDS = 30 * 60
+# Each worker holds a decoded track; more of them would only trade memory
+# for a little speed next to playback.
+MAX_WORKERS = 2
+
+
+def _biquad_power(b, a, w):
+    z = np.exp(-1j * w)
+    num = b[0] + b[1] * z + b[2] * z * z
+    den = a[0] + a[1] * z + a[2] * z * z
+    return np.abs(num) ** 2 / np.abs(den) ** 2
+
+
+def k_weighting(rate, size):
+    # |H|^2 of the BS.1770 pre-filter (high shelf + RLB high-pass) at
+    # the rfft bins of a size-sample segment, with coefficients derived
+    # for this sample rate rather than the 48 kHz table.
+    w = 2 * np.pi * np.fft.rfftfreq(size, 1.0 / rate) / rate
+    k = math.tan(math.pi * 1681.974450955533 / rate)
+    q = 0.7071752369554196
+    vh = 10 ** (3.999843853973347 / 20)
+    vb = vh ** 0.4996667741545416
+    shelf = _biquad_power((vh + vb * k / q + k * k, 2 * (k * k - vh), vh - vb * k / q + k * k),
+                          (1 + k / q + k * k, 2 * (k * k - 1), 1 - k / q + k * k), w)
+    k = math.tan(math.pi * 38.13547087602444 / rate)
+    q = 0.5003270373238773
+    a0 = 1 + k / q + k * k
+    highpass = _biquad_power((1.0, -2.0, 1.0), (1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0), w)
+    return shelf * highpass
+
+
+def segment_energy(samples, rate):
+    # samples: (frames, channels) float. Returns the K-weighted energy of
+    # each 100 ms segment summed over channels. The filter is applied as a
+    # weighting of each segment's power spectrum (Parseval), a whole chunk
+    # of segments per rfft call.
+    size = int(rate * SEGMENT_SECONDS)
+    count = len(samples) // size
+    if not count:
+        return np.zeros(0)
+    weights = k_weighting(rate, size)
+    # rfft bins other than DC (and Nyquist for even sizes) stand for two.
+    weights[1:(size + 1) // 2] *= 2
+    energy = np.zeros(count)
+    for start in range(0, count, SEGMENTS_PER_CHUNK):
+        stop = min(count, start + SEGMENTS_PER_CHUNK)
+        chunk = samples[start * size:stop * size].reshape(stop - start, size, -1)
+        spectrum = np.fft.rfft(chunk, axis=1)
+        power = spectrum.real ** 2 + spectrum.imag ** 2
+        energy[start:stop] = np.einsum("skc,k->s", power, weights) / size
+    return energy
+
+
+def gated_blocks(energy, rate):
+    # Mean square of each 400 ms block (hop 100 ms), gated as in R128.
+    # Returns the gated block powers.
+    if len(energy) < SEGMENTS_PER_BLOCK:
+        return np.zeros(0)
+    size = int(rate * SEGMENT_SECONDS)
+    sums = np.convolve(energy, np.ones(SEGMENTS_PER_BLOCK), mode="valid")
+    blocks = sums / (size * SEGMENTS_PER_BLOCK)
+    blocks = blocks[blocks > 10 ** ((-70 + 0.691) / 10)]
+    if not len(blocks):
+        return blocks
+    relative = blocks.mean() * 10 ** (-10 / 10)
+    return blocks[blocks > relative]
+
+
+def loudness(power):
+    return -0.691 + 10 * math.log10(power)
+
+
+def gain_for(power):
+    return REFERENCE_LUFS - loudness(power)
+
+
+def _tag_float(tags, key):
+    try:
+        value = tags.get(key)
+    except Exception:
+        return None
+    if not value:
+        return None
+    text = str(value[0] if isinstance(value, list) else value)
+    try:
+        return float(text.lower().replace("db", "").strip())
+    except ValueError:
+        return None
+
+
+def read_replaygain(file_path):
+    # (track gain, track peak, album gain, album peak) from tags, any of
+    # them None; None when the file has no track gain.
+    from mutagen import File as MutagenFile
+    try:
+        audio = MutagenFile(file_path, easy=True)
+    except Exception:
+        return None
+    if audio is None or audio.tags is None:
+        return None
+    tags = audio.tags
+    track_gain = _tag_float(tags, "replaygain_track_gain")
+    if track_gain is None:
+        return None
+    return (track_gain, _tag_float(tags, "replaygain_track_peak"),
+            _tag_float(tags, "replaygain_album_gain"), _tag_float(tags, "replaygain_album_peak"))
+
+
+def _init_worker():
+    # Analysis runs beside playback; keep it off the audio device and
+    # behind everything else for the CPU. Workers are spawned, so they
+    # start without the player's mixer and decode at ANALYSIS_RATE.
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+
+
+def decode(file_path):
+    # Returns (rate, blocks): blocks yields the audio as float (frames,
+    # channels) arrays of one chunk of segments each, so a track is never
+    # held as floats whole. 16-bit WAV is read from the file a block at a
+    # time; anything else is decoded by SDL_mixer and converted a block at
+    # a time from the decoded samples in place.
+    if file_path.lower().endswith(".wav"):
+        try:
+            wav = wave.open(file_path, "rb")
+        except (wave.Error, EOFError):
+            wav = None
+        if wav is not None and wav.getsampwidth() == 2:
+            rate = wav.getframerate()
+            return rate, _wav_blocks(wav, _block_frames(rate))
+        if wav is not None:
+            wav.close()
+    import pygame
+    if not pygame.mixer.get_init():
+        pygame.mixer.init(frequency=ANALYSIS_RATE, size=-16, channels=2)
+    rate = pygame.mixer.get_init()[0]
+    sound = pygame.mixer.Sound(file_path)
+    return rate, _sound_blocks(sound, _block_frames(rate))
+
+
+def _block_frames(rate):
+    return int(rate * SEGMENT_SECONDS) * SEGMENTS_PER_CHUNK
+
+
+def _wav_blocks(wav, frames):
+    with wav:
+        channels = wav.getnchannels()
+        while True:
+            data = wav.readframes(frames)
+            data = data[:len(data) - len(data) % (2 * channels)]
+            if not data:
+                return
+            yield np.frombuffer(data, "<i2").reshape(-1, channels).astype(np.float32) / 32768.0
+
+
+def _sound_blocks(sound, frames):
+    import pygame
+    samples = pygame.sndarray.samples(sound)
+    if samples.ndim == 1:
+        samples = samples[:, None]
+    for start in range(0, len(samples), frames):
+        yield samples[start:start + frames].astype(np.float32) / 32768.0
+
+
+def analyze_file(file_path):
+    # Returns (path, track gain, track peak, album gain, album peak,
+    # gated power, gated blocks, error). Power and blocks are what album
+    # gains are computed from; they are NaN/0 when the gain came from tags.
+    try:
+        tagged = read_replaygain(file_path)
+        if tagged is not None:
+            return (file_path, *tagged, math.nan, 0, None)
+        rate, decoded = decode(file_path)
+        # Blocks are whole segments long, so only the last one may end in
+        # a partial segment, which segment_energy leaves out.
+        peak = 0.0
+        energy = []
+        for samples in decoded:
+            if len(samples):
+                peak = max(peak, float(np.abs(samples).max()))
+            energy.append(segment_energy(samples, rate))
+        energy = np.concatenate(energy) if energy else np.zeros(0)
+        blocks = gated_blocks(energy, rate)
+        if not len(blocks):
+            return file_path, None, peak, None, None, math.nan, 0, None
+        power = float(blocks.mean())
+        return file_path, gain_for(power), peak, None, None, power, len(blocks), None
+    except Exception as e:
+        return file_path, None, None, None, None, math.nan, 0, str(e)
+
+
+def album_gains(results, album_of):
+    # results: {path: (track gain, track peak, album gain, album peak,
+    # power, blocks)}; album_of: {path: album key}. An album's loudness
+    # is the block-weighted mean of its tracks' gated powers, which is the
+    # album's gated mean when every track has the same relative gate.
+    # Returns {path: (album gain, album peak)}.
+    albums = {}
+    for path, key in album_of.items():
+        entry = results.get(path)
+        if entry is None:
+            continue
+        total = albums.setdefault(key, [0.0, 0, 0.0])
+        _, peak, _, _, power, blocks = entry
+        if blocks and not math.isnan(power):
+            total[0] += power * blocks
+            total[1] += blocks
+        if peak:
+            total[2] = max(total[2], peak)
+    gains = {}
+    for path, key in album_of.items():
+        entry = results.get(path)
+        if entry is None:
+            continue
+        if entry[2] is not None:
+            gains[path] = (entry[2], entry[3])
+            continue
+        power, blocks, peak = albums[key]
+        if blocks:
+            gains[path] = (gain_for(power / blocks), peak)
+    return gains
+
+
+class LoudnessAnalyzer:
+    # Works out gains for a folder's tracks in the background: cached
+    # results come from the metadata cache (keyed on path, size and
+    # mtime), everything else is analyzed on a process pool. Results go to
+    # the engine's thread in batches through post(), as
+    # [(path, track gain, track peak, album gain, album peak)].
+
+    def __init__(self, post, metadata_cache, on_batch, on_done, workers=None, batch_size=64):
+        self.post = post
+        self.metadata_cache = metadata_cache
+        self.on_batch = on_batch
+        self.on_done = on_done
+        self.workers = min(workers or os.cpu_count() or 1, MAX_WORKERS)
+        self.batch_size = batch_size
+        self.token = None
+        self.lock = threading.Lock()
+
+    def analyze(self, folder, recursive):
+        with self.lock:
+            if self.token:
+                self.token.cancel()
+            token = self.token = ScanToken(folder)
+        threading.Thread(target=self._run, args=(token, recursive), daemon=True).start()
+        return token
+
+    def cancel(self):
+        with self.lock:
+            if self.token:
+                self.token.cancel()
+                self.token = None
+
+    def _post(self, token, func, *args):
+        if not token.is_cancelled:
+            self.post(self._deliver, token, func, args)
+
+    def _deliver(self, token, func, args):
+        if token.is_cancelled or token is not self.token:
+            return
+        func(*args)
+
+    def _run(self, token, recursive):
+        folder = token.folder
+        base = os.path.dirname(os.path.join(folder, ""))
+        tracks = self.metadata_cache.lookup_folder(folder)
+        cached = self.metadata_cache.lookup_gains(folder)
+        results = {}
+        album_of = {}
+        misses = []
+        for path, (size, mtime, length, tags) in tracks.items():
+            if not recursive and os.path.dirname(path) != base:
+                continue
+            # Tracks without an album tag are grouped by folder.
+            album_of[path] = (os.path.dirname(path), tags.get("album", ""))
+            entry = cached.get(path)
+            if entry and entry[0] == size and entry[1] == mtime:
+                results[path] = entry[2:]
+            elif length <= MAX_ANALYSIS_SECONDS:
+                misses.append((path, size, mtime))
+
+        # Cached gains apply right away; album gains follow once every
+        # track of the folder has been measured.
+        self._post_rows(token, [(path, entry[0], entry[1], None, None)
+                                for path, entry in results.items() if entry[0] is not None])
+        if misses:
+            fresh = self._analyze(token, misses, results)
+            if fresh is None:
+                return
+            try:
+                self.metadata_cache.store_gains(fresh)
+            except Exception as e:
+                print(f"Loudness cache update failed: {e}")
+
+        albums = album_gains(results, album_of)
+        self._post_rows(token, [(path, results[path][0], results[path][1], *gain)
+                                for path, gain in albums.items() if results[path][0] is not None])
+        self._post(token, self.on_done, len(misses))
+
+    def _post_rows(self, token, rows):
+        step = self.batch_size * 16
+        for start in range(0, len(rows), step):
+            self._post(token, self.on_batch, rows[start:start + step])
+
+    def _analyze(self, token, misses, results):
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        stats = {path: (size, mtime) for path, size, mtime in misses}
+        fresh = []
+        batch = []
+        executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=_init_worker)
+        try:
+            for path, *entry, error in executor.map(analyze_file, list(stats)):
+                if token.is_cancelled:
+                    return None
+                if error is not None:
+                    print(f"Could not analyze {path}: {error}")
+                    continue
+                results[path] = tuple(entry)
+                fresh.append((path, *stats[path], *entry))
+                if entry[0] is not None:
+                    batch.append((path, entry[0], entry[1], None, None))
+                if len(batch) >= self.batch_size:
+                    self._post(token, self.on_batch, batch)
+                    batch = []
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+        if batch:
+            self._post(token, self.on_batch, batch)
+        return fresh
@@ -0,0 +1,207 @@
+import math
+import os
+import sqlite3
+import threading
+import time
+
+
+TAG_FIELDS = ("title", "artist", "album", "tracknumber")
+
+
+def tags_from_easy(easy_tags):
+    tags = {}
+    if not easy_tags:
+        return tags
+    for field in TAG_FIELDS:
+        try:
+            value = easy_tags.get(field)
+        except Exception:
+            continue
+        if value:
+            tags[field] = str(value[0] if isinstance(value, list) else value)
+    return tags
+
+
+def read_tags(file_path):
+    from mutagen import File as MutagenFile
+    try:
+        audio = MutagenFile(file_path, easy=True)
+    except Exception:
+        return {}
+    if audio is None:
+        return {}
+    return tags_from_easy(audio.tags)
+
+
+class MetadataCache:
+    # Track lengths and tags keyed on path, invalidated by size + mtime.
+    # Rows carry a last_used stamp so the table can be trimmed LRU-style
+    # down to max_entries.
+
+    def __init__(self, path, max_entries=200000):
+        self.path = path
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS tracks ("
+            " path TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL,"
+            " mtime INTEGER NOT NULL,"
+            " length REAL NOT NULL,"
+            " title TEXT, artist TEXT, album TEXT, tracknumber TEXT,"
+            " last_used REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS tracks_last_used ON tracks(last_used)")
+        # Loudness analysis results, same identity check as tracks; power
+        # and blocks feed album gains and are NULL when the gains came
+        # from ReplayGain tags.
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS gains ("
+            " path TEXT PRIMARY KEY,"
+            " size INTEGER NOT NULL,"
+            " mtime INTEGER NOT NULL,"
+            " track_gain REAL, track_peak REAL, album_gain REAL, album_peak REAL,"
+            " power REAL, blocks INTEGER NOT NULL)"
+        )
+        # How often each track was played, for smart shuffle.
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS plays ("
+            " path TEXT PRIMARY KEY,"
+            " count INTEGER NOT NULL,"
+            " last_played REAL NOT NULL)"
+        )
+        self.conn.commit()
+
+    @staticmethod
+    def _folder_range(folder):
+        prefix = os.path.join(folder, "")
+        # Every path under prefix sorts between prefix and prefix + U+10FFFF.
+        return prefix, prefix + "\U0010ffff"
+
+    def lookup_folder(self, folder):
+        low, high = self._folder_range(folder)
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT path, size, mtime, length, title, artist, album, tracknumber"
+                " FROM tracks WHERE path >= ? AND path < ?",
+                (low, high)).fetchall()
+        entries = {}
+        for path, size, mtime, length, *tag_values in rows:
+            tags = {k: v for k, v in zip(TAG_FIELDS, tag_values) if v}
+            entries[path] = (size, mtime, length, tags)
+        return entries
+
+    def lookup(self, path, size, mtime):
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT length, title, artist, album, tracknumber FROM tracks"
+                " WHERE path = ? AND size = ? AND mtime = ?",
+                (path, size, mtime)).fetchone()
+        if row is None:
+            return None
+        length, *tag_values = row
+        return length, {k: v for k, v in zip(TAG_FIELDS, tag_values) if v}
+
+    def lookup_gains(self, folder):
+        low, high = self._folder_range(folder)
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT path, size, mtime, track_gain, track_peak, album_gain, album_peak, power, blocks"
+                " FROM gains WHERE path >= ? AND path < ?",
+                (low, high)).fetchall()
+        return {path: (size, mtime, track_gain, track_peak, album_gain, album_peak,
+                       math.nan if power is None else power, blocks)
+                for path, size, mtime, track_gain, track_peak, album_gain, album_peak, power, blocks in rows}
+
+    def store_gains(self, entries):
+        # entries: iterable of (path, size, mtime, track_gain, track_peak,
+        # album_gain, album_peak, power, blocks)
+        rows = [(*entry[:7], None if math.isnan(entry[7]) else entry[7], entry[8]) for entry in entries]
+        if not rows:
+            return
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO gains"
+                " (path, size, mtime, track_gain, track_peak, album_gain, album_peak, power, blocks)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.commit()
+
+    def lookup_plays(self, folder):
+        low, high = self._folder_range(folder)
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT path, count FROM plays WHERE path >= ? AND path < ?", (low, high)).fetchall()
+        return dict(rows)
+
+    def record_play(self, path):
+        with self.lock:
+            self.conn.execute(
+                "INSERT INTO plays (path, count, last_played) VALUES (?, 1, ?)"
+                " ON CONFLICT(path) DO UPDATE SET count = count + 1, last_played = excluded.last_played",
+                (path, time.time()))
+            self.conn.commit()
+
+    def store_many(self, entries):
+        # entries: iterable of (path, size, mtime, length, tags)
+        now = time.time()
+        rows = [(path, size, mtime, length,
+                 *(tags.get(field) for field in TAG_FIELDS), now)
+                for path, size, mtime, length, tags in entries]
+        if not rows:
+            return
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO tracks"
+                " (path, size, mtime, length, title, artist, album, tracknumber, last_used)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+            self.conn.commit()
+
+    def touch_many(self, paths):
+        now = time.time()
+        with self.lock:
+            self.conn.executemany("UPDATE tracks SET last_used = ? WHERE path = ?",
+                                  ((now, p) for p in paths))
+            self.conn.commit()
+
+    def prune_folder(self, folder, existing_paths, recursive=False):
+        # Drop rows for files under folder that were not seen on the last scan.
+        cached = self.lookup_folder(folder)
+        base = os.path.dirname(os.path.join(folder, ""))
+        stale = [p for p in cached
+                 if p not in existing_paths
+                 and (recursive or os.path.dirname(p) == base)]
+        if not stale:
+            return 0
+        with self.lock:
+            self.conn.executemany("DELETE FROM tracks WHERE path = ?", ((p,) for p in stale))
+            self.conn.executemany("DELETE FROM gains WHERE path = ?", ((p,) for p in stale))
+            self.conn.executemany("DELETE FROM plays WHERE path = ?", ((p,) for p in stale))
+            self.conn.commit()
+        return len(stale)
+
+    def trim(self):
+        if not self.max_entries or self.max_entries <= 0:
+            return 0
+        with self.lock:
+            count = self.conn.execute("SELECT COUNT(*) FROM tracks").fetchone()[0]
+            excess = count - self.max_entries
+            if excess <= 0:
+                return 0
+            self.conn.execute(
+                "DELETE FROM tracks WHERE path IN"
+                " (SELECT path FROM tracks ORDER BY last_used ASC LIMIT ?)", (excess,))
+            self.conn.execute("DELETE FROM gains WHERE path NOT IN (SELECT path FROM tracks)")
+            self.conn.execute("DELETE FROM plays WHERE path NOT IN (SELECT path FROM tracks)")
+            self.conn.commit()
+        return excess
+
+    def close(self):
+        with self.lock:
+            try:
+                self.conn.commit()
+                self.conn.close()
+            except sqlite3.Error:
+                pass
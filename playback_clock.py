@@ -0,0 +1,70 @@
+import time
+
+
+# pygame is imported by the first caller (the first playback), not here.
+MUSIC_END = None
+
+
+def install_end_event():
+    # pygame only delivers events once the display module is up; no window
+    # is opened. Everything but the end-of-music event is blocked so the
+    # queue never fills with events nobody reads.
+    global MUSIC_END
+    import pygame
+    MUSIC_END = pygame.USEREVENT + 1
+    if not pygame.display.get_init():
+        pygame.display.init()
+    pygame.event.set_blocked(None)
+    pygame.event.set_allowed(MUSIC_END)
+    pygame.mixer.music.set_endevent(MUSIC_END)
+
+
+def music_ended():
+    import pygame
+    return bool(pygame.event.get(MUSIC_END))
+
+
+def discard_end_events():
+    # stop()/load() halt the current stream, which also posts the end
+    # event; drop those so they are not taken for a natural track end.
+    import pygame
+    pygame.event.clear(MUSIC_END)
+
+
+class PlaybackClock:
+    # Playback position from time.monotonic(): base is the position at the
+    # last start/seek/pause and started the monotonic time it resumed at.
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.base = 0.0
+        self.started = None
+
+    @property
+    def running(self):
+        return self.started is not None
+
+    def start(self, position=0.0):
+        self.base = position
+        self.started = time.monotonic()
+
+    def pause(self):
+        if self.started is not None:
+            self.base = self.position()
+            self.started = None
+
+    def resume(self):
+        if self.started is None:
+            self.started = time.monotonic()
+
+    def seek(self, position):
+        self.base = position
+        if self.started is not None:
+            self.started = time.monotonic()
+
+    def position(self):
+        if self.started is None:
+            return self.base
+        return self.base + (time.monotonic() - self.started)
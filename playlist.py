@@ -0,0 +1,269 @@
+import os
+import queue
+import threading
+from urllib.parse import unquote, urlparse
+
+from scanner import AUDIO_EXTENSIONS, ScanToken, _probe
+
+
+# M3U / M3U8 / PLS playlists, read and written one entry at a time so a
+# playlist of 100k entries never sits in memory as a whole. Entries are
+# (path, length, title); length is None when the playlist does not give
+# one (#EXTINF:-1), title may be None, and path is None for streams and
+# other URLs.
+
+PLAYLIST_EXTENSIONS = (".m3u", ".m3u8", ".pls")
+
+
+def _decode(raw):
+    # M3U8 is UTF-8; plain M3U is whatever the writer used, most often
+    # UTF-8 as well and otherwise a Windows code page.
+    try:
+        return raw.decode("utf-8")
+    except UnicodeDecodeError:
+        return raw.decode("cp1252", "replace")
+
+
+def _lines(f):
+    for raw in f:
+        line = _decode(raw).strip()
+        if line.startswith("\ufeff"):
+            line = line[1:]
+        if line:
+            yield line
+
+
+def resolve(entry, base):
+    # An entry as written -> an absolute local path, or None for streams
+    # and other URLs the player cannot open.
+    if "://" in entry[:12]:
+        url = urlparse(entry)
+        if url.scheme != "file":
+            return None
+        entry = unquote(url.path)
+        if os.name == "nt" and entry[:1] == "/" and entry[2:3] == ":":
+            entry = entry[1:]
+    if os.sep == "/" and "\\" in entry:
+        # Written on Windows.
+        entry = entry.replace("\\", "/")
+    entry = os.path.expanduser(entry)
+    if not os.path.isabs(entry):
+        entry = os.path.join(base, entry)
+    return os.path.normpath(entry)
+
+
+def _length(text):
+    try:
+        length = float(text)
+    except ValueError:
+        return None
+    return length if length >= 0 else None
+
+
+def iter_m3u(f, base):
+    length = title = None
+    for line in _lines(f):
+        if line.startswith("#"):
+            if line[:8].upper() == "#EXTINF:":
+                duration, _, title = line[8:].partition(",")
+                # Attributes (tvg-id="..." and the like) follow the length.
+                length = _length(duration.split(" ", 1)[0])
+                title = title.strip() or None
+            continue
+        yield resolve(line, base), length, title
+        length = title = None
+
+
+def iter_pls(f, base):
+    # FileN= starts an entry; its TitleN= and LengthN= normally follow it
+    # and are picked up until the next FileN=.
+    pending = None
+    number = None
+    for line in _lines(f):
+        key, sep, value = line.partition("=")
+        if not sep:
+            continue
+        key = key.strip().lower()
+        value = value.strip()
+        for field in ("file", "title", "length"):
+            if key.startswith(field) and key[len(field):].isdigit():
+                break
+        else:
+            continue
+        n = key[len(field):]
+        if field == "file":
+            if pending is not None:
+                yield tuple(pending)
+            pending = [resolve(value, base), None, None]
+            number = n
+        elif pending is not None and n == number:
+            if field == "title":
+                pending[2] = value or None
+            else:
+                pending[1] = _length(value)
+    if pending is not None:
+        yield tuple(pending)
+
+
+def iter_playlist(f, playlist_path):
+    base = os.path.dirname(os.path.abspath(playlist_path))
+    if playlist_path.lower().endswith(".pls"):
+        return iter_pls(f, base)
+    return iter_m3u(f, base)
+
+
+def _entry_path(path, base):
+    # Relative when the track is under the playlist's folder, so the two
+    # can be moved together.
+    if base and os.path.commonpath([base, path]) == base:
+        return os.path.relpath(path, base)
+    return path
+
+
+def write_playlist(playlist_path, entries):
+    # entries: iterable of (path, length, title), consumed as it is
+    # written. Goes to a temporary file first, so a failed export leaves
+    # any earlier playlist in place. Returns the number of entries.
+    playlist_path = os.path.abspath(playlist_path)
+    base = os.path.dirname(playlist_path)
+    pls = playlist_path.lower().endswith(".pls")
+    tmp = playlist_path + ".tmp"
+    count = 0
+    try:
+        with open(tmp, "w", encoding="utf-8", errors="surrogateescape", newline="\n") as f:
+            f.write("[playlist]\n" if pls else "#EXTM3U\n")
+            for path, length, title in entries:
+                count += 1
+                seconds = int(round(length)) if length else -1
+                path = _entry_path(path, base)
+                if pls:
+                    f.write(f"File{count}={path}\n")
+                    if title:
+                        f.write(f"Title{count}={title}\n")
+                    f.write(f"Length{count}={seconds}\n")
+                else:
+                    f.write(f"#EXTINF:{seconds},{title or ''}\n{path}\n")
+            if pls:
+                f.write(f"NumberOfEntries={count}\nVersion=2\n")
+        os.replace(tmp, playlist_path)
+    except BaseException:
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    return count
+
+
+class PlaylistLoader:
+    # Reads a playlist on a worker thread and hands its entries to the
+    # engine's thread in batches through post(), on_batch(token, batch)
+    # with batch a list of (path, length, title), then on_done(token,
+    # count, skipped, error). Nothing is checked on disk while reading.
+    #
+    # The engine passes the paths it did not know back through check();
+    # a second thread stats them and looks up their length and tags (the
+    # metadata cache first, then a probe), reporting on_checked(token,
+    # found, missing, final) with found a list of (path, length, tags).
+    # final is True on the last call, once check(token, None) has been
+    # called and everything before it is done.
+
+    def __init__(self, post, metadata_cache, on_batch, on_done, on_checked, batch_size=512):
+        self.post = post
+        self.metadata_cache = metadata_cache
+        self.on_batch = on_batch
+        self.on_done = on_done
+        self.on_checked = on_checked
+        self.batch_size = batch_size
+        self.token = None
+        self.pending = None
+        self.lock = threading.Lock()
+
+    def load(self, playlist_path):
+        with self.lock:
+            if self.token:
+                self.token.cancel()
+                self.pending.put(None)
+            token = self.token = ScanToken(playlist_path)
+            self.pending = queue.SimpleQueue()
+        threading.Thread(target=self._read, args=(token,), daemon=True).start()
+        threading.Thread(target=self._check, args=(token, self.pending), daemon=True).start()
+        return token
+
+    def cancel(self):
+        with self.lock:
+            if self.token:
+                self.token.cancel()
+                self.pending.put(None)
+                self.token = None
+
+    def check(self, token, paths):
+        # paths: a list, or None once there will be no more.
+        if token is self.token:
+            self.pending.put(paths)
+
+    def _post(self, token, func, *args):
+        if not token.is_cancelled:
+            self.post(self._deliver, token, func, args)
+
+    def _deliver(self, token, func, args):
+        if token.is_cancelled or token is not self.token:
+            return
+        func(token, *args)
+
+    def _read(self, token):
+        playlist_path = token.folder
+        count = skipped = 0
+        batch = []
+        try:
+            with open(playlist_path, "rb") as f:
+                for entry in iter_playlist(f, playlist_path):
+                    if token.is_cancelled:
+                        return
+                    if entry[0] is None or not entry[0].lower().endswith(AUDIO_EXTENSIONS):
+                        skipped += 1
+                        continue
+                    batch.append(entry)
+                    if len(batch) >= self.batch_size:
+                        count += len(batch)
+                        self._post(token, self.on_batch, batch)
+                        batch = []
+        except OSError as e:
+            self._post(token, self.on_done, count, skipped, str(e))
+            return
+        if batch:
+            count += len(batch)
+            self._post(token, self.on_batch, batch)
+        self._post(token, self.on_done, count, skipped, None)
+
+    def _check(self, token, pending):
+        cache = self.metadata_cache
+        while not token.is_cancelled:
+            paths = pending.get()
+            if paths is None:
+                break
+            found = []
+            missing = []
+            fresh = []
+            for path in paths:
+                if token.is_cancelled:
+                    return
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    missing.append(path)
+                    continue
+                cached = cache.lookup(path, st.st_size, st.st_mtime_ns)
+                if cached is not None:
+                    found.append((path, *cached))
+                    continue
+                _, length, tags, error = _probe(path)
+                if error is None:
+                    found.append((path, length, tags))
+                    fresh.append((path, st.st_size, st.st_mtime_ns, length, tags))
+            try:
+                cache.store_many(fresh)
+            except Exception as e:
+                print(f"Metadata cache update failed: {e}")
+            self._post(token, self.on_checked, found, missing, False)
+        self._post(token, self.on_checked, [], [], True)
@@ -0,0 +1,181 @@
+import os
+import struct
+
+from metadata_cache import read_tags, tags_from_easy
+
+
+# Header probes read just enough of a file to work out its duration.
+# Each probe takes an open binary file and the path and returns either a
+# length in seconds, a (length, tags) tuple, or None when it cannot tell,
+# in which case probe_file falls back to mutagen and finally to a full
+# pygame decode. mutagen and pygame are imported where they are needed:
+# most files never reach them, and importing them up front would put
+# both on the startup path.
+PROBES = {}
+
+OGG_TAIL_BYTES = 64 * 1024
+
+
+def register_probe(*extensions):
+    def decorator(func):
+        for ext in extensions:
+            PROBES[ext.lower()] = func
+        return func
+    return decorator
+
+
+def _skip_id3v2(f):
+    header = f.read(10)
+    if len(header) == 10 and header[:3] == b"ID3":
+        size = 0
+        for b in header[6:10]:
+            size = (size << 7) | (b & 0x7F)
+        footer = 10 if header[5] & 0x10 else 0
+        f.seek(10 + size + footer)
+    else:
+        f.seek(0)
+
+
+@register_probe(".wav")
+def probe_wav(f, file_path):
+    riff = f.read(12)
+    if len(riff) < 12 or riff[:4] != b"RIFF" or riff[8:12] != b"WAVE":
+        return None
+    byte_rate = None
+    while True:
+        chunk = f.read(8)
+        if len(chunk) < 8:
+            return None
+        chunk_id, chunk_size = struct.unpack("<4sI", chunk)
+        if chunk_id == b"fmt ":
+            fmt = f.read(chunk_size)
+            if len(fmt) < 16:
+                return None
+            byte_rate = struct.unpack_from("<I", fmt, 8)[0]
+            if chunk_size & 1:
+                f.seek(1, os.SEEK_CUR)
+        elif chunk_id == b"data":
+            if not byte_rate:
+                return None
+            data_start = f.tell()
+            file_size = os.fstat(f.fileno()).st_size
+            # Streamed writers leave 0 or 0xFFFFFFFF in the size field.
+            if chunk_size == 0 or data_start + chunk_size > file_size:
+                chunk_size = file_size - data_start
+            return chunk_size / byte_rate
+        else:
+            f.seek(chunk_size + (chunk_size & 1), os.SEEK_CUR)
+
+
+@register_probe(".flac")
+def probe_flac(f, file_path):
+    _skip_id3v2(f)
+    if f.read(4) != b"fLaC":
+        return None
+    block_header = f.read(4)
+    if len(block_header) < 4 or block_header[0] & 0x7F != 0:
+        return None
+    info = f.read(34)
+    if len(info) < 34:
+        return None
+    # STREAMINFO: 20 bits sample rate, 3 bits channels, 5 bits bps,
+    # 36 bits total samples, starting at byte 10.
+    packed = int.from_bytes(info[10:18], "big")
+    sample_rate = packed >> 44
+    total_samples = packed & 0xFFFFFFFFF
+    if not sample_rate or not total_samples:
+        return None
+    return total_samples / sample_rate
+
+
+@register_probe(".ogg", ".oga", ".opus")
+def probe_ogg(f, file_path):
+    first = f.read(27)
+    if len(first) < 27 or first[:4] != b"OggS":
+        return None
+    serial = struct.unpack_from("<I", first, 14)[0]
+    segments = first[26]
+    lacing = f.read(segments)
+    packet = f.read(min(sum(lacing), 64))
+    pre_skip = 0
+    if packet[:7] == b"\x01vorbis" and len(packet) >= 16:
+        sample_rate = struct.unpack_from("<I", packet, 12)[0]
+    elif packet[:8] == b"OpusHead" and len(packet) >= 12:
+        sample_rate = 48000
+        pre_skip = struct.unpack_from("<H", packet, 10)[0]
+    elif packet[:5] == b"\x7fFLAC" and len(packet) >= 30:
+        # Mapping header (9 bytes), "fLaC", the STREAMINFO block header,
+        # then 10 bytes of block and frame sizes before the sample rate.
+        sample_rate = int.from_bytes(packet[27:30], "big") >> 4
+    else:
+        return None
+    if not sample_rate:
+        return None
+
+    # The last page of the logical stream carries the final granule
+    # position, i.e. the total number of samples.
+    file_size = os.fstat(f.fileno()).st_size
+    f.seek(max(0, file_size - OGG_TAIL_BYTES))
+    tail = f.read()
+    pos = tail.rfind(b"OggS")
+    while pos != -1:
+        if pos + 27 <= len(tail):
+            granule, page_serial = struct.unpack_from("<qI", tail, pos + 6)
+            if page_serial == serial and granule > 0:
+                return max(0, granule - pre_skip) / sample_rate
+        pos = tail.rfind(b"OggS", 0, pos)
+    return None
+
+
+@register_probe(".mp3")
+def probe_mp3(f, file_path):
+    # mutagen only reads the Xing/VBRI header or a few frames, and parses
+    # the ID3 tag in the same pass.
+    from mutagen.mp3 import MP3
+    from mutagen.easyid3 import EasyID3
+    audio = MP3(f, ID3=EasyID3)
+    return audio.info.length, tags_from_easy(audio.tags)
+
+
+def decode_length(file_path):
+    import pygame
+    if not pygame.mixer.get_init():
+        pygame.mixer.init()
+    sound = pygame.mixer.Sound(file_path)
+    length = sound.get_length()
+    del sound
+    return length
+
+
+def probe_file(file_path):
+    ext = os.path.splitext(file_path)[1].lower()
+    length = None
+    tags = None
+    probe = PROBES.get(ext)
+    if probe is not None:
+        try:
+            with open(file_path, "rb") as f:
+                result = probe(f, file_path)
+            if isinstance(result, tuple):
+                length, tags = result
+            else:
+                length = result
+        except Exception:
+            length = None
+
+    if length is None:
+        try:
+            from mutagen import File as MutagenFile
+            audio = MutagenFile(file_path, easy=True)
+            if audio is not None and audio.info.length:
+                length = audio.info.length
+                tags = tags_from_easy(audio.tags)
+        except Exception:
+            pass
+
+    if length is None:
+        length = decode_length(file_path)
+
+    if tags is None:
+        tags = read_tags(file_path)
+    return length, tags
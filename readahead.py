@@ -0,0 +1,302 @@
+import hashlib
+import io
+import mmap
+import os
+import threading
+import time
+
+
+CHUNK_SIZE = 256 * 1024
+# Decoders look at the end of a file as soon as it is opened (ID3v1 and
+# APE tags, the last Ogg page for the length), so the tail is read first.
+TAIL_SIZE = 128 * 1024
+
+
+class ReadAhead:
+    # Copies a file on a worker thread, into memory when it is at most
+    # max_memory bytes and otherwise into a spool file on local disk, while
+    # streams opened from it read whatever has arrived. Playback from such
+    # a stream only waits when it catches up with the copy; a slow or
+    # stalled network share no longer blocks the loop thread, and only
+    # reaches the audio thread if the share falls behind real time. The
+    # copy starts with the tail, then reads on from wherever a stream is
+    # waiting (after a seek) and fills the gaps last.
+    #
+    # Without a spool_dir, larger files are left where they are: direct is
+    # set and open() returns the path itself. on_ready(reader) runs on the
+    # worker thread once playback can start, on_done(reader) once the copy
+    # is complete or has failed (error is then set).
+
+    def __init__(self, path, max_memory, spool_dir=None, on_ready=None, on_done=None, delay=0.0):
+        self.path = path
+        self.max_memory = max_memory
+        self.spool_dir = spool_dir
+        self.on_ready = [on_ready] if on_ready else []
+        self.on_done = on_done
+        # Seconds to sleep after every chunk; only for simulating a slow
+        # file system (benchmark.py --throttle).
+        self.delay = delay
+        self.size = None
+        self.data = None
+        self.spool_path = None
+        self.direct = False
+        # Sorted, merged [start, end) byte ranges copied so far.
+        self.ranges = []
+        self.wanted = None
+        self.ready = False
+        self.done = False
+        self.error = None
+        self.cancelled = False
+        self.cond = threading.Condition()
+
+    def start(self):
+        threading.Thread(target=self._run, daemon=True).start()
+        return self
+
+    def add_ready_callback(self, callback):
+        with self.cond:
+            if not self.ready:
+                self.on_ready.append(callback)
+                return
+        callback(self)
+
+    def cancel(self):
+        with self.cond:
+            self.cancelled = True
+            self.cond.notify_all()
+
+    def wait_ready(self, timeout=None):
+        with self.cond:
+            return self.cond.wait_for(lambda: self.ready, timeout)
+
+    def wait(self, timeout=None):
+        # Blocks until the copy is complete or has failed.
+        with self.cond:
+            return self.cond.wait_for(lambda: self.done, timeout)
+
+    def open(self):
+        # A file object for pygame.mixer.music.load() or queue(), or the
+        # path itself when the file is not copied at all.
+        if self.direct:
+            return self.path
+        return ReadAheadStream(self)
+
+    def seek_index(self):
+        # Seeks re-open the stream and let the decoder skip ahead.
+        return None
+
+    def available(self, pos, count):
+        # Bytes that can be read at pos right now, waiting for the copy if
+        # there are none yet. 0 at the end of the file.
+        with self.cond:
+            while True:
+                if pos >= self.size:
+                    return 0
+                end = self._covered(pos)
+                if end is not None:
+                    return min(count, end - pos)
+                if self.error is not None:
+                    raise OSError(self.error)
+                if self.cancelled:
+                    raise OSError("read-ahead cancelled")
+                self.wanted = pos
+                self.cond.wait()
+
+    def _covered(self, pos):
+        # End of the copied range that holds pos, or None.
+        for start, end in self.ranges:
+            if start <= pos < end:
+                return end
+            if pos < start:
+                break
+        return None
+
+    def _gap(self, pos):
+        # (start, end) of the first missing range at or after pos, or None.
+        for start, end in self.ranges:
+            if pos < start:
+                return pos, start
+            pos = max(pos, end)
+        return (pos, self.size) if pos < self.size else None
+
+    def _add(self, start, end):
+        ranges = []
+        for r in self.ranges:
+            if r[1] < start or r[0] > end:
+                ranges.append(r)
+            else:
+                start, end = min(start, r[0]), max(end, r[1])
+        ranges.append((start, end))
+        ranges.sort()
+        self.ranges = ranges
+
+    def _spool_name(self, st):
+        key = f"{self.path}\0{st.st_size}\0{st.st_mtime_ns}".encode("utf-8", "surrogateescape")
+        ext = os.path.splitext(self.path)[1].lower()
+        return os.path.join(self.spool_dir, hashlib.sha1(key).hexdigest() + ext)
+
+    def _set_ready(self):
+        with self.cond:
+            if self.ready:
+                return
+            self.ready = True
+            self.cond.notify_all()
+            callbacks, self.on_ready = self.on_ready, []
+        for callback in callbacks:
+            callback(self)
+
+    def _run(self):
+        try:
+            with open(self.path, "rb") as f:
+                self._copy(f)
+        except OSError as e:
+            with self.cond:
+                self.error = str(e)
+                self.cond.notify_all()
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+        self._set_ready()
+        if self.on_done:
+            self.on_done(self)
+
+    def _copy(self, f):
+        st = os.fstat(f.fileno())
+        size = st.st_size
+        write = None
+        if size <= self.max_memory:
+            # Anonymous memory: pages are only touched as they are copied.
+            self.data = mmap.mmap(-1, size) if size else bytearray()
+
+            def write(pos, chunk):
+                self.data[pos:pos + len(chunk)] = chunk
+        elif not self.spool_dir:
+            self.direct = True
+        else:
+            final = self._spool_name(st)
+            if os.path.exists(final) and os.path.getsize(final) == size:
+                os.utime(final)
+                self.spool_path = final
+            else:
+                os.makedirs(self.spool_dir, exist_ok=True)
+                self.spool_path = final + ".part"
+                out = open(self.spool_path, "w+b")
+                out.truncate(size)
+
+                def write(pos, chunk):
+                    out.seek(pos)
+                    out.write(chunk)
+                    out.flush()
+        with self.cond:
+            self.size = size
+            if write is None:
+                self.ranges = [(0, size)]
+        if write is None:
+            return
+
+        try:
+            cursor = size - TAIL_SIZE if size > 2 * TAIL_SIZE else 0
+            reads = 0
+            while True:
+                with self.cond:
+                    if self.wanted is not None and self._covered(self.wanted) is None:
+                        cursor = self.wanted
+                    self.wanted = None
+                    gap = self._gap(cursor) or self._gap(0)
+                    cancelled = self.cancelled
+                if cancelled:
+                    raise OSError("read-ahead cancelled")
+                if gap is None:
+                    break
+                pos = gap[0]
+                chunk = self._read(f, min(CHUNK_SIZE, gap[1] - pos), pos)
+                write(pos, chunk)
+                cursor = pos + len(chunk)
+                with self.cond:
+                    self._add(pos, cursor)
+                    self.cond.notify_all()
+                reads += 1
+                if reads >= 2:
+                    self._set_ready()
+        finally:
+            if self.data is None:
+                out.close()
+        if self.spool_path and self.spool_path.endswith(".part"):
+            final = self.spool_path[:-len(".part")]
+            try:
+                os.replace(self.spool_path, final)
+                self.spool_path = final
+            except OSError:
+                # Still open elsewhere (Windows); it is copied again next time.
+                pass
+
+    def _read(self, f, count, pos):
+        f.seek(pos)
+        chunk = f.read(count)
+        if len(chunk) != count:
+            raise OSError(f"{self.path} changed while reading")
+        if self.delay:
+            time.sleep(self.delay)
+        return chunk
+
+
+class ReadAheadStream(io.RawIOBase):
+    # Read-only file object over a ReadAhead; each has its own position.
+
+    def __init__(self, reader):
+        self.reader = reader
+        self.pos = 0
+        self.file = open(reader.spool_path, "rb") if reader.data is None else None
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self.pos
+        elif whence == io.SEEK_END:
+            pos += self.reader.size
+        self.pos = max(0, min(pos, self.reader.size))
+        return self.pos
+
+    def readinto(self, buffer):
+        n = self.reader.available(self.pos, len(buffer))
+        if n <= 0:
+            return 0
+        if self.file is None:
+            buffer[:n] = self.reader.data[self.pos:self.pos + n]
+        else:
+            self.file.seek(self.pos)
+            n = self.file.readinto(memoryview(buffer)[:n])
+        self.pos += n
+        return n
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        super().close()
+
+
+def trim_spool(folder, max_bytes):
+    # Least recently played first; partial copies are left alone.
+    try:
+        entries = [e for e in os.scandir(folder) if e.is_file() and not e.name.endswith(".part")]
+        stats = sorted(((e.stat(), e.path) for e in entries), key=lambda s: s[0].st_mtime)
+    except OSError:
+        return
+    total = sum(st.st_size for st, _ in stats)
+    for st, path in stats:
+        if total <= max_bytes:
+            break
+        try:
+            os.unlink(path)
+            total -= st.st_size
+        except OSError:
+            pass
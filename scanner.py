@@ -0,0 +1,193 @@
+import os
+import threading
+import time
+
+import instrument
+from probe import probe_file
+
+
+AUDIO_EXTENSIONS = (".mp3", ".wav", ".ogg", ".flac")
+
+
+def _init_worker():
+    # Probe workers may fall back to a pygame decode; keep them off the
+    # real audio device. They are spawned rather than forked, which would
+    # hand them the player's mixer and threads.
+    os.environ.setdefault("SDL_AUDIODRIVER", "dummy")
+
+
+def _probe(file_path):
+    try:
+        length, tags = probe_file(file_path)
+        return file_path, length, tags, None
+    except Exception as e:
+        return file_path, None, None, str(e)
+
+
+def _timed_probe(file_path):
+    start = time.perf_counter()
+    result = _probe(file_path)
+    return result + (time.perf_counter() - start,)
+
+
+def _record_probe(result):
+    # Worker clocks are not comparable with ours, so probes only feed the
+    # per-format histograms, not the trace.
+    ext = os.path.splitext(result[0])[1].lower() or ".none"
+    instrument.add(f"scan.probe{ext}", result[4])
+    return result[:4]
+
+
+class ScanToken:
+    def __init__(self, folder):
+        self.folder = folder
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    @property
+    def is_cancelled(self):
+        return self.cancelled.is_set()
+
+
+class FolderScanner:
+    # Lists a folder, answers what it can from the metadata cache and
+    # probes the rest on a process pool. Results are handed to the
+    # engine's thread in batches through post(), in sorted order, so the
+    # listbox fills while the scan is still running.
+
+    def __init__(self, post, metadata_cache, on_batch, on_done, on_error=None,
+                 workers=None, batch_size=256, inline_threshold=32):
+        self.post = post
+        self.metadata_cache = metadata_cache
+        self.on_batch = on_batch
+        self.on_done = on_done
+        self.on_error = on_error
+        self.workers = workers or os.cpu_count() or 2
+        self.batch_size = batch_size
+        self.inline_threshold = inline_threshold
+        self.token = None
+        self.lock = threading.Lock()
+
+    def scan(self, folder, listing=None):
+        # listing: optional pre-built [(path, size, mtime)], e.g. a whole
+        # library tree; otherwise folder itself is listed (not recursively).
+        with self.lock:
+            if self.token:
+                self.token.cancel()
+            token = self.token = ScanToken(folder)
+        threading.Thread(target=self._run, args=(token, listing), daemon=True).start()
+        return token
+
+    def cancel(self):
+        with self.lock:
+            if self.token:
+                self.token.cancel()
+                self.token = None
+
+    def _post(self, token, func, *args):
+        if not token.is_cancelled:
+            self.post(self._deliver, token, func, args)
+
+    def _deliver(self, token, func, args):
+        if token.is_cancelled or token is not self.token:
+            return
+        func(token, *args)
+
+    def _list(self, folder):
+        entries = []
+        with os.scandir(folder) as it:
+            for entry in it:
+                if entry.name.lower().endswith(AUDIO_EXTENSIONS) and entry.is_file():
+                    st = entry.stat()
+                    entries.append((entry.path, st.st_size, st.st_mtime_ns))
+        entries.sort(key=lambda e: os.path.basename(e[0]))
+        return entries
+
+    def _probe_all(self, token, paths):
+        timed = instrument.enabled
+        probe = _timed_probe if timed else _probe
+        if len(paths) < self.inline_threshold or self.workers < 2:
+            for path in paths:
+                if token.is_cancelled:
+                    return
+                result = probe(path)
+                yield _record_probe(result) if timed else result
+            return
+        # Only large scans need the pool, so its import stays off startup.
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        chunksize = max(1, min(64, len(paths) // (self.workers * 4)))
+        executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=multiprocessing.get_context("spawn"),
+                                       initializer=_init_worker)
+        try:
+            for result in executor.map(probe, paths, chunksize=chunksize):
+                if token.is_cancelled:
+                    return
+                yield _record_probe(result) if timed else result
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _run(self, token, listing):
+        folder = token.folder
+        recursive = listing is not None
+        if listing is None:
+            try:
+                listing = self._list(folder)
+            except OSError as e:
+                self._post(token, self.on_done, 0, str(e))
+                return
+
+        cached = self.metadata_cache.lookup_folder(folder)
+        known = {}
+        misses = []
+        for path, size, mtime in listing:
+            entry = cached.get(path)
+            if entry and entry[0] == size and entry[1] == mtime:
+                known[path] = (entry[2], entry[3])
+            else:
+                misses.append(path)
+        if instrument.enabled:
+            instrument.count("scan.cache_hits", len(known))
+            instrument.count("scan.probed", len(misses))
+
+        probed = self._probe_all(token, misses)
+        stats = {path: (size, mtime) for path, size, mtime in listing}
+        batch = []
+        fresh = []
+        seen = set()
+        for path, _, _ in listing:
+            if token.is_cancelled:
+                probed.close()
+                return
+            if path in known:
+                length, tags = known[path]
+            else:
+                result = next(probed, None)
+                if result is None:
+                    # Cancelled while probing.
+                    probed.close()
+                    return
+                _, length, tags, error = result
+                if error is not None:
+                    if self.on_error:
+                        self._post(token, self.on_error, path, error)
+                    continue
+                fresh.append((path, *stats[path], length, tags))
+            seen.add(path)
+            batch.append((path, length, tags))
+            if len(batch) >= self.batch_size:
+                self._post(token, self.on_batch, batch)
+                batch = []
+        if batch:
+            self._post(token, self.on_batch, batch)
+
+        try:
+            self.metadata_cache.store_many(fresh)
+            self.metadata_cache.touch_many(known)
+            self.metadata_cache.prune_folder(folder, seen, recursive=recursive)
+            self.metadata_cache.trim()
+        except Exception as e:
+            print(f"Metadata cache update failed: {e}")
+        self._post(token, self.on_done, len(seen), None)
@@ -0,0 +1,115 @@
+from array import array
+
+
+def normalize(text):
+    return text.casefold()
+
+
+class SearchIndex:
+    # Substring search over track names (and tags when known). Keys are
+    # normalized once when a track is added; queries of three or more
+    # characters intersect trigram posting lists before the substring check,
+    # and a query that extends the previous one only re-checks the previous
+    # results. Results are track ids in ascending order.
+
+    def __init__(self, ngram=3):
+        self.ngram = ngram
+        self.clear()
+
+    def clear(self):
+        self.keys = []
+        self.postings = {}
+        self.dirty = False
+        self.last_query = None
+        self.last_results = None
+
+    @staticmethod
+    def make_key(name, tags=None):
+        parts = [name]
+        if tags:
+            parts.extend(v for v in tags.values() if v)
+        return normalize("\n".join(parts))
+
+    def _grams(self, key):
+        n = self.ngram
+        return {key[i:i + n] for i in range(len(key) - n + 1)}
+
+    def add(self, track_id, name, tags=None):
+        # Tracks are added in id order, so posting lists stay sorted.
+        key = self.make_key(name, tags)
+        self.keys.append(key)
+        if not self.dirty:
+            for gram in self._grams(key):
+                posting = self.postings.get(gram)
+                if posting is None:
+                    posting = self.postings[gram] = array("I")
+                posting.append(track_id)
+        if self.last_results is not None and self.last_query in key:
+            self.last_results.append(track_id)
+
+    def update(self, track_id, name, tags=None):
+        if track_id >= len(self.keys):
+            return
+        self.keys[track_id] = self.make_key(name, tags)
+        self.dirty = True
+        self.last_query = None
+        self.last_results = None
+
+    def rebuild(self, entries):
+        # entries: (name, tags) in track id order.
+        self.clear()
+        for track_id, (name, tags) in enumerate(entries):
+            self.add(track_id, name, tags)
+
+    def invalidate(self):
+        # Track ids were remapped (e.g. after removals); the caller must
+        # rebuild before the next search.
+        self.dirty = True
+        self.last_query = None
+        self.last_results = None
+
+    def _reindex(self):
+        self.postings = {}
+        for track_id, key in enumerate(self.keys):
+            for gram in self._grams(key):
+                posting = self.postings.get(gram)
+                if posting is None:
+                    posting = self.postings[gram] = array("I")
+                posting.append(track_id)
+        self.dirty = False
+
+    def matches(self, track_id, query):
+        return normalize(query) in self.keys[track_id]
+
+    def search(self, query):
+        query = normalize(query)
+        keys = self.keys
+        if not query:
+            results = list(range(len(keys)))
+        elif self.last_results is not None and self.last_query and self.last_query in query:
+            results = [i for i in self.last_results if query in keys[i]]
+        elif len(query) < self.ngram:
+            results = [i for i, key in enumerate(keys) if query in key]
+        else:
+            if self.dirty:
+                self._reindex()
+            postings = []
+            for gram in self._grams(query):
+                posting = self.postings.get(gram)
+                if posting is None:
+                    postings = None
+                    break
+                postings.append(posting)
+            if not postings:
+                results = []
+            else:
+                postings.sort(key=len)
+                candidates = postings[0]
+                for posting in postings[1:]:
+                    if len(candidates) < 64:
+                        break
+                    candidates = sorted(set(candidates).intersection(posting))
+                results = [i for i in candidates if query in keys[i]]
+        self.last_query = query
+        self.last_results = results
+        return list(results)
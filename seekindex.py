@@ -0,0 +1,417 @@
+import bisect
+import io
+import mmap
+import os
+import struct
+import threading
+from array import array
+from collections import OrderedDict
+
+
+# Bitrates (kbps) by (is MPEG1, layer bits), where layer bits 3/2/1 are
+# Layer I/II/III; sample rates by version bits.
+MP3_BITRATES = {
+    (True, 3): (0, 32, 64, 96, 128, 160, 192, 224, 256, 288, 320, 352, 384, 416, 448),
+    (True, 2): (0, 32, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320, 384),
+    (True, 1): (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224, 256, 320),
+    (False, 3): (0, 32, 48, 56, 64, 80, 96, 112, 128, 144, 160, 176, 192, 224, 256),
+    (False, 2): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+    (False, 1): (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128, 144, 160),
+}
+MP3_SAMPLE_RATES = {3: (44100, 48000, 32000), 2: (22050, 24000, 16000), 0: (11025, 12000, 8000)}
+
+# Formats whose SDL_mixer decoder seeks natively and cheaply (FLAC via its
+# own seek table, Vorbis via page granules), so set_pos() on the live
+# stream is used before splicing.
+NATIVE_SEEK = (".ogg", ".flac")
+
+
+class SplicedStream(io.RawIOBase):
+    # Read-only file object: a header prefix followed by data[offset:].
+    # Lets the decoder start at any frame boundary of an mmap'd file
+    # without copying it. on_close(data) is called once when the stream
+    # is closed (by the decoder, or when it is garbage collected).
+
+    def __init__(self, prefix, data, offset, on_close=None):
+        self.prefix = prefix
+        self.data = data
+        self.offset = offset
+        self.length = len(prefix) + len(data) - offset
+        self.pos = 0
+        self.on_close = on_close
+
+    def close(self):
+        if not self.closed and self.on_close is not None:
+            on_close, self.on_close = self.on_close, None
+            on_close(self.data)
+        super().close()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self.pos
+        elif whence == io.SEEK_END:
+            pos += self.length
+        self.pos = max(0, min(pos, self.length))
+        return self.pos
+
+    def readinto(self, buffer):
+        n = min(len(buffer), self.length - self.pos)
+        if n <= 0:
+            return 0
+        written = 0
+        plen = len(self.prefix)
+        if self.pos < plen:
+            chunk = self.prefix[self.pos:self.pos + n]
+            buffer[:len(chunk)] = chunk
+            written = len(chunk)
+        if written < n:
+            start = self.offset + self.pos + written - plen
+            buffer[written:n] = self.data[start:start + n - written]
+        self.pos += n
+        return n
+
+
+class SeekIndex:
+    # Maps a time to a byte offset the decoder can start from.
+    # times: start time (seconds) of each seek point, ascending; offsets:
+    # the matching byte offsets; data[:header_end] (the stream headers,
+    # optionally rewritten by patch) is put in front of the spliced data.
+
+    def __init__(self, path, times, offsets, header_end=0, patch=None):
+        self.path = path
+        self.times = times
+        self.offsets = offsets
+        self.header_end = header_end
+        self.patch = patch
+
+    def locate(self, position):
+        i = bisect.bisect_right(self.times, position) - 1
+        i = max(0, min(i, len(self.times) - 1))
+        return self.times[i], self.offsets[i]
+
+    def open_at(self, data, position, on_close=None):
+        actual, offset = self.locate(position)
+        prefix = bytes(data[:self.header_end])
+        if self.patch:
+            prefix = self.patch(prefix, len(data) - offset)
+        return SplicedStream(prefix, data, offset, on_close), actual
+
+
+class PcmSeekIndex(SeekIndex):
+    # Uncompressed data needs no table: any sample frame is a valid start.
+
+    def __init__(self, path, rate, block_align, data_start, frames):
+        super().__init__(path, None, None, header_end=data_start, patch=_patch_wav_header)
+        self.rate = rate
+        self.block_align = block_align
+        self.data_start = data_start
+        self.frames = frames
+
+    def locate(self, position):
+        frame = max(0, min(int(position * self.rate), self.frames - 1))
+        return frame / self.rate, self.data_start + frame * self.block_align
+
+
+def _skip_id3v2(data):
+    if len(data) >= 10 and data[:3] == b"ID3":
+        size = 0
+        for b in data[6:10]:
+            size = (size << 7) | (b & 0x7F)
+        return 10 + size + (10 if data[5] & 0x10 else 0)
+    return 0
+
+
+def _mp3_frame(data, pos):
+    # Returns (frame length, samples per frame, sample rate) or None.
+    h = int.from_bytes(data[pos:pos + 4], "big")
+    if h >> 21 != 0x7FF:
+        return None
+    version = (h >> 19) & 3
+    layer = (h >> 17) & 3
+    bitrate_index = (h >> 12) & 0xF
+    rate_index = (h >> 10) & 3
+    if version == 1 or layer == 0 or bitrate_index in (0, 15) or rate_index == 3:
+        return None
+    mpeg1 = version == 3
+    bitrate = MP3_BITRATES[(mpeg1, layer)][bitrate_index] * 1000
+    rate = MP3_SAMPLE_RATES[version][rate_index]
+    padding = (h >> 9) & 1
+    if layer == 3:
+        return (12 * bitrate // rate + padding) * 4, 384, rate
+    if layer == 2 or mpeg1:
+        return 144 * bitrate // rate + padding, 1152, rate
+    return 72 * bitrate // rate + padding, 576, rate
+
+
+def build_mp3_index(path, data):
+    pos = _skip_id3v2(data)
+    end = len(data)
+    offsets = array("Q")
+    times = array("d")
+    samples = 0
+    first = True
+    while pos + 4 <= end:
+        frame = _mp3_frame(data, pos)
+        if frame is None or frame[0] <= 4:
+            pos = data.find(b"\xff", pos + 1)
+            if pos == -1:
+                break
+            continue
+        length, per_frame, rate = frame
+        if first:
+            first = False
+            head = data[pos:pos + min(length, 200)]
+            if b"Xing" in head or b"Info" in head or b"VBRI" in head:
+                # LAME/Xing header frame: silent, and decoders skip it.
+                pos += length
+                continue
+        offsets.append(pos)
+        times.append(samples / rate)
+        samples += per_frame
+        pos += length
+    if not offsets:
+        return None
+    return SeekIndex(path, times, offsets)
+
+
+def build_ogg_index(path, data):
+    end = len(data)
+    pos = 0
+    rate = None
+    header_end = None
+    page_start = 0.0
+    times = array("d")
+    offsets = array("Q")
+    while pos + 27 <= end and data[pos:pos + 4] == b"OggS":
+        granule = struct.unpack_from("<q", data, pos + 6)[0]
+        segments = data[pos + 26]
+        body = pos + 27 + segments
+        size = 27 + segments + sum(data[pos + 27:body])
+        if rate is None:
+            packet = data[body:body + 16]
+            if packet[:7] != b"\x01vorbis":
+                return None
+            rate = struct.unpack_from("<I", packet, 12)[0]
+        # Header pages carry granule 0, and -1 means no packet ends in
+        # the page; neither is a usable start point.
+        if granule > 0:
+            if header_end is None:
+                header_end = pos
+            times.append(page_start)
+            offsets.append(pos)
+            page_start = granule / rate
+        pos += size
+    if header_end is None or not rate:
+        return None
+    return SeekIndex(path, times, offsets, header_end=header_end)
+
+
+def build_flac_index(path, data):
+    pos = _skip_id3v2(data)
+    if data[pos:pos + 4] != b"fLaC":
+        return None
+    pos += 4
+    rate = None
+    points = []
+    while True:
+        header = data[pos:pos + 4]
+        if len(header) < 4:
+            return None
+        last = header[0] & 0x80
+        block_type = header[0] & 0x7F
+        size = int.from_bytes(header[1:4], "big")
+        block = data[pos + 4:pos + 4 + size]
+        if block_type == 0:
+            rate = int.from_bytes(block[10:13], "big") >> 4
+        elif block_type == 3:
+            for i in range(0, size - 17, 18):
+                sample, offset = struct.unpack_from(">QQ", block, i)
+                if sample != 0xFFFFFFFFFFFFFFFF:
+                    points.append((sample, offset))
+        pos += 4 + size
+        if last:
+            break
+    first_frame = pos
+    if not rate:
+        return None
+    points.sort()
+    if not points or points[0][0] != 0:
+        points.insert(0, (0, 0))
+    times = array("d", (sample / rate for sample, _ in points))
+    offsets = array("Q", (first_frame + offset for _, offset in points))
+    return SeekIndex(path, times, offsets, header_end=first_frame)
+
+
+def _patch_wav_header(header, data_size):
+    header = bytearray(header)
+    struct.pack_into("<I", header, 4, len(header) - 8 + data_size)
+    struct.pack_into("<I", header, len(header) - 4, data_size)
+    return bytes(header)
+
+
+def build_wav_index(path, data):
+    if data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return None
+    pos = 12
+    fmt = None
+    while pos + 8 <= len(data):
+        chunk_id, size = struct.unpack_from("<4sI", data, pos)
+        if chunk_id == b"fmt ":
+            fmt = struct.unpack_from("<HHIIH", data, pos + 8)
+        elif chunk_id == b"data":
+            if fmt is None:
+                return None
+            data_start = pos + 8
+            rate, block_align = fmt[2], fmt[4]
+            if not rate or not block_align:
+                return None
+            frames = (len(data) - data_start) // block_align
+            return PcmSeekIndex(path, rate, block_align, data_start, frames)
+        pos += 8 + size + (size & 1)
+    return None
+
+
+BUILDERS = {
+    ".mp3": build_mp3_index,
+    ".ogg": build_ogg_index,
+    ".flac": build_flac_index,
+    ".wav": build_wav_index,
+}
+
+
+class SeekIndexCache:
+    # Per-track seek indexes, keyed on path + size + mtime and kept for the
+    # most recently used tracks. Files are mmap'd, so building an index
+    # and splicing a stream only touch the pages that are needed.
+    #
+    # An evicted entry's mapping is closed right away, or, while streams
+    # opened with open_at() still read from it, when the last of them is
+    # closed.
+
+    def __init__(self, max_entries=32):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.users = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def _key(path):
+        st = os.stat(path)
+        return path, st.st_size, st.st_mtime_ns
+
+    def get(self, path, build=True):
+        key = self._key(path)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+                return entry
+        if not build:
+            return None
+        builder = BUILDERS.get(os.path.splitext(path)[1].lower())
+        if builder is None:
+            return None
+        with open(path, "rb") as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        index = builder(path, data)
+        entry = (index, data) if index else None
+        if entry is None:
+            data.close()
+            return None
+        evicted = []
+        with self.lock:
+            existing = self.entries.get(key)
+            if existing is None:
+                self.entries[key] = entry
+                while len(self.entries) > self.max_entries:
+                    _, (_, old) = self.entries.popitem(last=False)
+                    if id(old) not in self.users:
+                        evicted.append(old)
+            else:
+                # Another thread built it meanwhile; keep theirs.
+                self.entries.move_to_end(key)
+                evicted.append(data)
+                entry = existing
+        for old in evicted:
+            old.close()
+        return entry
+
+    def open_at(self, path, position):
+        # Returns (stream, actual position), or None when path cannot be
+        # indexed. The stream keeps the mapping open until it is closed.
+        while True:
+            entry = self.get(path)
+            if entry is None:
+                return None
+            index, data = entry
+            with self.lock:
+                if data.closed:
+                    # Evicted before we got to it.
+                    continue
+                self.users[id(data)] = self.users.get(id(data), 0) + 1
+            break
+        try:
+            return index.open_at(data, position, self._release)
+        except Exception:
+            self._release(data)
+            raise
+
+    def _release(self, data):
+        with self.lock:
+            count = self.users.pop(id(data)) - 1
+            if count:
+                self.users[id(data)] = count
+                return
+            if any(entry[1] is data for entry in self.entries.values()):
+                return
+        data.close()
+
+    def prefetch(self, path):
+        threading.Thread(target=self._prefetch, args=(path,), daemon=True).start()
+
+    def _prefetch(self, path):
+        try:
+            self.get(path)
+        except (OSError, ValueError) as e:
+            print(f"Could not index {path}: {e}")
+
+
+def seek_music(path, position, cache, buffer=None):
+    # Moves the playing stream to position. Returns (actual position,
+    # whether the stream had to be re-opened). With a track_buffers
+    # buffer (or a readahead reader) for path, the stream is re-opened
+    # from that and the file is not touched at all.
+    import pygame
+    ext = os.path.splitext(path)[1].lower()
+    if ext in NATIVE_SEEK:
+        try:
+            pygame.mixer.music.set_pos(position)
+            return position, False
+        except pygame.error:
+            pass
+    if buffer is not None:
+        index = buffer.seek_index()
+        if index is None:
+            pygame.mixer.music.load(buffer.open(), ext.lstrip("."))
+            pygame.mixer.music.play(start=position)
+            return position, True
+        stream, actual = index.open_at(buffer.data, position)
+    else:
+        opened = cache.open_at(path, position)
+        if opened is None:
+            pygame.mixer.music.load(path)
+            pygame.mixer.music.play(start=position)
+            return position, True
+        stream, actual = opened
+    pygame.mixer.music.load(stream, ext.lstrip("."))
+    pygame.mixer.music.play()
+    return actual, True
@@ -0,0 +1,108 @@
+import json
+import os
+import threading
+
+
+# What the player was doing when it last ran: the folder, volume, queue,
+# current track and position, and whether it was playing or paused. The
+# queue and current track are stored as paths, so they survive the
+# library changing in between.
+
+SESSION_VERSION = 1
+STATES = ("stopped", "playing", "paused")
+
+
+def load_session(path):
+    # Returns the session as a dict, or None when there is none or it
+    # cannot be read. Fields of the wrong type are dropped.
+    try:
+        with open(path, "rb") as f:
+            data = json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+    if not isinstance(data, dict) or data.get("version") != SESSION_VERSION:
+        return None
+    session = {}
+    if isinstance(data.get("folder"), str):
+        session["folder"] = data["folder"]
+    if isinstance(data.get("volume"), (int, float)):
+        session["volume"] = max(0.0, min(1.0, float(data["volume"])))
+    if isinstance(data.get("queue"), list):
+        session["queue"] = [p for p in data["queue"] if isinstance(p, str)]
+    if isinstance(data.get("current"), str):
+        session["current"] = data["current"]
+    if isinstance(data.get("position"), (int, float)):
+        session["position"] = max(0.0, float(data["position"]))
+    if data.get("state") in STATES:
+        session["state"] = data["state"]
+    return session
+
+
+def encode_session(session):
+    return json.dumps({"version": SESSION_VERSION, **session}, ensure_ascii=False).encode("utf-8")
+
+
+def atomic_write(path, data):
+    # A crash leaves either the old file or the new one, never half of it.
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+
+class BackgroundWriter:
+    # Writes files atomically on a worker thread, so the caller's thread
+    # never waits on the disk. data is bytes, or a callable returning them
+    # that runs on the worker (for encoding that is not free). A file that
+    # is written again before the worker got to it is written once, with
+    # the latest data.
+
+    def __init__(self):
+        self.pending = {}
+        self.writing = False
+        self.closed = False
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def write(self, path, data):
+        with self.cond:
+            if self.closed:
+                return
+            self.pending[path] = data
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, daemon=True)
+                self.thread.start()
+            self.cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self.cond:
+                while not self.pending and not self.closed:
+                    self.cond.wait()
+                if not self.pending:
+                    return
+                path = next(iter(self.pending))
+                data = self.pending.pop(path)
+                self.writing = True
+            try:
+                atomic_write(path, data() if callable(data) else data)
+            except Exception as e:
+                print(f"Could not write {path}: {e}")
+            with self.cond:
+                self.writing = False
+                self.cond.notify_all()
+
+    def flush(self, timeout=5.0):
+        # Waits until everything handed over so far is on disk.
+        with self.cond:
+            return self.cond.wait_for(lambda: not self.pending and not self.writing, timeout)
+
+    def close(self, timeout=5.0):
+        self.flush(timeout)
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join(timeout)
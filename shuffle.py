@@ -0,0 +1,288 @@
+import random
+from array import array
+from bisect import bisect_left
+from collections import deque
+
+
+class FeistelPermutation:
+    # A bijection on range(n) that needs O(1) memory: a small Feistel
+    # network over the next even number of bits, applied again until the
+    # result falls inside range(n) (cycle walking; under four steps on
+    # average, since the network's range is less than 4n).
+
+    ROUNDS = 4
+
+    def __init__(self, n, seed):
+        self.n = n
+        bits = max(2, (n - 1).bit_length())
+        bits += bits & 1
+        self.half = bits // 2
+        self.mask = (1 << self.half) - 1
+        rng = random.Random(seed)
+        self.keys = [rng.getrandbits(32) for _ in range(self.ROUNDS)]
+
+    @staticmethod
+    def _mix(value, key):
+        value = ((value ^ key) * 0x45D9F3B) & 0xFFFFFFFF
+        value ^= value >> 16
+        return ((value * 0x45D9F3B) & 0xFFFFFFFF) ^ (value >> 15)
+
+    def __call__(self, i):
+        half, mask = self.half, self.mask
+        while True:
+            left, right = i >> half, i & mask
+            for key in self.keys:
+                left, right = right, left ^ (self._mix(right, key) & mask)
+            i = (left << half) | right
+            if i < self.n:
+                return i
+
+
+class WeightTree:
+    # Fenwick tree over non-negative weights: changing a weight, appending
+    # one and picking an index with probability proportional to its weight
+    # are O(log n).
+
+    def __init__(self, weights):
+        n = self.n = len(weights)
+        self.weights = weights
+        tree = array("d", [0.0]) + weights
+        for i in range(1, n + 1):
+            j = i + (i & -i)
+            if j <= n:
+                tree[j] += tree[i]
+        self.tree = tree
+        self.total = sum(weights)
+        self.top = 1 << (n.bit_length() - 1) if n else 0
+
+    def set(self, index, weight):
+        delta = weight - self.weights[index]
+        self.weights[index] = weight
+        self.total += delta
+        tree = self.tree
+        i = index + 1
+        while i <= self.n:
+            tree[i] += delta
+            i += i & -i
+
+    def append(self, weight):
+        # The new node covers itself and the nodes just below it.
+        self.weights.append(weight)
+        n = self.n = self.n + 1
+        node = weight
+        step = 1
+        while step < n & -n:
+            node += self.tree[n - step]
+            step <<= 1
+        self.tree.append(node)
+        self.total += weight
+        self.top = 1 << (n.bit_length() - 1)
+
+    def find(self, value):
+        # The index whose cumulative weight range holds value.
+        tree = self.tree
+        pos = 0
+        step = self.top
+        while step:
+            nxt = pos + step
+            if nxt <= self.n and tree[nxt] <= value:
+                pos = nxt
+                value -= tree[nxt]
+            step >>= 1
+        return min(pos, self.n - 1)
+
+
+class Shuffle:
+    # Endless shuffled order over a scope of track ids (the whole library,
+    # or the ids the list is filtered to), drawn lazily:
+    #   "shuffle"  every track once per round, in the order of a seeded
+    #              Feistel permutation; O(1) time and memory per pick.
+    #   "smart"    weighted picks from a Fenwick tree, O(log n) each:
+    #              tracks played less often come up more, a picked track
+    #              sits out the rest of the round, and a pick by one of the
+    #              last few artists is redrawn (a few times at most).
+    # history keeps what was played, so previous() and next() walk back
+    # and forth through it before anything new is drawn. A new scope
+    # starts a new round that skips whatever is in the history.
+
+    ARTIST_SPACING = 4
+    MAX_REDRAWS = 8
+    HISTORY = 1000
+
+    def __init__(self, tracks, mode, scope=None, play_counts=None, current=None, seed=None):
+        self.tracks = tracks
+        self.mode = mode
+        self.scope = scope
+        # track id -> times played; read at the start of each round.
+        self.play_counts = play_counts or {}
+        self.rng = random.Random(seed)
+        self.history = [] if current is None else [current]
+        self.cursor = len(self.history) - 1
+        self.upcoming = deque()
+        self.recent_artists = deque(maxlen=self.ARTIST_SPACING)
+        self._start(frozenset(self.history))
+
+    def _domain(self):
+        return range(len(self.tracks)) if self.scope is None else self.scope
+
+    def _start(self, skip):
+        domain = self._domain()
+        n = self.size = len(domain)
+        self.pos = 0
+        self.skip = skip
+        self.held = None
+        if self.mode == "shuffle":
+            self.order = FeistelPermutation(n, self.rng.getrandbits(64)) if n else None
+            return
+        # The weight tree is built by the first pick (_build), so a scope
+        # that changes with every keystroke in the search box costs nothing
+        # until a track is actually wanted.
+        self.order = None
+
+    def _weight(self, track):
+        return 0.0 if track in self.skip else 1.0 / (1 + self.play_counts.get(track, 0))
+
+    def _build(self):
+        domain = self._domain()
+        n = self.size = len(domain)
+        weights = array("d", [1.0]) * n
+        # Only tracks played before or skipped differ from 1; the scope is
+        # ascending, so they are found by bisection.
+        for track in set(self.play_counts) | self.skip:
+            if self.scope is None:
+                pos = track
+            else:
+                pos = bisect_left(domain, track)
+                if pos < n and domain[pos] != track:
+                    continue
+            if pos < n:
+                weights[pos] = self._weight(track)
+        self.order = WeightTree(weights)
+
+    def _grow(self):
+        # A scan appended tracks to the scope; they join the round.
+        domain = self._domain()
+        if self.order is not None:
+            for pos in range(self.size, len(domain)):
+                self.order.append(self._weight(domain[pos]))
+        self.size = len(domain)
+
+    def _artist(self, track):
+        # Tracks without an artist tag are spaced by folder instead.
+        return self.tracks.tag(track, "artist") or self.tracks.dir_of[track]
+
+    def _pick(self):
+        domain = self._domain()
+        count = len(self.tracks)
+        if self.mode == "shuffle":
+            while self.pos < self.size:
+                track = domain[self.order(self.pos)]
+                self.pos += 1
+                if track < count and track not in self.skip:
+                    return track
+            return None
+        if self.order is None:
+            self._build()
+        tree = self.order
+        best = None
+        for _ in range(self.MAX_REDRAWS):
+            if tree.total <= 1e-9:
+                break
+            pos = tree.find(self.rng.random() * tree.total)
+            if tree.weights[pos] <= 0:
+                continue
+            track = domain[pos]
+            if track >= count:
+                tree.set(pos, 0.0)
+                continue
+            best = pos, track
+            if self._artist(track) not in self.recent_artists:
+                break
+        if best is None:
+            return None
+        tree.set(best[0], 0.0)
+        self.recent_artists.append(self._artist(best[1]))
+        return best[1]
+
+    def _draw(self):
+        if self.held is not None:
+            track, self.held = self.held, None
+            return track
+        size = len(self._domain())
+        if size > self.size and self.mode == "smart":
+            self._grow()
+        elif size != self.size:
+            # The scope changed under us (a scan still running); the
+            # shuffle's permutation only covers the old size.
+            self._start(frozenset(self.history))
+        last = self.upcoming[-1] if self.upcoming else (self.history[-1] if self.history else None)
+        track = self._pick()
+        if track is None and self.size:
+            # Round over. A new round that opens with the track just drawn
+            # plays it second instead, so it is not heard twice in a row.
+            self._start(frozenset())
+            track = self._pick()
+            if track == last:
+                second = self._pick()
+                if second is not None:
+                    self.held, track = track, second
+        return track
+
+    def peek(self, count):
+        # The next count tracks next() would return, without moving.
+        ahead = self.history[self.cursor + 1:self.cursor + 1 + count]
+        while len(ahead) + len(self.upcoming) < count:
+            track = self._draw()
+            if track is None:
+                break
+            self.upcoming.append(track)
+        ahead.extend(self.upcoming)
+        return ahead[:count]
+
+    def next(self):
+        if self.cursor + 1 < len(self.history):
+            self.cursor += 1
+            return self.history[self.cursor]
+        track = self.upcoming.popleft() if self.upcoming else self._draw()
+        if track is not None:
+            self._append(track)
+        return track
+
+    def previous(self):
+        if self.cursor <= 0:
+            return None
+        self.cursor -= 1
+        return self.history[self.cursor]
+
+    def visit(self, track):
+        # A track started some other way (a double-click, the queue) goes
+        # into the history after the current one.
+        if 0 <= self.cursor < len(self.history) and self.history[self.cursor] == track:
+            return
+        del self.history[self.cursor + 1:]
+        self._append(track)
+
+    def _append(self, track):
+        self.history.append(track)
+        if len(self.history) > self.HISTORY:
+            del self.history[0]
+        self.cursor = len(self.history) - 1
+
+    def played(self, track):
+        self.play_counts[track] = self.play_counts.get(track, 0) + 1
+
+    def set_scope(self, scope):
+        self.scope = scope
+        self.upcoming.clear()
+        self._start(frozenset(self.history))
+
+    def remap(self, remap, doomed):
+        # After tracks were removed from the table: remap(old id) gives the
+        # new id of every track that is not in doomed.
+        kept = sum(1 for track in self.history[:self.cursor + 1] if track not in doomed)
+        self.history = [remap(track) for track in self.history if track not in doomed]
+        self.cursor = kept - 1
+        self.play_counts = {remap(track): plays for track, plays in self.play_counts.items()
+                            if track not in doomed}
+        self.recent_artists.clear()
+        self.set_scope(self.scope)
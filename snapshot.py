@@ -0,0 +1,40 @@
+import marshal
+import os
+
+from track_table import TrackTable
+
+
+# The library as it was last shown, written with marshal: the track
+# table's columns go out as plain lists and raw array bytes and load
+# straight back with no per-track Python work, which keeps showing the
+# last library at startup in the tens of milliseconds even for very large
+# libraries. A snapshot that cannot be read, or comes from another format
+# version, is simply ignored. The queue and current track are kept with
+# the session (session.py).
+
+SNAPSHOT_VERSION = 4
+
+
+def save_snapshot(path, folder, library_mode, tracks):
+    data = marshal.dumps((SNAPSHOT_VERSION, folder, library_mode, tracks.dump()), 4)
+    tmp = path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def load_snapshot(path):
+    # Returns (folder, library_mode, track table) or None. The table still needs TrackTable.index() before lookups by path.
+    try:
+        with open(path, "rb") as f:
+            data = marshal.loads(f.read())
+    except (OSError, EOFError, ValueError, TypeError):
+        return None
+    if not isinstance(data, tuple) or len(data) != 4 or data[0] != SNAPSHOT_VERSION:
+        return None
+    _, folder, library_mode, columns = data
+    try:
+        tracks = TrackTable.load(columns)
+    except (ValueError, TypeError):
+        return None
+    return folder, library_mode, tracks
@@ -0,0 +1,48 @@
+import os
+import struct
+import tempfile
+import unittest
+
+from probe import probe_ogg
+
+
+def ogg_page(serial, sequence, granule, packet, header_type=0):
+    lacing = bytes([255] * (len(packet) // 255) + [len(packet) % 255])
+    return (b"OggS" + bytes([0, header_type]) + struct.pack("<qIII", granule, serial, sequence, 0)
+            + bytes([len(lacing)]) + lacing + packet)
+
+
+def flac_mapping_header(rate, channels=2, bits=16):
+    streaminfo = (struct.pack(">HH", 4096, 4096) + b"\0\0\0" + b"\0\0\0"
+                  + ((rate << 44) | ((channels - 1) << 41) | ((bits - 1) << 36)).to_bytes(8, "big")
+                  + bytes(16))
+    return b"\x7fFLAC\x01\x00\x00\x01" + b"fLaC" + b"\x00\x00\x00\x22" + streaminfo
+
+
+class ProbeOggTest(unittest.TestCase):
+    def probe(self, data):
+        fd, path = tempfile.mkstemp(suffix=".ogg")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            with open(path, "rb") as f:
+                return probe_ogg(f, path)
+        finally:
+            os.unlink(path)
+
+    def test_ogg_flac(self):
+        rate = 44100
+        data = (ogg_page(7, 0, 0, flac_mapping_header(rate), header_type=2)
+                + ogg_page(7, 1, 3 * rate, bytes(100), header_type=4))
+        self.assertAlmostEqual(self.probe(data), 3.0)
+
+    def test_ogg_flac_other_stream_ignored(self):
+        rate = 48000
+        data = (ogg_page(7, 0, 0, flac_mapping_header(rate), header_type=2)
+                + ogg_page(7, 1, 2 * rate, bytes(100))
+                + ogg_page(9, 0, 99 * rate, bytes(100), header_type=4))
+        self.assertAlmostEqual(self.probe(data), 2.0)
+
+
+if __name__ == "__main__":
+    unittest.main()
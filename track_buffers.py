@@ -0,0 +1,219 @@
+import os
+import threading
+from collections import OrderedDict
+
+from readahead import ReadAhead, trim_spool
+from seekindex import BUILDERS, NATIVE_SEEK, SplicedStream
+
+
+class TrackBuffer:
+    # A whole file in memory, plus its seek index once a seek needed it.
+
+    __slots__ = ("path", "data", "index", "indexed")
+
+    def __init__(self, path, data):
+        self.path = path
+        self.data = data
+        self.index = None
+        self.indexed = False
+
+    def seek_index(self):
+        if not self.indexed:
+            builder = BUILDERS.get(os.path.splitext(self.path)[1].lower())
+            self.index = builder(self.path, self.data) if builder else None
+            self.indexed = True
+        return self.index
+
+    def open(self):
+        return SplicedStream(b"", self.data, 0)
+
+
+class TrackBufferCache:
+    # Recently played and upcoming files, held in memory so replaying,
+    # going back a track and re-opening the stream for a seek never go to
+    # disk (or the network) again. Bounded by max_bytes; the least
+    # recently used entry goes first, but the protected ones (current,
+    # previous and next track) only once nothing else is left. Files
+    # larger than max_file_bytes are never held; with a spool_dir they are
+    # copied there instead (up to spool_bytes in all), so they still play
+    # from local disk.
+    #
+    # Files are read through readahead.ReadAhead, so a track can start
+    # playing from the part that has arrived while the rest is read.
+
+    def __init__(self, max_bytes=256 * 1024 * 1024, max_file_bytes=64 * 1024 * 1024,
+                 spool_dir=None, spool_bytes=2 * 1024 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_file_bytes = min(max_file_bytes, max_bytes)
+        self.spool_dir = spool_dir
+        self.spool_bytes = spool_bytes
+        self.read_delay = 0.0
+        self.entries = OrderedDict()
+        self.size = 0
+        self.protected = set()
+        self.readers = {}
+        self.spooled = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, path):
+        with self.lock:
+            buffer = self.entries.get(path)
+            if buffer is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(path)
+            return buffer
+
+    def __contains__(self, path):
+        with self.lock:
+            return path in self.entries
+
+    def protect(self, paths):
+        with self.lock:
+            self.protected = set(paths)
+
+    def put(self, path, data):
+        if len(data) > self.max_file_bytes:
+            return None
+        buffer = TrackBuffer(path, data)
+        with self.lock:
+            old = self.entries.pop(path, None)
+            if old is not None:
+                self.size -= len(old.data)
+            self.entries[path] = buffer
+            self.size += len(data)
+            self._evict()
+        return buffer
+
+    def _evict(self):
+        if self.size <= self.max_bytes:
+            return
+        for protected in (False, True):
+            for path in list(self.entries):
+                if self.size <= self.max_bytes:
+                    return
+                if (path in self.protected) != protected:
+                    continue
+                self.size -= len(self.entries.pop(path).data)
+                self.evictions += 1
+
+    def fetch(self, path, on_ready=None):
+        # The ReadAhead for path, started unless one is already running.
+        # on_ready(reader) runs on its worker thread.
+        with self.lock:
+            reader = self.readers.get(path)
+            started = reader is None
+            if started:
+                reader = self.readers[path] = ReadAhead(path, self.max_file_bytes, self.spool_dir,
+                                                        on_done=self._fetched, delay=self.read_delay)
+        if started:
+            reader.start()
+        if on_ready:
+            reader.add_ready_callback(on_ready)
+        return reader
+
+    def cancel_except(self, paths):
+        # Stops every read-ahead but those for paths: tracks the user
+        # skipped past would otherwise be copied to the end, competing for
+        # I/O with the ones still wanted.
+        keep = set(paths)
+        with self.lock:
+            doomed = [reader for path, reader in self.readers.items() if path not in keep]
+            for reader in doomed:
+                del self.readers[reader.path]
+        for reader in doomed:
+            reader.cancel()
+
+    def reader(self, path):
+        with self.lock:
+            return self.readers.get(path)
+
+    def prefetch(self, path):
+        # Reads path in the background unless it is already held.
+        with self.lock:
+            if path in self.entries:
+                return
+        self.fetch(path)
+
+    def prepare_seek(self, path, index_file):
+        # Builds path's seek index in the background once it has been
+        # read, so the first seek does not have to. Files that are not
+        # held in memory go to index_file(path), with the spooled copy's
+        # path when there is one.
+        if os.path.splitext(path)[1].lower() in NATIVE_SEEK:
+            return
+        threading.Thread(target=self._prepare_seek, args=(path, index_file), daemon=True).start()
+
+    def _prepare_seek(self, path, index_file):
+        reader = self.reader(path)
+        if reader is not None:
+            reader.wait()
+        with self.lock:
+            buffer = self.entries.get(path)
+        try:
+            if buffer is not None:
+                buffer.seek_index()
+            elif reader is None or reader.error is None:
+                index_file(self.local_path(path))
+        except (OSError, ValueError) as e:
+            print(f"Could not index {path}: {e}")
+
+    def _fetched(self, reader):
+        path = reader.path
+        with self.lock:
+            if self.readers.get(path) is reader:
+                del self.readers[path]
+        if reader.error is not None:
+            if not reader.cancelled:
+                print(f"Could not buffer {path}: {reader.error}")
+            return
+        if reader.data is not None:
+            self.put(path, reader.data)
+        elif reader.spool_path:
+            with self.lock:
+                self.spooled[path] = reader.spool_path
+            trim_spool(self.spool_dir, self.spool_bytes)
+
+    def local_path(self, path):
+        # The spooled copy of path, if there is one.
+        with self.lock:
+            spooled = self.spooled.get(path)
+        if spooled and os.path.exists(spooled):
+            return spooled
+        return path
+
+    def discard(self, path):
+        with self.lock:
+            self.spooled.pop(path, None)
+            buffer = self.entries.pop(path, None)
+            if buffer is not None:
+                self.size -= len(buffer.data)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.spooled.clear()
+            self.size = 0
+
+    def close(self):
+        with self.lock:
+            readers = list(self.readers.values())
+        for reader in readers:
+            reader.cancel()
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self.entries),
+                "bytes": self.size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+            }
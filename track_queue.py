@@ -0,0 +1,124 @@
+from collections import deque
+
+
+class TrackQueue:
+    # Play queue of track indices. Backed by a deque, so taking the next
+    # track is O(1); every change is reported to listeners as a small
+    # edit ("insert", pos, items) / ("remove", pos, count) /
+    # ("move", src, dst) / ("reset",) so views never have to rebuild.
+
+    def __init__(self, items=()):
+        self.items = deque(items)
+        self.listeners = []
+
+    def subscribe(self, listener):
+        self.listeners.append(listener)
+
+    def _notify(self, *change):
+        for listener in self.listeners:
+            listener(change)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __bool__(self):
+        return bool(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __getitem__(self, pos):
+        return self.items[pos]
+
+    def append(self, item):
+        self.items.append(item)
+        self._notify("insert", len(self.items) - 1, [item])
+
+    def extend(self, items):
+        items = list(items)
+        if not items:
+            return
+        pos = len(self.items)
+        self.items.extend(items)
+        self._notify("insert", pos, items)
+
+    def insert(self, pos, item):
+        pos = max(0, min(pos, len(self.items)))
+        self.items.insert(pos, item)
+        self._notify("insert", pos, [item])
+
+    def popleft(self):
+        item = self.items.popleft()
+        self._notify("remove", 0, 1)
+        return item
+
+    def remove_at(self, pos):
+        item = self.items[pos]
+        del self.items[pos]
+        self._notify("remove", pos, 1)
+        return item
+
+    def move(self, src, dst):
+        if src == dst:
+            return
+        item = self.items[src]
+        del self.items[src]
+        self.items.insert(dst, item)
+        self._notify("move", src, dst)
+
+    def clear(self):
+        self.items.clear()
+        self._notify("reset")
+
+    def replace(self, items):
+        self.items = deque(items)
+        self._notify("reset")
+
+    def dedupe(self):
+        # Keeps the first occurrence of each track; returns how many
+        # entries were dropped.
+        seen = set()
+        unique = []
+        for item in self.items:
+            if item not in seen:
+                seen.add(item)
+                unique.append(item)
+        removed = len(self.items) - len(unique)
+        if removed:
+            self.replace(unique)
+        return removed
+
+
+class QueueListboxView:
+    # Mirrors a TrackQueue into a tk.Listbox by applying each edit.
+
+    def __init__(self, listbox, queue, label_fn):
+        self.listbox = listbox
+        self.queue = queue
+        self.label_fn = label_fn
+        queue.subscribe(self.apply)
+        self.apply(("reset",))
+
+    def _label(self, item):
+        try:
+            return self.label_fn(item)
+        except (IndexError, TypeError):
+            return "<Invalid>"
+
+    def apply(self, change):
+        kind = change[0]
+        if kind == "insert":
+            _, pos, items = change
+            self.listbox.insert(pos, *(self._label(i) for i in items))
+        elif kind == "remove":
+            _, pos, count = change
+            self.listbox.delete(pos, pos + count - 1)
+        elif kind == "move":
+            _, src, dst = change
+            text = self.listbox.get(src)
+            self.listbox.delete(src)
+            self.listbox.insert(dst, text)
+        else:
+            self.listbox.delete(0, "end")
+            if self.queue:
+                self.listbox.insert(0, *(self._label(i) for i in self.queue))
@@ -0,0 +1,248 @@
+import math
+import os
+import re
+from array import array
+from itertools import compress
+
+from metadata_cache import TAG_FIELDS
+
+GAIN_FIELDS = ("track_gain", "track_peak", "album_gain", "album_peak")
+
+
+def track_number(value):
+    # "3", "03/12" -> 3; anything without a leading number sorts last.
+    match = re.match(r"\s*(\d+)", value or "")
+    return int(match.group(1)) if match else 1 << 30
+
+
+class TrackTable:
+    # The library as columns indexed by track id. Directories and
+    # extensions are stored once and referenced by number, lengths live in
+    # a flat array of doubles, display names are computed when a track is
+    # added, and tags are per-field lists whose values are interned, so an
+    # artist shared by a thousand tracks is one string. A file's stem is
+    # only kept when its display name differs from it (underscores).
+    # Loudness gains and peaks are float columns, NaN until analyzed.
+    # Paths are rebuilt on demand; by_path maps them back to ids.
+
+    def __init__(self):
+        self.clear()
+
+    def clear(self):
+        self.dirs = []
+        self.dir_ids = {}
+        self.exts = []
+        self.ext_ids = {}
+        self.dir_of = array("I")
+        self.ext_of = array("H")
+        self.names = []
+        self.stems = {}
+        self.lengths = array("d")
+        self.tag_columns = {field: [] for field in TAG_FIELDS}
+        self.gain_columns = {field: array("f") for field in GAIN_FIELDS}
+        self.strings = {}
+        self.by_path = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def __bool__(self):
+        return bool(self.names)
+
+    def _intern(self, value):
+        return self.strings.setdefault(value, value)
+
+    def _split(self, file_path):
+        folder, base = os.path.split(file_path)
+        stem, ext = os.path.splitext(base)
+        dir_id = self.dir_ids.get(folder)
+        if dir_id is None:
+            dir_id = self.dir_ids[folder] = len(self.dirs)
+            self.dirs.append(folder)
+        ext_id = self.ext_ids.get(ext)
+        if ext_id is None:
+            ext_id = self.ext_ids[ext] = len(self.exts)
+            self.exts.append(ext)
+        return dir_id, ext_id, stem
+
+    def append(self, file_path, length, tags=None):
+        track_id = len(self.names)
+        dir_id, ext_id, stem = self._split(file_path)
+        name = stem.replace("_", " ")
+        self.dir_of.append(dir_id)
+        self.ext_of.append(ext_id)
+        self.names.append(name)
+        if name != stem:
+            self.stems[track_id] = stem
+        self.lengths.append(length)
+        for field, column in self.tag_columns.items():
+            value = tags.get(field) if tags else None
+            column.append(self._intern(value) if value else None)
+        for column in self.gain_columns.values():
+            column.append(math.nan)
+        self.by_path[file_path] = track_id
+        return track_id
+
+    def path(self, track_id):
+        stem = self.stems.get(track_id, self.names[track_id])
+        return os.path.join(self.dirs[self.dir_of[track_id]], stem + self.exts[self.ext_of[track_id]])
+
+    def folder(self, track_id):
+        return self.dirs[self.dir_of[track_id]]
+
+    def name(self, track_id):
+        return self.names[track_id]
+
+    def length(self, track_id):
+        return self.lengths[track_id]
+
+    def find(self, file_path):
+        return self.by_path.get(file_path)
+
+    def tag(self, track_id, field):
+        return self.tag_columns[field][track_id]
+
+    def tags(self, track_id):
+        tags = {field: column[track_id] for field, column in self.tag_columns.items()
+                if column[track_id]}
+        return tags or None
+
+    def gain(self, track_id, album=False):
+        # (gain in dB, peak) or None; album gains fall back to the track's.
+        columns = self.gain_columns
+        if album and not math.isnan(columns["album_gain"][track_id]):
+            return columns["album_gain"][track_id], columns["album_peak"][track_id]
+        if math.isnan(columns["track_gain"][track_id]):
+            return None
+        return columns["track_gain"][track_id], columns["track_peak"][track_id]
+
+    def set_gain(self, track_id, track_gain, track_peak, album_gain=None, album_peak=None):
+        columns = self.gain_columns
+        columns["track_gain"][track_id] = track_gain
+        columns["track_peak"][track_id] = math.nan if track_peak is None else track_peak
+        if album_gain is not None:
+            columns["album_gain"][track_id] = album_gain
+            columns["album_peak"][track_id] = math.nan if album_peak is None else album_peak
+
+    def set_length(self, track_id, length):
+        self.lengths[track_id] = length
+
+    def set_tags(self, track_id, tags):
+        for field, column in self.tag_columns.items():
+            value = tags.get(field) if tags else None
+            column[track_id] = self._intern(value) if value else None
+
+    def rename(self, track_id, file_path):
+        self.by_path.pop(self.path(track_id), None)
+        dir_id, ext_id, stem = self._split(file_path)
+        name = stem.replace("_", " ")
+        self.dir_of[track_id] = dir_id
+        self.ext_of[track_id] = ext_id
+        self.names[track_id] = name
+        if name != stem:
+            self.stems[track_id] = stem
+        else:
+            self.stems.pop(track_id, None)
+        self.by_path[file_path] = track_id
+
+    def remove(self, doomed):
+        # doomed: set of ids. Later ids shift down, as in a list.
+        keep = [i not in doomed for i in range(len(self.names))]
+        self.dir_of = array("I", compress(self.dir_of, keep))
+        self.ext_of = array("H", compress(self.ext_of, keep))
+        self.names = list(compress(self.names, keep))
+        self.lengths = array("d", compress(self.lengths, keep))
+        for field, column in self.tag_columns.items():
+            self.tag_columns[field] = list(compress(column, keep))
+        for field, column in self.gain_columns.items():
+            self.gain_columns[field] = array("f", compress(column, keep))
+        old_ids = compress(range(len(keep)), keep)
+        stems = self.stems
+        self.stems = {new: stems[old] for new, old in enumerate(old_ids) if old in stems}
+        self.by_path = {self.path(i): i for i in range(len(self.names))}
+
+    def in_folder(self, folder):
+        dir_id = self.dir_ids.get(folder)
+        if dir_id is None:
+            return []
+        return [i for i, d in enumerate(self.dir_of) if d == dir_id]
+
+    def sort_keys(self, key):
+        # One sort key per track for a single column.
+        if key == "name":
+            return [name.casefold() for name in self.names]
+        if key == "length":
+            return self.lengths
+        if key == "folder":
+            folders = [d.casefold() for d in self.dirs]
+            return [folders[d] for d in self.dir_of]
+        if key == "tracknumber":
+            return [track_number(v) for v in self.tag_columns[key]]
+        return [(v is None, v.casefold() if v else "") for v in self.tag_columns[key]]
+
+    def sort_key(self, key):
+        # The sort key of a single track for a column, as sort_keys()
+        # computes it for all of them.
+        if key == "name":
+            return lambda i: self.names[i].casefold()
+        if key == "length":
+            return self.lengths.__getitem__
+        if key == "folder":
+            return lambda i: self.dirs[self.dir_of[i]].casefold()
+        column = self.tag_columns[key]
+        if key == "tracknumber":
+            return lambda i: track_number(column[i])
+        return lambda i: (column[i] is None, column[i].casefold() if column[i] else "")
+
+    def sorted(self, ids, keys):
+        # Multi-key sort as a series of stable single-key sorts, least
+        # significant key first; each pass compares plain values instead
+        # of building a tuple per track. A few ids (a queue in a large
+        # library) get their keys computed one by one rather than for
+        # every track.
+        ids = list(ids)
+        few = len(ids) * 8 < len(self)
+        for key in reversed(keys):
+            ids.sort(key=self.sort_key(key) if few else self.sort_keys(key).__getitem__)
+        return ids
+
+    def dump(self):
+        # Plain lists, dicts and bytes, for marshal.
+        return (self.dirs, self.exts, self.dir_of.tobytes(), self.ext_of.tobytes(), self.names,
+                self.stems, self.lengths.tobytes(), [self.tag_columns[f] for f in TAG_FIELDS],
+                [self.gain_columns[f].tobytes() for f in GAIN_FIELDS])
+
+    @classmethod
+    def load(cls, data):
+        # by_path is left empty and tag values are not interned yet; the
+        # caller catches up with index() in slices.
+        table = cls()
+        dirs, exts, dir_of, ext_of, names, stems, lengths, columns, gains = data
+        table.dirs = dirs
+        table.dir_ids = {d: i for i, d in enumerate(dirs)}
+        table.exts = exts
+        table.ext_ids = {e: i for i, e in enumerate(exts)}
+        table.dir_of.frombytes(dir_of)
+        table.ext_of.frombytes(ext_of)
+        table.names = names
+        table.stems = stems
+        table.lengths.frombytes(lengths)
+        if len(columns) != len(TAG_FIELDS) or any(len(c) != len(names) for c in columns):
+            raise ValueError("tag columns do not match the track list")
+        table.tag_columns = dict(zip(TAG_FIELDS, columns))
+        for field, column in zip(GAIN_FIELDS, gains):
+            table.gain_columns[field].frombytes(column)
+        if len(gains) != len(GAIN_FIELDS) or any(len(c) != len(names) for c in table.gain_columns.values()):
+            raise ValueError("gain columns do not match the track list")
+        if not len(table.dir_of) == len(table.ext_of) == len(table.lengths) == len(names):
+            raise ValueError("track columns differ in length")
+        return table
+
+    def index(self, start, stop):
+        for track_id in range(start, stop):
+            self.by_path[self.path(track_id)] = track_id
+        for column in self.tag_columns.values():
+            for track_id in range(start, stop):
+                value = column[track_id]
+                if value:
+                    column[track_id] = self._intern(value)
@@ -0,0 +1,171 @@
+import tkinter as tk
+import tkinter.font as tkfont
+
+
+class VirtualListbox(tk.Frame):
+    # Listbox look-alike that only holds the rows currently on screen.
+    # Labels come from label_fn(position) when a row scrolls into view, so
+    # the cost of the widget does not depend on how many rows there are.
+    # Positions, selection and nearest() are all in model coordinates, and
+    # the usual Listbox selection calls are supported.
+
+    def __init__(self, master, label_fn, **listbox_options):
+        super().__init__(master)
+        self.label_fn = label_fn
+        self.count = 0
+        self.top = 0
+        self.rows = 1
+        self.selected = None
+
+        self.listbox = tk.Listbox(self, height=1, **listbox_options)
+        self.scrollbar = tk.Scrollbar(self, command=self.yview)
+        self.scrollbar.pack(side="right", fill="y")
+        self.listbox.pack(side="left", fill="both", expand=True)
+        font = tkfont.Font(font=self.listbox.cget("font"))
+        self.row_height = font.metrics("linespace") + 1
+
+        self.listbox.bind("<Configure>", self._on_resize)
+        self.listbox.bind("<<ListboxSelect>>", self._on_select)
+        self.listbox.bind("<MouseWheel>", self._on_wheel)
+        self.listbox.bind("<Button-4>", lambda e: self._scroll(-3))
+        self.listbox.bind("<Button-5>", lambda e: self._scroll(3))
+        self.listbox.bind("<Up>", lambda e: self._move_selection(-1))
+        self.listbox.bind("<Down>", lambda e: self._move_selection(1))
+        self.listbox.bind("<Prior>", lambda e: self._move_selection(-self.rows))
+        self.listbox.bind("<Next>", lambda e: self._move_selection(self.rows))
+        self.listbox.bind("<Home>", lambda e: self._move_selection(-self.count))
+        self.listbox.bind("<End>", lambda e: self._move_selection(self.count))
+
+    def bind(self, sequence=None, func=None, add=None):
+        # Mouse/key bindings belong on the inner listbox; handlers see this
+        # widget as event.widget, like they would with a plain Listbox.
+        if func is None:
+            return self.listbox.bind(sequence)
+
+        def handler(event):
+            event.widget = self
+            return func(event)
+        return self.listbox.bind(sequence, handler, add)
+
+    def set_count(self, count, reset=False):
+        old_count = self.count
+        self.count = count
+        if reset:
+            self.top = 0
+            self.selected = None
+        elif self.selected is not None and self.selected >= count:
+            self.selected = None
+        self.top = max(0, min(self.top, count - self.rows))
+        if reset or count < old_count or old_count < self.top + self.rows:
+            self._render()
+        else:
+            self._update_scrollbar()
+
+    def refresh(self):
+        self._render()
+
+    def size(self):
+        return self.count
+
+    def curselection(self):
+        return () if self.selected is None else (self.selected,)
+
+    def selection_set(self, first, last=None):
+        if 0 <= first < self.count:
+            self.selected = first
+            self._sync_selection()
+
+    select_set = selection_set
+
+    def selection_clear(self, first=0, last=None):
+        self.selected = None
+        self.listbox.selection_clear(0, tk.END)
+
+    select_clear = selection_clear
+
+    def nearest(self, y):
+        if not self.count:
+            return -1
+        row = self.listbox.nearest(y)
+        return min(self.count - 1, self.top + max(0, row))
+
+    def see(self, index):
+        if index < self.top:
+            self.top = index
+        elif index >= self.top + self.rows:
+            self.top = index - self.rows + 1
+        else:
+            return
+        self.top = max(0, min(self.top, self.count - self.rows))
+        self._render()
+
+    def yview(self, *args):
+        if not args:
+            return self._fractions()
+        if args[0] == "moveto":
+            self._scroll_to(int(float(args[1]) * self.count))
+        elif args[0] == "scroll":
+            amount = int(args[1])
+            if args[2] == "pages":
+                amount *= max(1, self.rows - 1)
+            self._scroll(amount)
+
+    def _fractions(self):
+        if not self.count:
+            return 0.0, 1.0
+        first = self.top / self.count
+        last = min(1.0, (self.top + self.rows) / self.count)
+        return first, last
+
+    def _update_scrollbar(self):
+        self.scrollbar.set(*self._fractions())
+
+    def _scroll(self, amount):
+        self._scroll_to(self.top + amount)
+        return "break"
+
+    def _scroll_to(self, top):
+        top = max(0, min(top, self.count - self.rows))
+        if top != self.top:
+            self.top = top
+            self._render()
+
+    def _on_wheel(self, event):
+        return self._scroll(-1 * (event.delta // 120 or (1 if event.delta > 0 else -1)) * 3)
+
+    def _on_resize(self, event):
+        rows = max(1, event.height // self.row_height)
+        if rows != self.rows:
+            self.rows = rows
+            self.top = max(0, min(self.top, self.count - self.rows))
+            self._render()
+
+    def _on_select(self, event=None):
+        sel = self.listbox.curselection()
+        self.selected = self.top + sel[0] if sel else None
+
+    def _move_selection(self, delta):
+        if not self.count:
+            return "break"
+        current = self.selected if self.selected is not None else self.top - (1 if delta > 0 else 0)
+        target = max(0, min(self.count - 1, current + delta))
+        self.selected = target
+        self.see(target)
+        self._sync_selection()
+        self.listbox.event_generate("<<ListboxSelect>>")
+        return "break"
+
+    def _sync_selection(self):
+        self.listbox.selection_clear(0, tk.END)
+        if self.selected is not None and self.top <= self.selected < self.top + self.rows:
+            self.listbox.selection_set(self.selected - self.top)
+
+    def _render(self):
+        end = min(self.count, self.top + self.rows)
+        labels = [self.label_fn(i) for i in range(self.top, end)]
+        self.listbox.delete(0, tk.END)
+        if labels:
+            self.listbox.insert(0, *labels)
+        self.listbox.yview_moveto(0)
+        self._sync_selection()
+        self._update_scrollbar()
@@ -0,0 +1,224 @@
+import hashlib
+import os
+import struct
+import threading
+
+import numpy as np
+
+
+# Peak files: min/max overviews of a track at several resolutions, for the
+# waveform seek bar. Level 0 has one int8 (min, max) pair per BASE_BIN
+# samples at PEAK_RATE; every further level merges LEVEL_FACTOR bins of the
+# one before, down to a few hundred bins. Files are memory-mapped, so
+# opening one costs the same for a 3-minute track as for a 2-hour mix, and
+# drawing only touches the bins that are on screen.
+#
+#   header  "PEAK", version (H), level count (H), rate (I), frames (Q)
+#   levels  samples per bin (I), bin count (I), data offset (Q), each
+#   data    int8 min, int8 max per bin
+
+MAGIC = b"PEAK"
+VERSION = 1
+HEADER = struct.Struct("<4sHHIQ")
+LEVEL = struct.Struct("<IIQ")
+PEAK_RATE = 11025
+BASE_BIN = 64
+LEVEL_FACTOR = 4
+MIN_BINS = 256
+
+
+def _init_worker():
+    # Workers are spawned, not forked: a forked one would inherit the
+    # player's mixer (44.1 kHz stereo) and decode at that rate.
+    os.environ["SDL_AUDIODRIVER"] = "dummy"
+    try:
+        os.nice(10)
+    except (AttributeError, OSError):
+        pass
+
+
+def decode(file_path):
+    # Mono at a low rate: an overview does not need more, and it keeps a
+    # 2-hour mix to about 160 MB while it is being reduced.
+    import pygame
+    if not pygame.mixer.get_init():
+        pygame.mixer.init(frequency=PEAK_RATE, size=-16, channels=1)
+    rate = pygame.mixer.get_init()[0]
+    sound = pygame.mixer.Sound(file_path)
+    samples = pygame.sndarray.array(sound)
+    del sound
+    return samples.reshape(len(samples), -1), rate
+
+
+def _reduce(mins, maxs, factor):
+    # Merges every factor bins; a partial last group becomes its own bin.
+    whole = len(mins) // factor * factor
+    new_mins = mins[:whole].reshape(-1, factor).min(axis=1)
+    new_maxs = maxs[:whole].reshape(-1, factor).max(axis=1)
+    if whole < len(mins):
+        new_mins = np.append(new_mins, mins[whole:].min())
+        new_maxs = np.append(new_maxs, maxs[whole:].max())
+    return new_mins, new_maxs
+
+
+def build_peaks(file_path, out_path):
+    samples, rate = decode(file_path)
+    frames = len(samples)
+    # int16 -> int8 by the high byte; channels are folded into each bin.
+    samples = (samples >> 8).astype(np.int8)
+    mins, maxs = _reduce(samples.min(axis=1), samples.max(axis=1), BASE_BIN)
+    levels = [(BASE_BIN, mins, maxs)]
+    while len(mins) > MIN_BINS:
+        mins, maxs = _reduce(mins, maxs, LEVEL_FACTOR)
+        levels.append((levels[-1][0] * LEVEL_FACTOR, mins, maxs))
+
+    offset = HEADER.size + LEVEL.size * len(levels)
+    header = [HEADER.pack(MAGIC, VERSION, len(levels), rate, frames)]
+    for samples_per_bin, mins, _ in levels:
+        header.append(LEVEL.pack(samples_per_bin, len(mins), offset))
+        offset += 2 * len(mins)
+    tmp = out_path + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(b"".join(header))
+        for _, mins, maxs in levels:
+            f.write(np.column_stack((mins, maxs)).astype(np.int8).tobytes())
+    os.replace(tmp, out_path)
+    return out_path
+
+
+class PeakFile:
+    def __init__(self, path):
+        data = np.memmap(path, dtype=np.uint8, mode="r")
+        magic, version, count, self.rate, self.frames = HEADER.unpack_from(data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"not a peak file: {path}")
+        self.levels = []
+        for i in range(count):
+            samples_per_bin, bins, offset = LEVEL.unpack_from(data, HEADER.size + i * LEVEL.size)
+            pairs = data[offset:offset + 2 * bins].view(np.int8).reshape(bins, 2)
+            self.levels.append((samples_per_bin, pairs))
+
+    @property
+    def length(self):
+        return self.frames / self.rate if self.rate else 0.0
+
+    def columns(self, start, end, width):
+        # (mins, maxs) in -1..1 for width columns covering start..end
+        # seconds, from the coarsest level that still has a bin per column.
+        if width <= 0 or end <= start or not self.levels:
+            return np.zeros(0), np.zeros(0)
+        samples_per_column = (end - start) * self.rate / width
+        samples_per_bin, pairs = self.levels[0]
+        for level_bin, level_pairs in self.levels:
+            if level_bin > samples_per_column:
+                break
+            samples_per_bin, pairs = level_bin, level_pairs
+        first = max(0, int(start * self.rate / samples_per_bin))
+        last = min(len(pairs), int(np.ceil(end * self.rate / samples_per_bin)))
+        if last <= first:
+            return np.zeros(0), np.zeros(0)
+        visible = pairs[first:last]
+        edges = np.linspace(0, len(visible), width, endpoint=False).astype(np.intp)
+        mins = np.minimum.reduceat(visible[:, 0], edges) / 128.0
+        maxs = np.maximum.reduceat(visible[:, 1], edges) / 127.0
+        return mins, maxs
+
+
+class WaveformCache:
+    # Peak files in a cache folder, named after the track's path, size and
+    # mtime. Missing ones are built on a single background process; the
+    # callback runs through post() on the caller's loop, and only for the
+    # latest request, so skipping through tracks never draws a stale one.
+    # Even the lookup stats the track, so it runs on a worker thread too.
+    # After each build the folder is trimmed to max_bytes, least recently
+    # opened first, on the executor's thread rather than the caller's loop.
+
+    def __init__(self, post, folder, max_bytes=200 * 1024 * 1024):
+        self.post = post
+        self.folder = folder
+        self.max_bytes = max_bytes
+        self.generation = 0
+        self.executor = None
+
+    def peak_path(self, file_path):
+        st = os.stat(file_path)
+        key = f"{file_path}\0{st.st_size}\0{st.st_mtime_ns}".encode("utf-8", "surrogateescape")
+        return os.path.join(self.folder, hashlib.sha1(key).hexdigest() + ".peaks")
+
+    def request(self, file_path, callback):
+        self.generation += 1
+        threading.Thread(target=self._locate, args=(self.generation, file_path, callback),
+                         daemon=True).start()
+
+    def _locate(self, generation, file_path, callback):
+        try:
+            path = self.peak_path(file_path)
+            exists = os.path.exists(path)
+            if exists:
+                os.utime(path)
+        except OSError as e:
+            print(f"Could not open waveform for {file_path}: {e}")
+            return
+        self.post(self._located, generation, file_path, path, exists, callback)
+
+    def _located(self, generation, file_path, path, exists, callback):
+        if generation != self.generation:
+            return
+        if exists:
+            try:
+                callback(PeakFile(path))
+            except (OSError, ValueError) as e:
+                print(f"Could not open waveform for {file_path}: {e}")
+            return
+        if self.executor is None:
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            os.makedirs(self.folder, exist_ok=True)
+            self.executor = ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context("spawn"),
+                                                initializer=_init_worker)
+        future = self.executor.submit(build_peaks, file_path, path)
+        future.add_done_callback(lambda f: self._finished(generation, f, file_path, callback))
+
+    def cancel(self):
+        self.generation += 1
+
+    def _finished(self, generation, future, file_path, callback):
+        if not future.cancelled() and future.exception() is None:
+            self.trim()
+        self.post(self._built, generation, future, file_path, callback)
+
+    def _built(self, generation, future, file_path, callback):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            print(f"Could not build waveform for {file_path}: {error}")
+            return
+        if generation != self.generation:
+            return
+        try:
+            callback(PeakFile(future.result()))
+        except (OSError, ValueError) as e:
+            print(f"Could not open waveform for {file_path}: {e}")
+
+    def trim(self):
+        try:
+            entries = [e for e in os.scandir(self.folder) if e.name.endswith(".peaks")]
+            stats = sorted(((e.stat(), e.path) for e in entries), key=lambda s: s[0].st_mtime)
+        except OSError:
+            return
+        total = sum(st.st_size for st, _ in stats)
+        for st, path in stats:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.unlink(path)
+                total -= st.st_size
+            except OSError:
+                pass
+
+    def close(self):
+        self.generation += 1
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.executor = None
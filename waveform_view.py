@@ -0,0 +1,133 @@
+import tkinter as tk
+
+
+class WaveformSeekBar(tk.Canvas):
+    # Seek bar that draws the current track's min/max peaks as a single
+    # polygon, from a waveform.PeakFile. The mouse wheel zooms in and out
+    # around the pointer, double-click shows the whole track again, and a
+    # click or drag seeks on release. While zoomed in, the view pages
+    # along with the playhead.
+
+    MIN_SPAN = 1.0
+
+    def __init__(self, master, on_seek, height=64, **options):
+        super().__init__(master, height=height, bg="#1e1e1e", highlightthickness=0, **options)
+        self.on_seek = on_seek
+        self.peaks = None
+        self.length = 0.0
+        self.position = 0.0
+        self.view_start = 0.0
+        self.view_span = 0.0
+        self.dragging = False
+        self.wave = self.create_polygon(0, 0, 0, 0, fill="#4a90d9", outline="")
+        self.baseline = self.create_line(0, 0, 0, 0, fill="#4a90d9")
+        self.cursor = self.create_line(0, 0, 0, 0, fill="white", width=2)
+
+        self.bind("<Configure>", lambda e: self.redraw())
+        self.bind("<ButtonPress-1>", self._on_press)
+        self.bind("<B1-Motion>", self._on_drag)
+        self.bind("<ButtonRelease-1>", self._on_release)
+        self.bind("<Double-1>", lambda e: self.reset_zoom())
+        self.bind("<MouseWheel>", lambda e: self._zoom(e.x, 0.8 if e.delta > 0 else 1.25))
+        self.bind("<Button-4>", lambda e: self._zoom(e.x, 0.8))
+        self.bind("<Button-5>", lambda e: self._zoom(e.x, 1.25))
+
+    def set_track(self, length):
+        self.peaks = None
+        self.length = length
+        self.position = 0.0
+        self.reset_zoom()
+
+    def set_peaks(self, peaks):
+        self.peaks = peaks
+        self.redraw()
+
+    def set_position(self, seconds):
+        if self.dragging:
+            return
+        self.position = seconds
+        start, span = self._view()
+        if span < self.length and not start <= seconds < start + span:
+            self.view_start = max(0.0, min(seconds, self.length - span))
+            self.redraw()
+        else:
+            self._move_cursor()
+
+    def reset_zoom(self):
+        self.view_start = 0.0
+        self.view_span = 0.0
+        self.redraw()
+
+    def _view(self):
+        # 0 as the span means the whole track.
+        span = self.view_span or self.length
+        return self.view_start, span
+
+    def _time_at(self, x):
+        start, span = self._view()
+        width = max(1, self.winfo_width())
+        return max(0.0, min(self.length, start + x / width * span))
+
+    def _x_at(self, seconds):
+        start, span = self._view()
+        if span <= 0:
+            return 0
+        return (seconds - start) / span * self.winfo_width()
+
+    def _zoom(self, x, factor):
+        if self.length <= 0:
+            return
+        anchor = self._time_at(x)
+        _, span = self._view()
+        span = max(self.MIN_SPAN, min(self.length, span * factor))
+        width = max(1, self.winfo_width())
+        self.view_start = max(0.0, min(anchor - x / width * span, self.length - span))
+        self.view_span = 0.0 if span >= self.length else span
+        self.redraw()
+
+    def _on_press(self, event):
+        if self.length <= 0:
+            return
+        self.dragging = True
+        self.position = self._time_at(event.x)
+        self._move_cursor()
+
+    def _on_drag(self, event):
+        if self.dragging:
+            self.position = self._time_at(event.x)
+            self._move_cursor()
+
+    def _on_release(self, event):
+        if not self.dragging:
+            return
+        self.dragging = False
+        self.position = self._time_at(event.x)
+        self._move_cursor()
+        self.on_seek(self.position)
+
+    def _move_cursor(self):
+        x = self._x_at(self.position)
+        self.coords(self.cursor, x, 0, x, self.winfo_height())
+
+    def redraw(self):
+        width = self.winfo_width()
+        height = self.winfo_height()
+        middle = height / 2
+        self.coords(self.baseline, 0, middle, width, middle)
+        start, span = self._view()
+        mins = maxs = ()
+        if self.peaks is not None and span > 0:
+            mins, maxs = self.peaks.columns(start, start + span, width)
+        if len(mins):
+            scale = middle - 2
+            top = []
+            bottom = []
+            for x, (low, high) in enumerate(zip(mins.tolist(), maxs.tolist())):
+                top.extend((x, middle - high * scale))
+                bottom.extend((x, middle - low * scale))
+            for i in range(len(bottom) - 2, -1, -2):
+                top.extend(bottom[i:i + 2])
+            self.coords(self.wave, *top)
+        else:
+            self.coords(self.wave, 0, middle, 0, middle)
+        self._move_cursor()